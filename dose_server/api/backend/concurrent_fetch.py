@@ -0,0 +1,78 @@
+"""
+Runs independent upstream fetches concurrently on a shared thread pool.
+
+Each fetch has its own timeout and its errors are isolated, a failed or timed out fetch
+is reported in its result without affecting the others. Fetches run in a copy of the caller's
+context, so spans started in them are recorded for the calling request.
+"""
+
+import concurrent.futures
+import contextvars
+import time
+import typing
+
+from django import db
+
+import logging
+logger = logging.getLogger('dose-logger')
+
+MAX_WORKERS = 16
+
+# Timeout of a fetch without its own timeout
+DEFAULT_TIMEOUT_SECONDS = 120
+
+_executor = concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix="upstream-fetch")
+
+
+class FetchResult(typing.NamedTuple):
+    value : typing.Any = None
+    error : typing.Optional[BaseException] = None
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+class FetchTimeout(Exception):
+    pass
+
+
+def _run_fetch(fetch : typing.Callable[[], typing.Any]) -> typing.Any:
+    try:
+        return fetch()
+    finally:
+        # Database connections are per thread, close the ones opened by the fetch
+        db.connections.close_all()
+
+def fetch_concurrently(fetches : typing.Dict[str, typing.Callable[[], typing.Any]], timeouts : typing.Optional[typing.Dict[str, float]] = None, executor : typing.Optional[concurrent.futures.Executor] = None) -> typing.Dict[str, FetchResult]:
+    """
+    Runs every fetch concurrently, returns their results by name once all finished or timed out.
+    A timed out fetch keeps running in the background, its result is discarded.
+
+    Fetches which themselves fetch concurrently must use another executor than the one running them,
+    waiting on the shared pool from inside it can exhaust it.
+    """
+    timeouts = timeouts or {}
+    executor = executor or _executor
+
+    started = time.monotonic()
+    futures = {
+        name : executor.submit(contextvars.copy_context().run, _run_fetch, fetch)
+        for name, fetch in fetches.items()
+    }
+
+    results : typing.Dict[str, FetchResult] = {}
+    # Shortest timeouts first, a fetch which finished before it is waited on is never timed out
+    for name in sorted(futures, key=lambda name: timeouts.get(name, DEFAULT_TIMEOUT_SECONDS)):
+        future = futures[name]
+        timeout = timeouts.get(name, DEFAULT_TIMEOUT_SECONDS)
+        try:
+            results[name] = FetchResult(value=future.result(timeout=max(started + timeout - time.monotonic(), 0)))
+        except concurrent.futures.TimeoutError:
+            logger.warning("fetch | \"%s timed out after %s seconds\"", name, timeout)
+            results[name] = FetchResult(error=FetchTimeout("{} timed out after {} seconds".format(name, timeout)))
+        except Exception as e:
+            logger.warning("fetch | \"%s failed: %s\"", name, e)
+            results[name] = FetchResult(error=e)
+
+    return {name : results[name] for name in fetches}
@@ -0,0 +1,311 @@
+"""
+Dexcom API client over a bounded pool of keep-alive HTTPS connections.
+
+Access tokens are refreshed ahead of their expiration (the OAuth expires_in), refreshes of a
+user are serialized with a per process lock, so concurrent requests reuse one refresh instead of
+each spending the single use refresh token. The tokens are read and written under a row lock on the user.
+"""
+
+import collections
+import contextlib
+import datetime
+import http.client
+import json
+import threading
+import typing
+import urllib.parse
+
+from django.conf import settings
+from django.db import transaction
+
+from api import models
+from api import utility
+
+from . import rate_limits
+
+# settings.UPSTREAM_BASE_URL replaces it, to sync against the fake_upstream server
+DEXCOM_BASE_URL = "https://api.dexcom.com"
+DEXCOM_REDIRECT_URI = "diabetes-dose://oauth-callback/dexcom"
+
+dex_client_id = "1bgV6dunaufYB8YwVxtJqVqC5a7ThmYI"
+dex_client_secret = "VRY8PtUOI4fjQaMp"
+
+POOL_SIZE = 8
+CONNECTION_TIMEOUT_SECONDS = 30
+STREAM_DRAIN_CHUNK = 64 * 1024
+
+# Tokens expiring within this margin are refreshed before being used
+TOKEN_EXPIRY_MARGIN = datetime.timedelta(minutes=2)
+
+# Token responses of a refresh token which is no longer valid (invalid_grant)
+INVALID_GRANT_STATUSES = (400, 401)
+
+TOKEN_FIELDS = ["dexcom_access_token", "dexcom_refresh_token", "dexcom_access_token_expiration"]
+
+# Only these are sent again after a stale connection error
+IDEMPOTENT_METHODS = ("GET", "HEAD")
+
+# Raised by a kept alive connection the server has closed in the meantime
+_STALE_CONNECTION_ERRORS = (http.client.RemoteDisconnected, http.client.CannotSendRequest, ConnectionResetError, BrokenPipeError)
+
+
+class DexcomApiError(Exception):
+
+    def __init__(self, status : int, message : str):
+        super().__init__("Dexcom API HTTP {} response: {}".format(status, message))
+        self.status = status
+
+
+class ConnectionPool:
+    """
+    At most `max_size` connections to the `base_url` host in use at once, idle connections are kept open for reuse.
+    """
+
+    def __init__(self, base_url : str, max_size : int = POOL_SIZE, timeout : float = CONNECTION_TIMEOUT_SECONDS):
+        url = urllib.parse.urlsplit(base_url)
+        self.host = url.netloc
+        self._connection_class = http.client.HTTPConnection if url.scheme == "http" else http.client.HTTPSConnection
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._idle : typing.Deque[http.client.HTTPConnection] = collections.deque()
+        self._idle_lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def connection(self) -> typing.Iterator[typing.Tuple[http.client.HTTPConnection, bool]]:
+        """
+        Yields (connection, reused), the connection goes back to the pool unless the block raised.
+        """
+        with self._slots:
+            with self._idle_lock:
+                conn = self._idle.pop() if self._idle else None
+
+            reused = conn is not None
+            if conn is None:
+                conn = self._connection_class(self.host, timeout=self.timeout)
+
+            try:
+                yield conn, reused
+            except BaseException:
+                conn.close()
+                raise
+
+            with self._idle_lock:
+                self._idle.append(conn)
+
+    def request(self, method : str, path : str, body : typing.Optional[str] = None, headers : typing.Optional[typing.Dict[str, str]] = None) -> typing.Tuple[int, bytes]:
+        """
+        Sends a request, returns (status, body). The body is always read so the connection can be reused.
+        Idempotent requests are retried once on a new connection when a reused one turns out to be closed.
+        """
+        headers = headers or {}
+        with self.connection() as (conn, reused):
+            try:
+                response = self._send(conn, method, path, body, headers)
+            except _STALE_CONNECTION_ERRORS:
+                # The request may have reached the server, a token POST is not sent twice
+                if not reused or method not in IDEMPOTENT_METHODS:
+                    raise
+                # The server closed the idle connection, retry once on a new one
+                conn.close()
+                response = self._send(conn, method, path, body, headers)
+
+            data = response.read()
+            if response.will_close:
+                conn.close()
+
+            return response.status, data
+
+    @contextlib.contextmanager
+    def stream(self, method : str, path : str, body : typing.Optional[str] = None, headers : typing.Optional[typing.Dict[str, str]] = None) -> typing.Iterator[http.client.HTTPResponse]:
+        """
+        Yields the response with its body unread, the rest of the body is drained afterwards so the connection can be reused.
+        """
+        headers = headers or {}
+        with self.connection() as (conn, reused):
+            try:
+                response = self._send(conn, method, path, body, headers)
+            except _STALE_CONNECTION_ERRORS:
+                if not reused or method not in IDEMPOTENT_METHODS:
+                    raise
+                conn.close()
+                response = self._send(conn, method, path, body, headers)
+
+            yield response
+
+            while not response.isclosed() and response.read(STREAM_DRAIN_CHUNK):
+                pass
+            if response.will_close:
+                conn.close()
+
+    def _send(self, conn : http.client.HTTPConnection, method : str, path : str, body : typing.Optional[str], headers : typing.Dict[str, str]) -> http.client.HTTPResponse:
+        conn.request(method, path, body, headers)
+        return conn.getresponse()
+
+    def close(self):
+        with self._idle_lock:
+            while self._idle:
+                self._idle.pop().close()
+
+
+pool = ConnectionPool(getattr(settings, "UPSTREAM_BASE_URL", None) or DEXCOM_BASE_URL)
+
+_refresh_locks : typing.Dict[typing.Any, threading.Lock] = collections.defaultdict(threading.Lock)
+_refresh_locks_lock = threading.Lock()
+
+
+def _refresh_lock(user : models.User) -> threading.Lock:
+    with _refresh_locks_lock:
+        return _refresh_locks[user.pk]
+
+def token_is_fresh(user : models.User) -> bool:
+    if user.dexcom_access_token is None or user.dexcom_access_token_expiration is None:
+        return False
+
+    return user.dexcom_access_token_expiration - TOKEN_EXPIRY_MARGIN > utility.utc_datetime()
+
+def access_token(user : models.User) -> typing.Optional[str]:
+    """
+    Access token of the user, refreshed first if it is missing or about to expire.
+    """
+    if token_is_fresh(user):
+        return user.dexcom_access_token
+
+    return refresh_access_token(user)
+
+def refresh_access_token(user : models.User) -> typing.Optional[str]:
+    """
+    Replaces the user's access token, returns None if the refresh token is no longer valid and
+    raises DexcomApiError for any other failed response. If another request already replaced the token
+    while this one waited, its token is used.
+
+    The row lock of the user is only held to read and to write the tokens, not across the token request.
+    """
+    stale_token = user.dexcom_access_token
+
+    with _refresh_lock(user):
+        locked_user = _fresh_locked_tokens(user, stale_token)
+        if locked_user is None:
+            return user.dexcom_access_token
+
+        payload = urllib.parse.urlencode({
+            "client_secret": dex_client_secret,
+            "client_id": dex_client_id,
+            "refresh_token": locked_user.dexcom_refresh_token,
+            "grant_type": "refresh_token",
+            "redirect_uri": DEXCOM_REDIRECT_URI
+        })
+
+        headers = {
+            'content-type': "application/x-www-form-urlencoded",
+            'cache-control': "no-cache"
+        }
+
+        status, data = pool.request("POST", "/v2/oauth2/token", payload, headers)
+
+        if status in INVALID_GRANT_STATUSES:
+            # Refresh code is no longer valid, unless another node spent it first
+            if _fresh_locked_tokens(user, stale_token) is None:
+                return user.dexcom_access_token
+            return None
+
+        if status != 200:
+            # Throttled or failed, the refresh token is still valid
+            if status == 429:
+                rate_limits.limiter.throttled(pool.host)
+            raise DexcomApiError(status, data.decode("utf-8", errors="replace"))
+
+        response_dict = json.loads(data.decode("utf-8"))
+
+        with transaction.atomic():
+            locked_user = models.User.objects.select_for_update().only(*TOKEN_FIELDS).get(pk=user.pk)
+
+            locked_user.dexcom_access_token = response_dict.get("access_token", locked_user.dexcom_access_token)
+            locked_user.dexcom_refresh_token = response_dict.get("refresh_token", locked_user.dexcom_refresh_token)
+
+            expires_in = response_dict.get("expires_in")
+            locked_user.dexcom_access_token_expiration = utility.utc_datetime() + datetime.timedelta(seconds=expires_in) if expires_in is not None else None
+
+            locked_user.save(update_fields=TOKEN_FIELDS)
+            _copy_tokens(locked_user, user)
+
+    return user.dexcom_access_token
+
+def _fresh_locked_tokens(user : models.User, stale_token : typing.Optional[str]) -> typing.Optional[models.User]:
+    # Copies the stored tokens to user and returns None if another request replaced the stale token,
+    # otherwise returns the stored tokens for a refresh
+    with transaction.atomic():
+        locked_user = models.User.objects.select_for_update().only(*TOKEN_FIELDS).get(pk=user.pk)
+
+    if locked_user.dexcom_access_token != stale_token and token_is_fresh(locked_user):
+        _copy_tokens(locked_user, user)
+        return None
+
+    return locked_user
+
+def _copy_tokens(source : models.User, target : models.User):
+    for field in TOKEN_FIELDS:
+        setattr(target, field, getattr(source, field))
+
+def get(user : models.User, path : str) -> typing.Tuple[int, bytes]:
+    """
+    Authorized GET, returns (status, body). A 401 refreshes the token and retries once,
+    the status is 401 if the user has no valid token.
+    """
+    token = access_token(user)
+    if token is None:
+        print("Refresh token is invalid, could not get new access token")
+        return 401, b""
+
+    status, data = _limited_request(user, path, token)
+    if status != 401:
+        return status, data
+
+    # 401, access token revoked or expired early
+    token = refresh_access_token(user)
+    if token is None:
+        print("Refresh token is invalid, could not get new access token")
+        return 401, b""
+
+    return _limited_request(user, path, token)
+
+def _limited_request(user : models.User, path : str, token : str) -> typing.Tuple[int, bytes]:
+    rate_limits.limiter.acquire(pool.host, user.pk)
+    status, data = pool.request("GET", path, headers={'authorization': "Bearer {}".format(token)})
+    if status == 429:
+        rate_limits.limiter.throttled(pool.host)
+    return status, data
+
+@contextlib.contextmanager
+def stream_get(user : models.User, path : str) -> typing.Iterator[typing.Tuple[int, typing.Optional[http.client.HTTPResponse]]]:
+    """
+    Authorized GET yielding (status, response) with the body unread, refreshing the token and retrying once after a 401.
+    The response is None if the user has no valid token.
+    """
+    token = access_token(user)
+    if token is None:
+        print("Refresh token is invalid, could not get new access token")
+        yield 401, None
+        return
+
+    with _limited_stream(user, path, token) as response:
+        if response.status != 401:
+            yield response.status, response
+            return
+
+    # 401, access token revoked or expired early
+    token = refresh_access_token(user)
+    if token is None:
+        print("Refresh token is invalid, could not get new access token")
+        yield 401, None
+        return
+
+    with _limited_stream(user, path, token) as response:
+        yield response.status, response
+
+@contextlib.contextmanager
+def _limited_stream(user : models.User, path : str, token : str) -> typing.Iterator[http.client.HTTPResponse]:
+    rate_limits.limiter.acquire(pool.host, user.pk)
+    with pool.stream("GET", path, headers={'authorization': "Bearer {}".format(token)}) as response:
+        if response.status == 429:
+            rate_limits.limiter.throttled(pool.host, response.getheader("Retry-After"))
+        yield response
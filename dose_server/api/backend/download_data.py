@@ -1,45 +1,76 @@
 
+import concurrent.futures
 import datetime
-import math
+import functools
+import itertools
 import arrow
+import dateutil.tz
 import logging
 import enum
-import json
-import http.client
+import threading
+import time
 import typing
 import arrow
+import numpy as np
 
 from api.models import User
 from api import utility
 
-from tconnectsync.parser.tconnect import TConnectEntry
-from tconnectsync.secret import TIMEZONE_NAME
+from . import concurrent_fetch
+from . import dexcom_client
+from . import json_stream
+from . import merge_engine
+from . import rate_limits
+from . import response_cache
+from . import spans
+from . import timestamps
+
 
 from tconnectsync.util import timeago
 from tconnectsync.api.common import ApiException
-from tconnectsync.features import *
+from tconnectsync.api.controliq import ControlIQApi
+from tconnectsync.api.ws2 import WS2Api
 from tconnectsync.sync.basal import (
     process_ciq_basal_events,
     add_csv_basal_events
 )
-from tconnectsync.sync.bolus import (
-    process_bolus_events
-)
-from tconnectsync.sync.iob import (
-    process_iob_events
-)
-from tconnectsync.sync.cgm import (
-    process_cgm_events
-)
-from tconnectsync.sync.pump_events import (
-    process_ciq_activity_events,
-    process_basalsuspension_events
-)
 
 logger = logging.getLogger(__name__)
 
-dex_client_id = "1bgV6dunaufYB8YwVxtJqVqC5a7ThmYI"
-dex_client_secret = "VRY8PtUOI4fjQaMp"
+# Timeouts of the concurrent downloads by source, in seconds
+FETCH_TIMEOUTS = {
+    "tconnect_ciq" : 60,
+    "tconnect_csv" : 300,
+    "dexcom" : 180
+}
+
+# Dexcom EGVs are downloaded in windows of this length, a few at a time
+DEXCOM_EGV_WINDOW = datetime.timedelta(days=7)
+DEXCOM_CONCURRENCY = 4
+DEXCOM_WINDOW_TIMEOUT = 30
+DEXCOM_WINDOW_ATTEMPTS = 3
+
+# EGV record fields kept, the cached days hold one list per field
+EGV_FIELDS = ("systemTime", "displayTime", "value", "trend", "trendRate")
+
+# Separate from the concurrent_fetch pool the Dexcom download itself runs on
+_dexcom_executor = concurrent.futures.ThreadPoolExecutor(max_workers=DEXCOM_CONCURRENCY, thread_name_prefix="dexcom-egvs")
+
+# t:connect CSV exports are downloaded in ranges of whole days, a few at a time
+TCONNECT_CSV_CONCURRENCY = 4
+TCONNECT_CSV_RANGE_TIMEOUT = 120
+
+_tconnect_csv_executor = concurrent.futures.ThreadPoolExecutor(max_workers=TCONNECT_CSV_CONCURRENCY, thread_name_prefix="tconnect-csv")
+
+# Largest CSV range in days which downloaded for a t:connect account, ranges start at this size
+_tconnect_csv_window_days : typing.Dict[str, int] = {}
+_tconnect_csv_window_lock = threading.Lock()
+
+CSV_SECTIONS = ("readingData", "iobData", "basalData", "bolusData")
+# Local time of a CSV row, boluses use the first of these which is set
+CSV_ROW_TIME_KEYS = ("EventDateTime", "CompletionDateTime", "RequestDateTime", "BolexStartDateTime")
+
+_CIQ_EPOCH_TIMEZONE = dateutil.tz.gettz("America/Los_Angeles")
 
 class DataType(enum.Enum):
     BOLUS = 1
@@ -48,10 +79,49 @@ class DataType(enum.Enum):
     CGM = 4
     TREND = 5
     TREND_RATE = 6
-    
+    TIME = 7
+    BASEL_RATE = 8
+    BASEL_DURATION = 9
+    BASEL_DELIVERY_TYPE = 10
+
+
+class Stream(enum.Enum):
+    DEXCOM_CGM = 1
+    TANDEM_CGM = 2
+    IOB = 3
+    BOLUS = 4
+    BASAL = 5
+
+
+# Upstream sources each stream is parsed from, basal segments come from ControlIQ and from the CSV of older pumps
+STREAM_SOURCES = {
+    Stream.DEXCOM_CGM : ("dexcom",),
+    Stream.TANDEM_CGM : ("tconnect_csv",),
+    Stream.IOB : ("tconnect_csv",),
+    Stream.BOLUS : ("tconnect_csv",),
+    Stream.BASAL : ("tconnect_ciq", "tconnect_csv")
+}
+
+
+class DownloadPlan(typing.NamedTuple):
+    """
+    Streams an endpoint uses, only their sources are downloaded and only they are parsed.
+    """
+    streams : typing.FrozenSet[Stream]
+
+    def sources(self) -> typing.Set[str]:
+        return {source for stream in self.streams for source in STREAM_SOURCES[stream]}
+
 
+# Every stream persisted in a DiabetesEntry
+SYNC_PLAN = DownloadPlan(frozenset(Stream))
 
-def custom_bolus_parse(bolus_data):
+# Streams of an insulin calculation, without the ControlIQ download of the basal segments.
+# It leaves user.last_fetched_basal_datetime behind, the next SYNC_PLAN sync resumes the basal segments from it.
+INSULIN_PLAN = DownloadPlan(frozenset({Stream.DEXCOM_CGM, Stream.TANDEM_CGM, Stream.IOB, Stream.BOLUS}))
+
+
+def custom_bolus_parse(bolus_data, timezone_name : str):
 
     final_return_data = []
 
@@ -70,8 +140,8 @@ def custom_bolus_parse(bolus_data):
         final_dict["bg"] = bg if bg != '' else None
         final_dict["iob"] = iob if iob != '' else None
         final_dict["insulin"] = insulin if insulin != '' else None
-        final_dict["request_time"] = arrow.get(req_time, tzinfo=TIMEZONE_NAME) if req_time != '' else None
-        final_dict["completion_time"] = arrow.get(comp_time, tzinfo=TIMEZONE_NAME) if comp_time != '' else None
+        final_dict["request_time"] = timestamps.optional_local_timestamp(req_time, timezone_name)
+        final_dict["completion_time"] = timestamps.optional_local_timestamp(comp_time, timezone_name)
         final_dict["target_bg"] = target_bg if target_bg != '' else None
 
         # Manual or Automatic Correction
@@ -85,257 +155,502 @@ def custom_bolus_parse(bolus_data):
 
     return final_return_data
 
-def download_tconnect_csv(tconnect, time_start : arrow.Arrow, time_end : arrow.Arrow):
-    tconnect.ws2.MAX_RETRIES = 0 # If it fails, it won't succeed again
+def parse_tandem_readings(reading_data : typing.List[typing.Dict[str, str]], timezone_name : str) -> typing.Dict[DataType, np.ndarray]:
+    # CGM readings as columns of epoch seconds and BG
+    return {
+        DataType.TIME : timestamps.parse_local_timestamps((reading["EventDateTime"] for reading in reading_data), timezone_name),
+        DataType.CGM : merge_engine.optional_floats(reading["Readings (CGM / BGM)"] for reading in reading_data)
+    }
+
+def parse_tandem_iob(iob_data : typing.List[typing.Dict[str, str]], timezone_name : str) -> typing.Dict[DataType, np.ndarray]:
+    # Insulin-on-Board samples as columns of epoch seconds and IOB
+    return {
+        DataType.TIME : timestamps.parse_local_timestamps((iob_dict["EventDateTime"] for iob_dict in iob_data), timezone_name),
+        DataType.IOB : merge_engine.optional_floats(iob_dict["IOB"] for iob_dict in iob_data)
+    }
 
-    csvdata : typing.Optional[typing.Dict[str, typing.Any]] = None
+def parse_basal_events(basal_events : typing.List[typing.Dict[str, typing.Any]], timezone_name : str) -> typing.Dict[DataType, np.ndarray]:
+    # Basal segments from process_ciq_basal_events and add_csv_basal_events as columns, durations are in minutes (NaN if unknown)
+    return {
+        DataType.TIME : timestamps.parse_local_timestamps((basal_dict["time"] for basal_dict in basal_events), timezone_name),
+        DataType.BASEL_RATE : merge_engine.optional_floats(basal_dict["basal_rate"] for basal_dict in basal_events),
+        DataType.BASEL_DURATION : merge_engine.optional_floats(basal_dict["duration_mins"] for basal_dict in basal_events),
+        DataType.BASEL_DELIVERY_TYPE : np.array([basal_dict["delivery_type"] for basal_dict in basal_events], dtype=object)
+    }
 
-    full_time_delta : datetime.timedelta = time_end - time_start
+def csv_day_ranges(first_day : datetime.date, last_day : datetime.date, window_days : int) -> typing.List[typing.Tuple[datetime.date, datetime.date]]:
+    # Inclusive (first day, last day) ranges of at most window_days days
+    day_ranges = []
+    range_start = first_day
+    while range_start <= last_day:
+        range_end = min(range_start + datetime.timedelta(days=window_days - 1), last_day)
+        day_ranges.append((range_start, range_end))
+        range_start = range_end + datetime.timedelta(days=1)
+
+    return day_ranges
+
+def _range_days(day_range : typing.Tuple[datetime.date, datetime.date]) -> int:
+    return (day_range[1] - day_range[0]).days + 1
+
+def _range_too_large(error : BaseException) -> bool:
+    # ws2 answers a range it cannot export with a 500, or does not answer in time
+    return isinstance(error, concurrent_fetch.FetchTimeout) or (isinstance(error, ApiException) and error.status_code == 500)
+
+def _csv_row_day(row : typing.Dict[str, str], first_day : datetime.date, last_day : datetime.date) -> datetime.date:
+    for key in CSV_ROW_TIME_KEYS:
+        value = row.get(key)
+        if not value:
+            continue
+
+        try:
+            day = datetime.date.fromisoformat(value[:10])
+        except ValueError:
+            continue
+
+        return min(max(day, first_day), last_day)
+
+    return first_day
+
+def split_csv_days(csv_data : typing.Dict[str, typing.Any], first_day : datetime.date, last_day : datetime.date) -> typing.Dict[datetime.date, typing.Dict[str, typing.List[typing.Dict[str, str]]]]:
+    # Rows of a CSV range by the local day of their time
+    day_csvs = {day : {section : [] for section in CSV_SECTIONS} for day in response_cache.day_range(first_day, last_day)}
+    for section in CSV_SECTIONS:
+        for row in csv_data.get(section) or []:
+            day_csvs[_csv_row_day(row, first_day, last_day)][section].append(row)
+
+    return day_csvs
+
+def download_csv_runs(tconnect, runs : typing.List[typing.Tuple[datetime.date, datetime.date]]) -> typing.Dict[datetime.date, typing.Dict[str, typing.List[typing.Dict[str, str]]]]:
+    """
+    Downloads the therapy timeline CSV of every day in the runs, in ranges of the largest
+    window which previously worked for the user, TCONNECT_CSV_CONCURRENCY ranges at a time.
+    Ranges failing as too large are halved and retried, down to a single day.
+    """
+    longest_run_days = max(_range_days(run) for run in runs)
+    with _tconnect_csv_window_lock:
+        window_days = min(_tconnect_csv_window_days.get(tconnect.email, longest_run_days), longest_run_days)
+
+    pending = [day_range for run in runs for day_range in csv_day_ranges(run[0], run[1], window_days)]
+    day_csvs : typing.Dict[datetime.date, typing.Dict[str, typing.List[typing.Dict[str, str]]]] = {}
+    largest_working_days = 0
+    smallest_failed_days : typing.Optional[int] = None
+
+    while len(pending) > 0:
+        fetches = {
+            "tconnect_csv {}".format(day_range[0].isoformat()) : functools.partial(_limited_tconnect_call, WS2Api.BASE_URL, tconnect, _ws2(tconnect).therapy_timeline_csv, *day_range)
+            for day_range in pending
+        }
+        results = concurrent_fetch.fetch_concurrently(fetches, {name : TCONNECT_CSV_RANGE_TIMEOUT for name in fetches}, executor=_tconnect_csv_executor)
+
+        failed = []
+        for day_range, result in zip(pending, results.values()):
+            range_days = _range_days(day_range)
+            if result.ok:
+                day_csvs.update(split_csv_days(result.value, *day_range))
+                largest_working_days = max(largest_working_days, range_days)
+            elif _range_too_large(result.error) and range_days > 1:
+                failed.append(day_range)
+                smallest_failed_days = min(smallest_failed_days or range_days, range_days)
+            else:
+                raise result.error
+
+        pending = []
+        for day_range in failed:
+            half_days = _range_days(day_range) // 2
+            pending.append((day_range[0], day_range[0] + datetime.timedelta(days=half_days - 1)))
+            pending.append((day_range[0] + datetime.timedelta(days=half_days), day_range[1]))
+
+        if len(failed) > 0:
+            print("{} t:connect CSV ranges failed, retrying as {} ranges".format(len(failed), len(pending)))
+
+    with _tconnect_csv_window_lock:
+        if smallest_failed_days is None:
+            # Only grows, a short sync does not shrink the window of a long one
+            _tconnect_csv_window_days[tconnect.email] = max(_tconnect_csv_window_days.get(tconnect.email, 0), largest_working_days)
+        else:
+            _tconnect_csv_window_days[tconnect.email] = max(min(largest_working_days, smallest_failed_days - 1), 1)
+
+    return day_csvs
+
+def _limited_tconnect_call(base_url : str, tconnect, call : typing.Callable[..., typing.Any], *args) -> typing.Any:
+    # Rate limited by the host and the t:connect account
+    host = rate_limits.url_host(base_url)
+    rate_limits.limiter.acquire(host, tconnect.email)
     try:
-          csvdata = tconnect.ws2.therapy_timeline_csv(time_start, time_end) 
-          return csvdata
+        return call(*args)
     except ApiException as e:
-        if e.status_code == 500:
-            # Failed first time, Run algorithm
-            print("First range failed, finding sitable day range to fulfill request")
-            while csvdata is None:
-                new_days = full_time_delta.days // 2
-                new_time_start = time_start.shift(days=-new_days)
-                try:
-                    csvdata = tconnect.ws2.therapy_timeline_csv(new_time_start, time_end)  
-                except ApiException as e:
-                    if e.status_code == 500:
-                        print("New range of {} days failed, retrying".format(new_days))
-                        csvdata = None
-
-            # Found valid range, run entire request, sliced up with these ranges
-            print("Found valid range of {} days".format(new_days))
-            valid_range_seconds = new_days * 24 * 60 * 60
-
-            full_range_count = math.floor(full_time_delta.seconds / valid_range_seconds) # Highest resolution
-
-            start_end_times : typing.List[typing.Tuple[arrow.Arrow, arrow.Arrow]] = [] # Tuple (startTime, endTime)
-
-            # Append ranges
-            current_start_time = time_start
-            for i in range(full_range_count):
-                end_time = current_start_time.shift(seconds=valid_range_seconds)
-                start_end_times.append((current_start_time, end_time))
-                current_start_time = end_time
-
-
-            # Append remainder
-            start_end_times.append((current_start_time, time_end))
-
-            # Fetch data for ranges
-            print("Starting to fetch multiple ranges data: {}".format(utility.utc_datetime().isoformat(timespec="seconds")))
-            range_dicts : typing.List[typing.Dict[str, typing.Any]] = []
-            for range_tup in start_end_times:
-                range_data = download_tconnect_csv(tconnect, range_tup[0], range_tup[1])
-
-                range_dicts.append(range_data)
-
-            print("Finished fetching multiple ranges data: {}".format(utility.utc_datetime().isoformat(timespec="seconds")))
-            final_dict : typing.Dict[str, typing.Any] = {
-                "readingData": [],
-                "iobData": [],
-                "basalData": [],
-                "bolusData": []
-            }
-            for range_dict in range_dicts:
-                reading_data = range_dict.get("readingData")
-                if reading_data is not None:
-                    final_dict["readingData"] += reading_data
-
-                iob_data = range_dict.get("iobData")
-                if iob_data is not None:
-                    final_dict["iobData"] += iob_data
-                    
-                basel_data = range_dict.get("basalData")
-                if basel_data is not None:
-                    final_dict["basalData"] += basel_data
-
-                bolus_data = range_dict.get("bolusData")
-                if bolus_data is not None:
-                    final_dict["bolusData"] += bolus_data
-
-            return final_dict
-            
-        print("Other API Exception: {}".format(e))
-
-def handle_bolus_data(bolus_csv_data : typing.List[typing.Dict[str, typing.Any]]):
-
-    # Bullshit hack around api
-    bolus_data = [bolus_dict for bolus_dict in bolus_csv_data if bolus_dict.get('CompletionDateTime') != '' and bolus_dict.get('CompletionDateTime') is not None]
-
-    return process_bolus_events(bolus_data)
-
-
-def download_tconnect_data(tconnect, time_start : arrow.Arrow, time_end : arrow.Arrow, features=DEFAULT_FEATURES):
-    print("Downloading t:connect ControlIQ data")
+        if e.status_code == 429:
+            rate_limits.limiter.throttled(host)
+        raise
+
+def _local_days(time_start : arrow.Arrow, time_end : arrow.Arrow, timezone_name : str) -> typing.List[datetime.date]:
+    # t:connect ranges are whole days of the pump's time zone
+    return response_cache.day_range(time_start.to(timezone_name).date(), time_end.to(timezone_name).date())
+
+def download_tconnect_csv(tconnect, time_start : arrow.Arrow, time_end : arrow.Arrow, timezone_name : str) -> typing.Dict[str, typing.List[typing.Dict[str, str]]]:
+    """
+    Therapy timeline CSV rows of every local day in the window, closed days are read from the response cache.
+    """
+    ws2 = _ws2(tconnect)
+    ws2.MAX_RETRIES = 0 # If it fails, it won't succeed again
+    ws2.SLEEP_SECONDS_INCREMENT = 0 # ws2 sleeps before checking MAX_RETRIES, failed ranges are split instead
+
+    first_open_day = response_cache.first_open_day(arrow.now(timezone_name))
+    day_csvs = response_cache.cached_days(tconnect.email, "tconnect_csv", _local_days(time_start, time_end, timezone_name), first_open_day, lambda runs: download_csv_runs(tconnect, runs))
+
+    return {
+        section : list(itertools.chain.from_iterable(day_csv[section] for day_csv in day_csvs))
+        for section in CSV_SECTIONS
+    }
+
+def _ciq_event_day(x : typing.Any) -> typing.Optional[datetime.date]:
+    # x is the user's wall clock read as an America/Los_Angeles epoch, see TConnectEntry._epoch_parse
     try:
-        ciqTherapyTimelineData = tconnect.controliq.therapy_timeline(time_start, time_end)
+        return datetime.datetime.fromtimestamp(x, _CIQ_EPOCH_TIMEZONE).date()
+    except (TypeError, ValueError, OverflowError, OSError):
+        return None
+
+def _split_ciq(value : typing.Any, first_day : datetime.date, last_day : datetime.date) -> typing.Dict[datetime.date, typing.Any]:
+    # Events with an "x" time are split by day, other list items go to the first day, other values to every day
+    days = response_cache.day_range(first_day, last_day)
+    if isinstance(value, dict):
+        day_values : typing.Dict[datetime.date, typing.Any] = {day : {} for day in days}
+        for key, item in value.items():
+            for day, day_item in _split_ciq(item, first_day, last_day).items():
+                day_values[day][key] = day_item
+        return day_values
+
+    if isinstance(value, list):
+        day_values = {day : [] for day in days}
+        for event in value:
+            event_day = _ciq_event_day(event.get("x")) if isinstance(event, dict) else None
+            day_values[min(max(event_day, first_day), last_day) if event_day is not None else first_day].append(event)
+        return day_values
+
+    return {day : value for day in days}
+
+def _merge_ciq(day_values : typing.List[typing.Any]) -> typing.Any:
+    first_value = day_values[0]
+    if isinstance(first_value, dict):
+        keys = list(dict.fromkeys(key for day_value in day_values for key in day_value))
+        return {key : _merge_ciq([day_value[key] for day_value in day_values if key in day_value]) for key in keys}
+
+    if isinstance(first_value, list):
+        return list(itertools.chain.from_iterable(day_values))
+
+    return first_value
+
+def download_ciq_run(tconnect, first_day : datetime.date, last_day : datetime.date) -> typing.Dict[datetime.date, typing.Any]:
+    try:
+        therapy_timeline = _limited_tconnect_call(ControlIQApi.BASE_URL, tconnect, _controliq(tconnect).therapy_timeline, first_day, last_day)
     except ApiException as e:
         # The ControlIQ API returns a 404 if the user did not have a ControlIQ enabled
         # device in the time range which is queried. Since it launched in early 2020,
         # ignore 404's before February.
-        if e.status_code == 404 and time_start.date() < datetime.date(2020, 2, 1):
+        if e.status_code == 404 and first_day < datetime.date(2020, 2, 1):
             logger.warning("Ignoring HTTP 404 for ControlIQ API request before Feb 2020")
-            ciqTherapyTimelineData = None
+            return {day : None for day in response_cache.day_range(first_day, last_day)}
         else:
             raise e
 
-    print("Downloading t:connect CSV data")
-    tconnect.ws2.MAX_RETRIES = 0 # If it fails, it won't succeed again
+    return _split_ciq(therapy_timeline, first_day, last_day)
 
-    csvdata = download_tconnect_csv(tconnect, time_start, time_end)
+def download_ciq_therapy_timeline(tconnect, time_start : arrow.Arrow, time_end : arrow.Arrow, timezone_name : str):
+    print("Downloading t:connect ControlIQ data")
+    with spans.span("tconnect_ciq"):
+        first_open_day = response_cache.first_open_day(arrow.now(timezone_name))
+        day_timelines = response_cache.cached_days(tconnect.email, "tconnect_ciq", _local_days(time_start, time_end, timezone_name), first_open_day,
+                                                   lambda runs: {day : timeline for run in runs for day, timeline in download_ciq_run(tconnect, *run).items()})
 
-    readingData = csvdata["readingData"]
-    iobData = csvdata["iobData"]
-    csvBasalData = csvdata["basalData"]
-    bolusData = csvdata["bolusData"]
+    day_timelines = [timeline for timeline in day_timelines if timeline is not None]
+    if len(day_timelines) == 0:
+        return None
 
-    if readingData and len(readingData) > 0:
-        lastReading = readingData[-1]['EventDateTime'] if 'EventDateTime' in readingData[-1] else 0
-        lastReading = TConnectEntry._datetime_parse(lastReading)
+    return _merge_ciq(day_timelines)
 
-        print("Last CGM reading from t:connect: %s (%s)" % (lastReading, timeago(lastReading)))
-    else:
-        logger.warning("No last CGM reading is able to be determined")
+def download_tconnect_csv_data(tconnect, time_start : arrow.Arrow, time_end : arrow.Arrow, timezone_name : str) -> typing.Dict[str, typing.Any]:
+    print("Downloading t:connect CSV data")
+    _ws2(tconnect).MAX_RETRIES = 0 # If it fails, it won't succeed again
 
-    added = 0
+    with spans.span("tconnect_csv"):
+        csvdata = download_tconnect_csv(tconnect, time_start, time_end, timezone_name)
 
-    cgmData = []
-    try:
-        cgmData = process_cgm_events(readingData)
-    except:
-        print("No Tandem CGM data avilable for Range")
-        pass
+    if csvdata is None:
+        raise ApiException(0, "No t:connect CSV data for {} - {}".format(time_start, time_end))
 
-    if BASAL in features:
-        basalEvents = process_ciq_basal_events(ciqTherapyTimelineData)
-        if csvBasalData:
-            logger.debug("CSV basal data found: processing it")
-            add_csv_basal_events(basalEvents, csvBasalData)
-        else:
-            logger.debug("No CSV basal data found")
+    return csvdata
 
-    
-    if PUMP_EVENTS in features:
-        pumpEvents = process_ciq_activity_events(ciqTherapyTimelineData)
-        logger.debug("CIQ activity events: %s" % pumpEvents)
+def _controliq(tconnect) -> ControlIQApi:
+    # The concurrent fetches share the client's ControlIQ login, only the first one logs in
+    with tconnect.login_lock:
+        return tconnect.controliq
 
-        ws2BasalSuspension = tconnect.ws2.basalsuspension(time_start, time_end)
+def _ws2(tconnect) -> WS2Api:
+    # Logs in through ControlIQ when the client has no ws2 api yet
+    with tconnect.login_lock:
+        return tconnect.ws2
 
-        bsPumpEvents = process_basalsuspension_events(ws2BasalSuspension)
-        logger.debug("basalsuspension events: %s" % bsPumpEvents)
+def tconnect_fetches(tconnect, time_start : arrow.Arrow, time_end : arrow.Arrow, timezone_name : str, plan : DownloadPlan = SYNC_PLAN) -> typing.Dict[str, typing.Callable[[], typing.Any]]:
+    fetches : typing.Dict[str, typing.Callable[[], typing.Any]] = {}
+    sources = plan.sources()
 
-        pumpEvents += bsPumpEvents
+    if "tconnect_ciq" in sources:
+        fetches["tconnect_ciq"] = lambda: download_ciq_therapy_timeline(tconnect, time_start, time_end, timezone_name)
 
+    if "tconnect_csv" in sources:
+        fetches["tconnect_csv"] = lambda: download_tconnect_csv_data(tconnect, time_start, time_end, timezone_name)
 
-    if BOLUS in features:
-        bolusEvents = handle_bolus_data(bolusData)
+    return fetches
 
-    if len(iobData) > 0:
-        iobEvents = process_iob_events(iobData)
+def parse_tconnect_data(results : typing.Dict[str, concurrent_fetch.FetchResult], timezone_name : str, plan : DownloadPlan = SYNC_PLAN):
+    # Sources which failed to download are treated as empty, streams left out of the plan are empty
+    ciqTherapyTimelineData = results["tconnect_ciq"].value if "tconnect_ciq" in results else None
+    csvdata = (results["tconnect_csv"].value if "tconnect_csv" in results else None) or {}
 
+    readingData = csvdata.get("readingData") or []
+    iobData = csvdata.get("iobData") or []
+    csvBasalData = csvdata.get("basalData") or []
+    bolusData = csvdata.get("bolusData") or []
 
-    return {DataType.CGM : cgmData, DataType.BOLUS : custom_bolus_parse(bolusData), DataType.BASEL : basalEvents, DataType.IOB : iobData}
+    cgmData = parse_tandem_readings([], timezone_name)
+    if Stream.TANDEM_CGM in plan.streams:
+        with spans.span("tconnect_parse"):
+            try:
+                cgmData = parse_tandem_readings(readingData, timezone_name)
+            except:
+                print("No Tandem CGM data avilable for Range")
+                pass
 
+        if len(cgmData[DataType.TIME]) > 0:
+            lastReading = merge_engine.from_epoch_seconds(cgmData[DataType.TIME][-1], timezone_name)
 
-# Currently assuming this works 100% of the time
-def refresh_dex_access_code(user : User) -> typing.Optional[str]:
+            print("Last CGM reading from t:connect: %s (%s)" % (lastReading, timeago(lastReading)))
+        else:
+            logger.warning("No last CGM reading is able to be determined")
 
-    conn = http.client.HTTPSConnection("api.dexcom.com")
+    basalEvents = []
+    if Stream.BASAL in plan.streams:
+        basalEvents = process_ciq_basal_events(ciqTherapyTimelineData)
+        if csvBasalData:
+            logger.debug("CSV basal data found: processing it")
+            add_csv_basal_events(basalEvents, csvBasalData)
+        else:
+            logger.debug("No CSV basal data found")
 
-    payload = "client_secret={}&client_id={}&refresh_token={}&grant_type=refresh_token&redirect_uri={}".format(dex_client_secret, dex_client_id, user.dexcom_refresh_token, "diabetes-dose://oauth-callback/dexcom")
+    with spans.span("tconnect_parse"):
+        return {
+            DataType.CGM : cgmData,
+            DataType.BOLUS : custom_bolus_parse(bolusData if Stream.BOLUS in plan.streams else [], timezone_name),
+            DataType.BASEL : parse_basal_events(basalEvents, timezone_name),
+            DataType.IOB : parse_tandem_iob(iobData if Stream.IOB in plan.streams else [], timezone_name)
+        }
 
-    headers = {
-        'content-type': "application/x-www-form-urlencoded",
-        'cache-control': "no-cache"
+def download_tconnect_data(tconnect, time_start : arrow.Arrow, time_end : arrow.Arrow, timezone_name : str, plan : DownloadPlan = SYNC_PLAN):
+    results = concurrent_fetch.fetch_concurrently(tconnect_fetches(tconnect, time_start, time_end, timezone_name, plan), FETCH_TIMEOUTS)
+    return parse_tconnect_data(results, timezone_name, plan)
+
+def download_all_data(user : User, tconnect, time_start : arrow.Arrow, time_end : arrow.Arrow, plan : DownloadPlan = SYNC_PLAN) -> typing.Tuple[typing.Dict[DataType, typing.Any], typing.Optional[typing.Dict[DataType, np.ndarray]], typing.List[str]]:
+    """
+    Downloads the sources of the plan's streams for the window concurrently.
+    Returns (tandem events, dexcom events, names of the failed sources) within the window, failed sources are left out of the events.
+    Local times are read in user.current_user_timezone.
+    """
+    fetches = tconnect_fetches(tconnect, time_start, time_end, user.current_user_timezone, plan)
+    if Stream.DEXCOM_CGM in plan.streams:
+        fetches["dexcom"] = lambda: download_dexcom_data(user, time_start, time_end)
+
+    results = concurrent_fetch.fetch_concurrently(fetches, FETCH_TIMEOUTS)
+    failed_sources = [name for name, result in results.items() if not result.ok]
+
+    dexcom_data = results["dexcom"].value if "dexcom" in results else None
+    return clip_to_window(parse_tconnect_data(results, user.current_user_timezone, plan), dexcom_data, time_start, time_end) + (failed_sources,)
+
+def _take_columns(columns : typing.Dict[DataType, np.ndarray], keep : np.ndarray) -> typing.Dict[DataType, np.ndarray]:
+    return {data_type : values[keep] for data_type, values in columns.items()}
+
+def clip_to_window(tandem_events : typing.Dict[DataType, typing.Any], dexcom_data : typing.Optional[typing.Dict[DataType, np.ndarray]],
+                   time_start : arrow.Arrow, time_end : arrow.Arrow) -> typing.Tuple[typing.Dict[DataType, typing.Any], typing.Optional[typing.Dict[DataType, np.ndarray]]]:
+    """
+    Events within [time_start, time_end). t:connect and the response cache return whole local days, the
+    events outside of the window would be merged again by every chunk of a sync. The basal segment
+    running at time_start is kept.
+    """
+    start_seconds = int(time_start.timestamp())
+    end_seconds = int(time_end.timestamp())
+
+    def in_window(times : np.ndarray) -> np.ndarray:
+        return (times >= start_seconds) & (times < end_seconds)
+
+    basal = tandem_events[DataType.BASEL]
+    basal_times = basal[DataType.TIME]
+    keep_basal = in_window(basal_times)
+    earlier_basal_times = basal_times[basal_times < start_seconds]
+    if earlier_basal_times.size > 0:
+        keep_basal |= basal_times == earlier_basal_times.max()
+
+    clipped_tandem_events = {
+        DataType.CGM : _take_columns(tandem_events[DataType.CGM], in_window(tandem_events[DataType.CGM][DataType.TIME])),
+        DataType.BOLUS : [bolus_dict for bolus_dict in tandem_events[DataType.BOLUS] if start_seconds <= bolus_dict["completion_time"] < end_seconds],
+        DataType.BASEL : _take_columns(basal, keep_basal),
+        DataType.IOB : _take_columns(tandem_events[DataType.IOB], in_window(tandem_events[DataType.IOB][DataType.TIME]))
     }
 
-    conn.request("POST", "/v2/oauth2/token", payload, headers)
-
-    res = conn.getresponse()
-
-    if res.status == 400:
-        # Refresh code is no longer valid
-        return None
-
-    data = res.read()
+    if dexcom_data is not None:
+        dexcom_data = _take_columns(dexcom_data, in_window(dexcom_data[DataType.TIME]))
 
-    response_str = data.decode("utf-8")
-    response_dict = json.loads(response_str)
+    return clipped_tandem_events, dexcom_data
 
-    access_token = response_dict.get("access_token", user.dexcom_access_token)
-    refresh_token = response_dict.get("refresh_token", user.dexcom_refresh_token)
-    user.dexcom_access_token = access_token
-    user.dexcom_refresh_token = refresh_token
-    user.save()
 
-    return access_token
+def refresh_dex_access_code(user : User) -> typing.Optional[str]:
+    return dexcom_client.refresh_access_token(user)
 
-def download_dexcom_data(user : User, time_start : arrow.Arrow, time_end: arrow.Arrow) -> typing.Optional[typing.Dict[arrow.Arrow, typing.Dict[DataType, typing.Any]]]:
+def dexcom_windows(time_start : arrow.Arrow, time_end : arrow.Arrow, window : datetime.timedelta = DEXCOM_EGV_WINDOW) -> typing.List[typing.Tuple[arrow.Arrow, arrow.Arrow]]:
+    windows = []
+    window_start = time_start
+    while window_start < time_end:
+        window_end = min(window_start + window, time_end)
+        windows.append((window_start, window_end))
+        window_start = window_end
 
-    access_token = user.dexcom_access_token
-    if user.dexcom_access_token is None:
-        access_token = refresh_dex_access_code(user)
+    return windows
 
-    conn = http.client.HTTPSConnection("api.dexcom.com")
+def new_egv_columns() -> typing.Dict[str, typing.List[typing.Any]]:
+    return {field : [] for field in EGV_FIELDS}
 
-    headers = {
-        'authorization': "Bearer {}".format(access_token)
-    }
+def _egv_day(egv : typing.Dict[str, typing.Any]) -> typing.Optional[datetime.date]:
+    egv_time = egv.get("systemTime") or egv.get("displayTime")
+    try:
+        return datetime.date.fromisoformat(egv_time[:10])
+    except (TypeError, ValueError):
+        return None
 
+def download_dexcom_egvs(user : User, time_start : arrow.Arrow, time_end : arrow.Arrow) -> typing.Optional[typing.Dict[datetime.date, typing.Dict[str, typing.List[typing.Any]]]]:
+    """
+    EGV fields of one window by UTC day, None if the user has no valid Dexcom token.
+    Records are decoded one at a time as the response is received, readings on the
+    end of the window are left to the next one.
+    """
     start_date_str = time_start.isoformat(timespec='seconds').replace('+00:00', '')
     end_date_str = time_end.isoformat(timespec='seconds').replace('+00:00', '')
 
-    print(time_start.isoformat())
-
     url_path = "/v2/users/self/egvs?startDate={}&endDate={}".format(start_date_str, end_date_str)
 
-    conn.request("GET", url_path, headers=headers)
-    res = conn.getresponse()
+    days = response_cache.day_range(time_start.date(), time_end.shift(seconds=-1).date())
+    day_columns = {day : new_egv_columns() for day in days}
 
-    if res.status == 401:
-        # 401, access token expired
-        access_token = refresh_dex_access_code(user)
-        if access_token is None:
-            print("Refresh token is invalid, could not get new access token")
-            return None
-        headers = {
-            'authorization': "Bearer {}".format(access_token)
-        }
-        conn = http.client.HTTPSConnection("api.dexcom.com")
-        conn.request("GET", url_path, headers=headers)
-        res = conn.getresponse()
-
-        if res.status == 401:
-            # Failed a second time
+    with spans.span("dexcom_fetch"), dexcom_client.stream_get(user, url_path) as (status, response):
+        if status == 401:
+            # Failed after refreshing the access token
             return None
 
-    data = res.read()
-
-    response_str = data.decode("utf-8")
-    response_dict = json.loads(response_str)
+        if status != 200:
+            raise dexcom_client.DexcomApiError(status, response.read().decode("utf-8", errors="replace"))
+
+        for egv in json_stream.iter_array_items(response, "egvs"):
+            columns = day_columns.get(_egv_day(egv))
+            if columns is None:
+                continue
+
+            for field in EGV_FIELDS:
+                columns[field].append(egv.get(field))
+
+    return day_columns
+
+def download_dexcom_runs(user : User, runs : typing.List[typing.Tuple[datetime.date, datetime.date]]) -> typing.Optional[typing.Dict[datetime.date, typing.Dict[str, typing.List[typing.Any]]]]:
+    """
+    EGV fields of every UTC day in the runs, downloaded in DEXCOM_EGV_WINDOW long windows, DEXCOM_CONCURRENCY at a time.
+    Failed windows are retried, the download fails if a window still fails after DEXCOM_WINDOW_ATTEMPTS.
+    None if the user has no valid Dexcom token.
+    """
+    now = arrow.utcnow()
+    windows = [
+        window
+        for first_day, last_day in runs
+        for window in dexcom_windows(arrow.get(first_day), min(arrow.get(last_day + datetime.timedelta(days=1)), now))
+    ]
+    day_columns : typing.Dict[datetime.date, typing.Dict[str, typing.List[typing.Any]]] = {}
+
+    pending = list(range(len(windows)))
+    for attempt in range(DEXCOM_WINDOW_ATTEMPTS):
+        if attempt > 0:
+            print("Retrying {} Dexcom windows".format(len(pending)))
+            time.sleep(attempt)
+
+        fetches = {
+            "dexcom {}".format(windows[window_idx][0].isoformat()) : functools.partial(download_dexcom_egvs, user, *windows[window_idx])
+            for window_idx in pending
+        }
+        results = concurrent_fetch.fetch_concurrently(fetches, {name : DEXCOM_WINDOW_TIMEOUT for name in fetches}, executor=_dexcom_executor)
+
+        failed = []
+        for window_idx, result in zip(pending, results.values()):
+            if not result.ok:
+                failed.append(window_idx)
+                error = result.error
+            elif result.value is None:
+                return None
+            else:
+                day_columns.update(result.value)
+
+        pending = failed
+        if len(pending) == 0:
+            break
+
+    if len(pending) > 0:
+        raise error
+
+    return day_columns
+
+def download_dexcom_data(user : User, time_start : arrow.Arrow, time_end: arrow.Arrow) -> typing.Optional[typing.Dict[DataType, np.ndarray]]:
+    """
+    EGVs of the window, closed UTC days are read from the response cache. None if the user has no valid Dexcom token.
+    """
+    print(time_start.isoformat())
 
-    evgs = response_dict.get("egvs", [])
+    utc_start = time_start.to("UTC")
+    utc_end = time_end.to("UTC")
+    days = response_cache.day_range(utc_start.date(), utc_end.date())
 
-    return_dict : typing.Dict[arrow.Arrow, typing.Dict[DataType, typing.Any]] = {}
+    unauthorized = False
 
-    for data_dict in evgs:
-        system_time = data_dict.get("displayTime")
-        if system_time is None:
-            continue
-        
-        time = arrow.get(system_time, tzinfo=TIMEZONE_NAME)
+    def download(runs):
+        nonlocal unauthorized
+        day_egvs = download_dexcom_runs(user, runs)
+        if day_egvs is None:
+            unauthorized = True
+            return {}
+        return day_egvs
 
-        bg = data_dict.get("value")
-        trend_rate = data_dict.get("trendRate")
-        trend = data_dict.get("trend")
+    day_columns = response_cache.cached_days(user.uuid, "dexcom_egvs", days, response_cache.first_open_day(arrow.utcnow()), download)
+    if unauthorized:
+        return None
 
-        type_dict = {DataType.CGM : bg, DataType.TREND : trend, DataType.TREND_RATE : trend_rate}
-        return_dict[time] = type_dict
+    # Days are cached whole, only the readings of the window are returned
+    start_str = utc_start.isoformat(timespec='seconds').replace('+00:00', '')
+    end_str = utc_end.isoformat(timespec='seconds').replace('+00:00', '')
+
+    with spans.span("dexcom_parse"):
+        columns = new_egv_columns()
+        for day_column in day_columns:
+            for egv_idx, (system_time, display_time) in enumerate(zip(day_column["systemTime"], day_column["displayTime"])):
+                if start_str <= (system_time or display_time or "") <= end_str:
+                    for field in EGV_FIELDS:
+                        columns[field].append(day_column[field][egv_idx])
+
+        return parse_dexcom_columns(columns, user.current_user_timezone)
+
+def parse_dexcom_columns(columns : typing.Dict[str, typing.List[typing.Any]], timezone_name : str) -> typing.Dict[DataType, np.ndarray]:
+    # EGV fields as typed columns, readings without a display time are skipped
+    display_times = np.array(columns["displayTime"], dtype=object)
+    has_time = np.array([display_time is not None for display_time in display_times], dtype=bool)
+
+    return {
+        DataType.TIME : timestamps.parse_local_timestamps(display_times[has_time], timezone_name),
+        DataType.CGM : merge_engine.optional_floats(np.array(columns["value"], dtype=object)[has_time]),
+        DataType.TREND : np.array(columns["trend"], dtype=object)[has_time],
+        DataType.TREND_RATE : merge_engine.optional_floats(np.array(columns["trendRate"], dtype=object)[has_time])
+    }
 
-    return return_dict
+def parse_dexcom_egvs(evgs : typing.List[typing.Dict[str, typing.Any]], timezone_name : str) -> typing.Dict[DataType, np.ndarray]:
+    # EGV records as columns, readings without a display time are skipped
+    return parse_dexcom_columns({field : [data_dict.get(field) for data_dict in evgs] for field in EGV_FIELDS}, timezone_name)
@@ -0,0 +1,350 @@
+"""
+Local stand-in for the Dexcom and t:connect services, to load test the sync path offline.
+
+Serves the endpoints the sync path uses from one host: the Dexcom token and EGV endpoints, the
+t:connect login, the ControlIQ therapy timeline and the ws2 CSV and basalsuspension exports.
+Data is synthetic and generated per day, so any split of a window returns the same records.
+Latency, error rates and record sizes are configurable.
+
+In record mode requests are proxied to the live services and every response is saved as a fixture,
+replay mode serves the saved fixtures. Point settings.UPSTREAM_BASE_URL at the server to use it.
+"""
+
+import base64
+import csv
+import datetime
+import functools
+import hashlib
+import http.client
+import http.server
+import io
+import json
+import pathlib
+import random
+import threading
+import time
+import typing
+import urllib.parse
+import uuid
+
+from . import synthetic_data
+
+import logging
+logger = logging.getLogger('dose-logger')
+
+# Live hosts of the proxied paths in record mode, by path prefix
+LIVE_HOSTS = [
+    ("/v2/", "api.dexcom.com"),
+    ("/tconnect/", "tdcservices.tandemdiabetes.com"),
+    ("/therapytimeline2csv/", "tconnectws2.tandemdiabetes.com"),
+    ("/basalsuspension/", "tconnectws2.tandemdiabetes.com"),
+    ("/", "tconnect.tandemdiabetes.com")
+]
+
+# Response headers kept in fixtures and passed through by the proxy
+KEPT_HEADERS = ("Content-Type", "Location", "Set-Cookie")
+
+USER_GUID = "00000000-0000-0000-0000-000000000000"
+TOKEN_EXPIRES_IN = 2 * 60 * 60
+
+TCONNECT_DATE_FORMAT = "%m-%d-%Y"
+
+LOGIN_PAGE = """<html><body><form method="post" action="login.aspx?ReturnUrl=%2f">
+<input type="hidden" id="__VIEWSTATE" value="fake" />
+<input type="hidden" id="__VIEWSTATEGENERATOR" value="fake" />
+<input type="hidden" id="__EVENTVALIDATION" value="fake" />
+</form></body></html>"""
+
+
+class FakeUpstreamConfig(typing.NamedTuple):
+    latency_ms : float = 0
+    jitter_ms : float = 0
+    # Chance of a data request answering a 500
+    error_rate : float = 0
+    # ws2 CSV exports of more days answer a 500, like the live export does for long ranges
+    csv_max_days : typing.Optional[int] = None
+    # Bytes of filler added to every record
+    record_padding : int = 0
+    seed : int = 0
+    record_dir : typing.Optional[pathlib.Path] = None
+    replay_dir : typing.Optional[pathlib.Path] = None
+
+
+class Response(typing.NamedTuple):
+    status : int
+    headers : typing.List[typing.Tuple[str, str]]
+    body : bytes
+
+
+def _json_response(payload : typing.Any, status : int = 200) -> Response:
+    return Response(status, [("Content-Type", "application/json")], json.dumps(payload).encode("utf-8"))
+
+def _text_response(text : str, status : int = 200, content_type : str = "text/plain") -> Response:
+    return Response(status, [("Content-Type", content_type)], text.encode("utf-8"))
+
+
+@functools.lru_cache(maxsize=4096)
+def _day_config(day : datetime.date, seed : int) -> synthetic_data.SyntheticConfig:
+    return synthetic_data.SyntheticConfig(days=1, start=datetime.datetime(day.year, day.month, day.day), seed=seed * 100000 + day.toordinal())
+
+def _days(first_day : datetime.date, last_day : datetime.date) -> typing.List[datetime.date]:
+    return [first_day + datetime.timedelta(days=day_offset) for day_offset in range((last_day - first_day).days + 1)]
+
+def _padded(records : typing.List[typing.Dict[str, typing.Any]], padding : int) -> typing.List[typing.Dict[str, typing.Any]]:
+    if padding <= 0:
+        return records
+
+    filler = "x" * padding
+    return [{**record, "padding": filler} for record in records]
+
+@functools.lru_cache(maxsize=1024)
+def _day_egvs(day : datetime.date, seed : int, padding : int) -> typing.List[typing.Dict[str, typing.Any]]:
+    return _padded(synthetic_data.dexcom_egvs(_day_config(day, seed)), padding)
+
+@functools.lru_cache(maxsize=1024)
+def _day_csv(day : datetime.date, seed : int, padding : int) -> typing.Dict[str, typing.List[typing.Dict[str, str]]]:
+    config = _day_config(day, seed)
+    # The export tells sections apart by the first column of their first row
+    return {
+        "readingData": _padded([{"DeviceType": "t:slim X2 Insulin Pump", **row} for row in synthetic_data.tandem_reading_data(config)], padding),
+        "iobData": _padded([{"Type": "IOB", **row} for row in synthetic_data.tandem_iob_data(config)], padding),
+        "bolusData": _padded([{"Type": "Bolus", **row} for row in synthetic_data.tandem_bolus_data(config)], padding)
+    }
+
+@functools.lru_cache(maxsize=1024)
+def _day_ciq(day : datetime.date, seed : int, padding : int) -> typing.Dict[str, typing.Any]:
+    timeline = synthetic_data.ciq_therapy_timeline(_day_config(day, seed))
+    timeline["basal"] = {key : _padded(events, padding) for key, events in timeline["basal"].items()}
+    return timeline
+
+def _csv_text(sections : typing.List[typing.List[typing.Dict[str, str]]]) -> str:
+    # ws2 format, sections of a header row and data rows separated by empty lines
+    output = io.StringIO()
+    for rows in sections:
+        if len(rows) == 0:
+            continue
+
+        writer = csv.DictWriter(output, fieldnames=list(rows[0].keys()), lineterminator="\n")
+        writer.writeheader()
+        writer.writerows(rows)
+        output.write("\n")
+
+    return output.getvalue()
+
+
+class SyntheticUpstream:
+    """
+    Answers the upstream requests with synthetic data.
+    """
+
+    def __init__(self, config : FakeUpstreamConfig):
+        self.config = config
+        self._rng = random.Random(config.seed)
+        self._rng_lock = threading.Lock()
+
+    def _fails(self) -> bool:
+        with self._rng_lock:
+            return self._rng.random() < self.config.error_rate
+
+    def handle(self, method : str, path : str, query : typing.Dict[str, str], headers : typing.Mapping[str, str], body : bytes) -> Response:
+        segments = [segment for segment in path.split("/") if segment != ""]
+
+        if path == "/v2/oauth2/token" and method == "POST":
+            return _json_response({
+                "access_token": "fake-access-{}".format(uuid.uuid4().hex),
+                "refresh_token": "fake-refresh-{}".format(uuid.uuid4().hex),
+                "expires_in": TOKEN_EXPIRES_IN,
+                "token_type": "Bearer"
+            })
+
+        if path == "/login.aspx":
+            return self._login(method)
+
+        if path == "/v2/users/self/egvs":
+            if not headers.get("authorization", "").startswith("Bearer "):
+                return _json_response({"error": "unauthorized"}, 401)
+            return self._data(lambda: self._egvs(query["startDate"], query["endDate"]))
+
+        if path.startswith("/tconnect/controliq/api/therapytimeline/users/"):
+            return self._data(lambda: self._ciq(query["startDate"], query["endDate"]))
+
+        if len(segments) == 4 and segments[0] == "therapytimeline2csv":
+            return self._data(lambda: self._csv(segments[2], segments[3]))
+
+        if len(segments) >= 4 and segments[0] == "basalsuspension":
+            return self._data(lambda: _text_response("{}({})".format(query.get("callback", "cb"), json.dumps({"BasalSuspension": []})), content_type="application/javascript"))
+
+        if method == "POST":
+            # Redirect target of the login, sets the session cookies
+            return _text_response("<html></html>", content_type="text/html")
+
+        return _text_response("Not found", 404)
+
+    def _data(self, respond : typing.Callable[[], Response]) -> Response:
+        if self._fails():
+            return _text_response("Injected error", 500)
+        return respond()
+
+    def _login(self, method : str) -> Response:
+        if method == "GET":
+            return _text_response(LOGIN_PAGE, content_type="text/html")
+
+        expires_at = (datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=TOKEN_EXPIRES_IN)).isoformat(timespec="seconds")
+        return Response(302, [
+            ("Location", "/"),
+            ("Set-Cookie", "UserGUID={}; Path=/".format(USER_GUID)),
+            ("Set-Cookie", "accessToken=fake-{}; Path=/".format(uuid.uuid4().hex)),
+            ("Set-Cookie", "accessTokenExpiresAt={}; Path=/".format(expires_at))
+        ], b"")
+
+    def _egvs(self, start_date : str, end_date : str) -> Response:
+        first_day = datetime.date.fromisoformat(start_date[:10])
+        last_day = datetime.date.fromisoformat(end_date[:10])
+        egvs = [
+            egv for day in _days(first_day, last_day)
+            for egv in _day_egvs(day, self.config.seed, self.config.record_padding)
+            if start_date <= egv["systemTime"] <= end_date
+        ]
+        return _json_response({"unit": "mg/dL", "rateUnit": "mg/dL/min", "egvs": egvs})
+
+    def _ciq(self, start_date : str, end_date : str) -> Response:
+        days = _days(datetime.datetime.strptime(start_date, TCONNECT_DATE_FORMAT).date(), datetime.datetime.strptime(end_date, TCONNECT_DATE_FORMAT).date())
+        day_timelines = [_day_ciq(day, self.config.seed, self.config.record_padding) for day in days]
+        return _json_response({
+            "suspensionDeliveryEvents": [],
+            "basal": {
+                key : [event for timeline in day_timelines for event in timeline["basal"][key]]
+                for key in ("tempDeliveryEvents", "algorithmDeliveryEvents", "profileDeliveryEvents")
+            }
+        })
+
+    def _csv(self, start_date : str, end_date : str) -> Response:
+        days = _days(datetime.datetime.strptime(start_date, TCONNECT_DATE_FORMAT).date(), datetime.datetime.strptime(end_date, TCONNECT_DATE_FORMAT).date())
+        if self.config.csv_max_days is not None and len(days) > self.config.csv_max_days:
+            return _text_response("Range of {} days is too large".format(len(days)), 500)
+
+        day_csvs = [_day_csv(day, self.config.seed, self.config.record_padding) for day in days]
+        return _text_response(_csv_text([
+            [row for day_csv in day_csvs for row in day_csv[section]]
+            for section in ("readingData", "iobData", "bolusData")
+        ]), content_type="text/csv")
+
+
+class FixtureStore:
+    """
+    Responses saved by record mode, one JSON file per method, path and query.
+    """
+
+    def __init__(self, directory : pathlib.Path):
+        self.directory = directory
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    def _path(self, method : str, target : str) -> pathlib.Path:
+        return self.directory / "{}.json".format(hashlib.sha256("{} {}".format(method, target).encode("utf-8")).hexdigest()[:32])
+
+    def save(self, method : str, target : str, response : Response):
+        fixture = {
+            "method": method,
+            "target": target,
+            "status": response.status,
+            "headers": response.headers,
+            "body": base64.b64encode(response.body).decode("ascii")
+        }
+        with open(self._path(method, target), "w") as fixture_file:
+            json.dump(fixture, fixture_file, indent=2)
+
+    def load(self, method : str, target : str) -> typing.Optional[Response]:
+        try:
+            with open(self._path(method, target)) as fixture_file:
+                fixture = json.load(fixture_file)
+        except FileNotFoundError:
+            return None
+
+        return Response(fixture["status"], [tuple(header) for header in fixture["headers"]], base64.b64decode(fixture["body"]))
+
+
+def _live_host(path : str) -> str:
+    return next(host for prefix, host in LIVE_HOSTS if path.startswith(prefix))
+
+def proxy(method : str, target : str, headers : typing.Mapping[str, str], body : bytes) -> Response:
+    """
+    Forwards the request to the live service of its path.
+    """
+    path = urllib.parse.urlsplit(target).path
+    host = _live_host(path)
+
+    forwarded_headers = {name : value for name, value in headers.items() if name.lower() not in ("host", "accept-encoding", "connection")}
+    forwarded_headers["Host"] = host
+
+    conn = http.client.HTTPSConnection(host, timeout=300)
+    try:
+        conn.request(method, target, body or None, forwarded_headers)
+        response = conn.getresponse()
+        response_body = response.read()
+        response_headers = [(name, value) for name, value in response.getheaders() if name in KEPT_HEADERS]
+    finally:
+        conn.close()
+
+    # Redirects to the live hosts stay on this server
+    for _, live_host in LIVE_HOSTS:
+        response_headers = [(name, value.replace("https://{}".format(live_host), "") if name == "Location" else value) for name, value in response_headers]
+
+    return Response(response.status, response_headers, response_body)
+
+
+class FakeUpstreamHandler(http.server.BaseHTTPRequestHandler):
+    # Keep-alive, like the live services
+    protocol_version = "HTTP/1.1"
+
+    config : FakeUpstreamConfig = FakeUpstreamConfig()
+    upstream : SyntheticUpstream = SyntheticUpstream(config)
+    fixtures : typing.Optional[FixtureStore] = None
+
+    def do_GET(self):
+        self._respond("GET")
+
+    def do_POST(self):
+        self._respond("POST")
+
+    def _respond(self, method : str):
+        body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        url = urllib.parse.urlsplit(self.path)
+        query = dict(urllib.parse.parse_qsl(url.query))
+
+        if self.config.replay_dir is not None:
+            response = self.fixtures.load(method, self.path) or _text_response("No fixture for {} {}".format(method, self.path), 404)
+        elif self.config.record_dir is not None:
+            response = proxy(method, self.path, self.headers, body)
+            self.fixtures.save(method, self.path, response)
+        else:
+            try:
+                response = self.upstream.handle(method, url.path, query, self.headers, body)
+            except (KeyError, ValueError) as e:
+                response = _text_response("Bad request: {}".format(e), 400)
+
+        delay_ms = self.config.latency_ms + random.uniform(-self.config.jitter_ms, self.config.jitter_ms)
+        if delay_ms > 0:
+            time.sleep(delay_ms / 1000)
+
+        self.send_response(response.status)
+        for name, value in response.headers:
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(response.body)))
+        self.end_headers()
+        self.wfile.write(response.body)
+
+    def log_message(self, format, *args):
+        logger.debug("fake-upstream | " + format, *args)
+
+
+def make_server(config : FakeUpstreamConfig, host : str = "127.0.0.1", port : int = 8765) -> http.server.ThreadingHTTPServer:
+    fixture_dir = config.replay_dir or config.record_dir
+    handler = type("ConfiguredFakeUpstreamHandler", (FakeUpstreamHandler,), {
+        "config": config,
+        "upstream": SyntheticUpstream(config),
+        "fixtures": FixtureStore(fixture_dir) if fixture_dir is not None else None
+    })
+
+    server = http.server.ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
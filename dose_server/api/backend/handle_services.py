@@ -2,7 +2,6 @@
 
 
 from tconnectsync.api import TConnectApi
-from tconnectsync.secret import TIMEZONE_NAME
 
 import matplotlib.pyplot as plt
 import numpy as np
@@ -11,308 +10,245 @@ import typing
 import bisect
 import numpy as np
 
+from api import models
 from api import utility
 
 from . import download_data
-
-def minutes(timedelta_val):
-    return divmod(timedelta_val.seconds, 60)[0]
+from . import merge_engine
+from . import spans
+from .range_index import RangeIndex
+from .timeline import NO_TIME, UNKNOWN, Timeline
 
 def chunks(lst, n):
     """Yield successive n-sized chunks from lst."""
     for i in range(0, len(lst), n):
         yield lst[i:i + n]
 
-def range_containing_datetime(range_list : typing.List[typing.Tuple[arrow.Arrow]], test_datetime : arrow.Arrow, sort : bool = True) -> typing.Optional[typing.Tuple[arrow.Arrow]]:
-
-
-
-    # Sorted from oldest to newest
-    sorted_list = range_list
-    if sort:
-        sorted_list = sorted(range_list, key=lambda range_tup: range_tup[0])
-
-    low_idx = 0
-    high_idx = len(sorted_list)-1
-
-
-    while low_idx <= high_idx:
-
-        mid = low_idx + (high_idx - low_idx)//2
-
-        if test_datetime.is_between(*sorted_list[mid], bounds="[]"):
-            return (*sorted_list[mid],)
-
-        elif test_datetime > sorted_list[mid][0]:
-            low_idx = mid + 1
-
-        else:
-            high_idx = mid - 1
-
-    return None
-
-def add_ranges_for_datetimes(datetime_list : typing.List[arrow.Arrow], full_data, should_test_gaps):
-    current_cgm_ranges = sorted(list(full_data.keys()), key=lambda range_tup: range_tup[0])
-
-    sorted_list = sorted(datetime_list)
-    skipped_datetimes = []
-
-    if len(current_cgm_ranges) == 0:
-        return full_data, skipped_datetimes
-
-
+def range_containing_datetime(range_index : RangeIndex, test_datetime : arrow.Arrow) -> typing.Optional[typing.Tuple[arrow.Arrow, arrow.Arrow]]:
 
-    for current_reading_time in sorted_list:
+    range_idx = range_index.locate_one(int(test_datetime.timestamp()))
+    if range_idx is None:
+        return None
 
-        cgm_range = range_containing_datetime(current_cgm_ranges, current_reading_time)
+    tzinfo = test_datetime.tzinfo
+    return (merge_engine.from_epoch_seconds(range_index.starts[range_idx], tzinfo), merge_engine.from_epoch_seconds(range_index.ends[range_idx], tzinfo))
 
-        if cgm_range is not None:
-            # If a range already exists, don't add range
-            current_cgm_ranges.remove(cgm_range)
-            continue
+def add_ranges_for_datetimes(event_times : np.ndarray, range_index : RangeIndex) -> RangeIndex:
+    # Adds ranges for the event times before, after or in the gaps between the CGM ranges
+    range_index.fill_gaps(event_times)
+    return range_index
 
-        # Range does not exist, add
+def parse_tandem_cgm_data(range_idx : np.ndarray, cgm_values : np.ndarray, timeline : Timeline) -> Timeline:
+    # Ranges already filled with Dexcom data are ignored
+    missing_bg = range_idx >= 0
+    missing_bg[missing_bg] = np.isnan(timeline.bg[range_idx[missing_bg]])
 
-        if current_reading_time < current_cgm_ranges[0][0]:
-            # Is before start of data
-            diff = current_cgm_ranges[0][0] - current_reading_time
-            if minutes(diff) > 5:
-                # Greater than a 5 minute increment, just create a five minute increment
-                # Note: Can create gaps, make sure gap filling code is sound
-                range_end = current_reading_time.shift(minutes=5)
-            else:
-                range_end = current_cgm_ranges[0][0]
+    # Fill with the first Tandem reading of the range
+    ranges, positions = merge_engine.first_per_range(np.where(missing_bg, range_idx, -1))
+    timeline.bg[ranges] = cgm_values[positions]
 
-            full_data[(current_reading_time, range_end)] = {}
-            
-            # Update current cgm ranges
-            current_cgm_ranges = list(full_data.keys())
-            continue
+    return timeline
 
-        if current_reading_time > current_cgm_ranges[-1][1]:
-            # Is after end of data
+def load_existing_entries(user : models.User, start_seconds : int, end_seconds : int) -> typing.List[models.DiabetesEntry]:
+    """
+    Persisted entries overlapping [start_seconds, end_seconds].
+    Entries overlapping an earlier entry are left out, the merge needs non overlapping ranges.
+    """
+    entries = list(models.DiabetesEntry.objects.filter(
+        owner=user,
+        end_datetime__gt=merge_engine.from_epoch_seconds(start_seconds, "UTC").datetime,
+        start_datetime__lte=merge_engine.from_epoch_seconds(end_seconds, "UTC").datetime
+    ).order_by("start_datetime", "id"))
 
-            # Range should be 5 minutes in length, after measurment
-            # Note: Can create gaps, make sure gap filling code is sound
-            range_end = current_reading_time.shift(minutes=5)
+    if len(entries) == 0:
+        return entries
 
-            full_data[(current_reading_time, range_end)] = {}
+    starts = merge_engine.to_epoch_seconds(entry.start_datetime for entry in entries)
+    ends = merge_engine.to_epoch_seconds(entry.end_datetime for entry in entries)
 
-            # Update current cgm ranges
-            current_cgm_ranges = list(full_data.keys())
-            continue
+    prev_max_end = np.empty_like(ends)
+    prev_max_end[0] = starts[0]
+    np.maximum.accumulate(ends[:-1], out=prev_max_end[1:])
 
-        if not should_test_gaps:
-            skipped_datetimes.append(current_reading_time)
-            continue
+    return [entries[idx] for idx in np.flatnonzero(starts >= prev_max_end)]
 
-        current_cgm_ranges = sorted(list(full_data.keys()), key=lambda range_tup: range_tup[0])
-        
-        for range_idx in range(len(current_cgm_ranges)-1):
-            current_range = current_cgm_ranges[range_idx]
-            next_range = current_cgm_ranges[range_idx+1]
-            if current_reading_time.is_between(current_range[1], next_range[0]):
-                # There is a gap between the end of the current cgm data and start of the next, create
+def handle_data(tandem_events, dexcom_events, user : typing.Optional[models.User] = None) -> Timeline:
+    """
+    Merges the downloaded events into a Timeline of CGM ranges.
 
-                diff = next_range[0] - current_range[1]
-                if minutes(diff) <= 5:
-                    range_start = current_range[1]
-                    range_end = next_range[0]
+    With a user the merge is incremental: the user's persisted entries around the downloaded
+    events are merged with the new events, and only added or changed entries are returned.
+    Changed entries keep their entry id. Data already on a persisted entry is never replaced, but
+    the open range of the last reading of a previous sync is ended at the next reading.
+    """
 
-                    full_data[(range_start, range_end)] = {}
-                    # Update current cgm ranges
-                    current_cgm_ranges = sorted(list(full_data.keys()), key=lambda range_tup: range_tup[0])
-                    continue
-                
-                #Create subrange
-                start_diff = current_reading_time - current_range[1]
-                end_diff = next_range[0] - current_reading_time
-
-                diff_list = [5 - minutes(start_diff), 5 - minutes(end_diff)]
-                diff_list = [i for i in diff_list if i >= 0]
-                
-                try:
-                    min_value = min(diff_list)
-                    if min_value == minutes(start_diff):
-                        # First interval is valid
-                        range_start = current_range[1]
-                        range_end = current_reading_time
-                    else:
-                        # Second interval is valid
-                        range_start = current_reading_time
-                        range_end = next_range[0]
-
-                    full_data[(range_start, range_end)] = {}
-                    # Update current cgm ranges
-                    current_cgm_ranges = sorted(list(full_data.keys()), key=lambda range_tup: range_tup[0])
-                    continue
-
-                except ValueError:
-                    # No interval on either side exists which is less than or equal to 5 minutes 
-                    pass
-
-                # Create 5 minute interval manually
-                range_end = current_reading_time.shift(minutes=5)
-
-                full_data[(current_reading_time, range_end)] = {}
-                # Update current cgm ranges
-                current_cgm_ranges = sorted(list(full_data.keys()), key=lambda range_tup: range_tup[0])
-                continue
-
-    return full_data,skipped_datetimes
-
-def parse_tandem_cgm_data(tandem_events, full_data):
-    current_cgm_ranges = sorted(list(full_data.keys()), key=lambda range_tup: range_tup[0])
+    print("Starting to Handle Data")
 
+    # Tandem CGM
     cgm_data = tandem_events[download_data.DataType.CGM]
-    for cgm_dict_idx in range(len(cgm_data)):
-        cgm_dict = cgm_data[cgm_dict_idx]
-        current_reading_time = arrow.get(cgm_dict["time"], tzinfo=TIMEZONE_NAME)
-
-        cgm_range = range_containing_datetime(current_cgm_ranges, current_reading_time)
-
-        if cgm_range is None:
-            # If a range does not exist, ignore
-            print("Ignoring CGM Range!!!!!!")
-            continue
-        
-        if full_data[cgm_range].get("bg") is not None:
-            # Already filled with Dexcom data, ignore
-            current_cgm_ranges.remove(cgm_range)
-            continue
-
-        # Add with tandem BG data
-        full_data[cgm_range]["bg"] = int(cgm_dict["bg"])
-
-    return full_data
-
-
-def handle_data(tandem_events, dexcom_events):
-
-    full_data = {}
-    print("Starting to Handle Data")
-    if dexcom_events is not None and len(dexcom_events) > 0:
+    cgm_order = np.argsort(cgm_data[download_data.DataType.TIME], kind="stable")
+    cgm_times, cgm_values = cgm_data[download_data.DataType.TIME][cgm_order], cgm_data[download_data.DataType.CGM][cgm_order]
+
+    # Tandem Bolus
+    bolus_data = tandem_events[download_data.DataType.BOLUS]
+    bolus_times = np.fromiter((bolus_dict["completion_time"] for bolus_dict in bolus_data), dtype=np.int64, count=len(bolus_data))
+    bolus_order = np.argsort(bolus_times, kind="stable")
+    bolus_data = [bolus_data[idx] for idx in bolus_order]
+    bolus_times = bolus_times[bolus_order]
+
+    # Tandem Insulin-on-Board
+    iob_data = tandem_events[download_data.DataType.IOB]
+    iob_order = np.argsort(iob_data[download_data.DataType.TIME], kind="stable")
+    iob_times, iob_values = iob_data[download_data.DataType.TIME][iob_order], iob_data[download_data.DataType.IOB][iob_order]
+
+    # Tandem Basal
+    basal_data = tandem_events[download_data.DataType.BASEL]
+    basal_order = np.argsort(basal_data[download_data.DataType.TIME], kind="stable")
+    basal_times = basal_data[download_data.DataType.TIME][basal_order]
+    basal_durations = basal_data[download_data.DataType.BASEL_DURATION][basal_order]
+    basal_ends = merge_engine.segment_ends(basal_times, basal_durations)
+
+    has_dexcom = dexcom_events is not None and len(dexcom_events[download_data.DataType.TIME]) > 0
+    if has_dexcom:
         print("Dexcom Events Exist, using them to fill")
-        dex_keys = sorted(list(dexcom_events.keys()))
-        for dex_key_idx in range(len(dex_keys)):
-            event_datetime = dex_keys[dex_key_idx]
-
-            data_dict = dexcom_events[event_datetime]
-
-            if dex_key_idx < len(dex_keys)-1:
-                next_datetime = dex_keys[dex_key_idx+1]
-                range_end = arrow.get(next_datetime, tzinfo=TIMEZONE_NAME)
-            else:
-                # If last, just advance five minutes
-                range_end = event_datetime.shift(minutes=5)
-
-
-            full_data[(event_datetime, range_end)] = {
-                "bg" : data_dict[download_data.DataType.CGM],
-                "trend" : data_dict[download_data.DataType.TREND],
-                "trend_rate" : data_dict[download_data.DataType.TREND_RATE]
-            }
+        # Of readings sharing a time, the last one is kept
+        dex_times = dexcom_events[download_data.DataType.TIME][::-1]
+        reading_times, unique_idx = np.unique(dex_times, return_index=True)
+        dex_idx = len(dex_times) - 1 - unique_idx
+        reading_values = dexcom_events[download_data.DataType.CGM][dex_idx]
+        reading_trends = dexcom_events[download_data.DataType.TREND][dex_idx]
+        reading_trend_rates = dexcom_events[download_data.DataType.TREND_RATE][dex_idx]
     else:
         print("No dexcom events exist, using tandem data to fill")
-        cgm_data = tandem_events[download_data.DataType.CGM]
-        for cgm_dict_idx in range(len(cgm_data)):
-            cgm_dict = cgm_data[cgm_dict_idx]
-            current_reading_time = arrow.get(cgm_dict["time"], tzinfo=TIMEZONE_NAME)
-            
-            if cgm_dict_idx < len(cgm_data)-1:
-                next_datetime = cgm_data[cgm_dict_idx+1]["time"]
-                range_end = arrow.get(next_datetime, tzinfo=TIMEZONE_NAME)
-            else:
-                # If last, just advance five minutes
-                range_end = current_reading_time.shift(minutes=5)
-
-            # Add with tandem BG data
-            full_data[(current_reading_time, range_end)] = {"bg" : int(cgm_dict["bg"])}
-
-
-    # Add all ranges to data
-    cgm_data = tandem_events[download_data.DataType.CGM]
-    tandem_cgm_times = []
-    for cgm_dict in cgm_data:
-        current_reading_time = arrow.get(cgm_dict["time"], tzinfo=TIMEZONE_NAME)
-        tandem_cgm_times.append(current_reading_time)
-    
-    tandem_bolus_times = []
-    for bolus_dict in tandem_events[download_data.DataType.BOLUS]:
-        comp_time = bolus_dict["completion_time"]
-        tandem_bolus_times.append(comp_time)
-
-    tandem_iob_times = []
-    for iob_dict in tandem_events[download_data.DataType.IOB]:
-        data_time = arrow.get(iob_dict["EventDateTime"], tzinfo=TIMEZONE_NAME)
-        tandem_iob_times.append(data_time)
-
-    print("Starting to add Ranges: ({}): {}".format(len(full_data),utility.utc_datetime().isoformat(timespec="seconds")))
-    # First pass, add ranges to beginning or end
-    full_data, skipped_cgm_times = add_ranges_for_datetimes(tandem_cgm_times, full_data, False)
-    full_data, skipped_bolus_times = add_ranges_for_datetimes(tandem_bolus_times, full_data, False)
-    full_data, skipped_iob_times = add_ranges_for_datetimes(tandem_iob_times, full_data, False)
-    print("Finished first pass ranges: {}".format(utility.utc_datetime().isoformat(timespec="seconds")))
-    # Second pass, add ranges to gaps
-    full_data, _ = add_ranges_for_datetimes(skipped_cgm_times, full_data, True)
-    full_data, _ = add_ranges_for_datetimes(skipped_bolus_times, full_data, True)
-    full_data, _ = add_ranges_for_datetimes(skipped_iob_times, full_data, True)
-
-    print("Ended adding Ranges: ({}): {}".format(len(full_data), utility.utc_datetime().isoformat(timespec="seconds")))
-    # Parse CGM data (First pass)
-    full_data = parse_tandem_cgm_data(tandem_events, full_data)
-    print("Finished parsing CGM data: {}".format(utility.utc_datetime().isoformat(timespec="seconds")))
-    # Parse Bolus Data
-    bolus_ranges = list(full_data.keys())
-    for bolus_dict in tandem_events[download_data.DataType.BOLUS]:
-        iob = bolus_dict["iob"]
-        insulin = float(bolus_dict["insulin"])
-        comp_time = bolus_dict["completion_time"]
-        is_manual = bolus_dict["is_manual"]
-        target_bg = float(bolus_dict["target_bg"])
-
-        bolus_range = range_containing_datetime(bolus_ranges, comp_time)
-        if bolus_range is None:
-            print("No corresponding BG found")
-            continue
-
-        bolus_ranges.remove(bolus_range)
-
-        if iob is not None:
-            full_data[bolus_range]["iob"] = [float(iob)]
-        full_data[bolus_range]["insulin"] = insulin
-        full_data[bolus_range]["completion_time"] = comp_time
-        full_data[bolus_range]["target_bg"] = target_bg
-        full_data[bolus_range]["is_manual"] = is_manual
-
-    print("Finished parsing BOLUS data: {}".format(utility.utc_datetime().isoformat(timespec="seconds")))
-    # Parse Insulin-on-Board
-    iob_ranges = list(full_data.keys())
-    iob_ranges = sorted(iob_ranges, key=lambda range_tup: range_tup[0])
-    for iob_dict in tandem_events[download_data.DataType.IOB]:
-        iob = float(iob_dict["IOB"])
-        data_time = arrow.get(iob_dict["EventDateTime"], tzinfo=TIMEZONE_NAME)
-
-        cgm_range = range_containing_datetime(iob_ranges, data_time, sort=False)
-        if cgm_range is None:
-            print("No corresponding BG found (Current IOB: {}): {}, {}".format(iob, len(iob_ranges), data_time))
-            continue
-
-        if iob == 0:
-            full_data[cgm_range]["iob"] = full_data[cgm_range].get("iob", []) + [iob]
-            continue
-
-        full_data[cgm_range]["iob"] = full_data[cgm_range].get("iob", []) + [iob]
-    print("Finished parsing IOB data: {}".format(utility.utc_datetime().isoformat(timespec="seconds")))
-    #Simplify Insulin on board data
-    # for cgm_range, data_dict in full_data.items():
-
-    #     updated_dict = data_dict
-    #     current_iob = updated_dict.get("iob")
-    #     if current_iob is not None and type(current_iob) is not float:
-    #         updated_dict["iob"] = min(updated_dict.get("iob", []))
-
-    #     full_data[cgm_range] = updated_dict
-
-    full_data = {key:value for (key,value) in full_data.items() if value != {} }
-    return full_data
+        reading_times, unique_idx = np.unique(cgm_times, return_index=True)
+        reading_values = cgm_values[unique_idx]
+
+    existing_entries : typing.List[models.DiabetesEntry] = []
+    with spans.span("load_entries"):
+        if user is not None:
+            event_times = np.concatenate((reading_times, cgm_times, bolus_times, iob_times))
+            if event_times.size > 0:
+                existing_entries = load_existing_entries(user, event_times.min(), event_times.max())
+            print("Merging into {} existing entries".format(len(existing_entries)))
+
+    with spans.span("ranges"):
+        existing_starts = merge_engine.to_epoch_seconds(entry.start_datetime for entry in existing_entries)
+        existing_ends = merge_engine.to_epoch_seconds(entry.end_datetime for entry in existing_entries)
+
+        range_index = RangeIndex(existing_starts, existing_ends)
+        # The persisted range of the last reading of a previous sync ends at the next reading
+        moved_starts = range_index.end_open_ranges(reading_times)
+        range_index.add_readings(reading_times)
+
+        range_index = add_ranges_for_datetimes(np.concatenate((cgm_times, bolus_times, iob_times)), range_index)
+    print("Built {} ranges".format(len(range_index)))
+
+    with spans.span("readings"):
+        timeline = Timeline(range_index.starts, range_index.ends)
+        range_count = len(timeline)
+
+        # Seed with the existing entries
+        existing_idx = range_index.locate(existing_starts)
+
+        timeline.entry_ids[existing_idx] = [entry.id for entry in existing_entries]
+        timeline.bg[existing_idx] = merge_engine.optional_floats(entry.blood_glucose for entry in existing_entries)
+        timeline.trend[existing_idx] = [entry.trend for entry in existing_entries]
+        timeline.trend_rate[existing_idx] = merge_engine.optional_floats(entry.trend_rate for entry in existing_entries)
+        timeline.insulin[existing_idx] = merge_engine.optional_floats(entry.dosed_insulin for entry in existing_entries)
+        timeline.target_bg[existing_idx] = merge_engine.optional_floats(entry.dose_target_bg for entry in existing_entries)
+        timeline.completion_time[existing_idx] = [int(entry.dose_completion_time.timestamp()) if entry.dose_completion_time is not None else NO_TIME for entry in existing_entries]
+        timeline.is_manual[existing_idx] = [int(entry.is_manual_bolus) if entry.is_manual_bolus is not None else UNKNOWN for entry in existing_entries]
+        timeline.basel_time[existing_idx] = [int(entry.basel_time.timestamp()) if entry.basel_time is not None else NO_TIME for entry in existing_entries]
+        timeline.basel_delivery_type[existing_idx] = [entry.basel_delivery_type for entry in existing_entries]
+        timeline.basel_duration[existing_idx] = merge_engine.optional_floats(entry.basel_duration for entry in existing_entries)
+        timeline.basel_rate[existing_idx] = merge_engine.optional_floats(entry.basel_rate for entry in existing_entries)
+
+        existing_iob_counts = np.fromiter((len(entry.insulin_on_board) for entry in existing_entries), dtype=np.int64, count=len(existing_entries))
+        existing_iob_values = np.fromiter((iob for entry in existing_entries for iob in entry.insulin_on_board), dtype=np.float64, count=existing_iob_counts.sum())
+        existing_iob_idx = np.repeat(existing_idx, existing_iob_counts)
+
+        has_bolus = timeline.has_bolus()
+        has_iob = np.zeros(range_count, dtype=bool)
+        has_iob[existing_iob_idx] = True
+        changed = np.zeros(range_count, dtype=bool)
+        changed[range_index.locate(moved_starts)] = True
+
+        # Every event stream is located in one pass over the ranges
+        stream_sizes = np.cumsum([reading_times.size, cgm_times.size, bolus_times.size])
+        reading_idx, cgm_idx, bolus_idx, iob_idx = np.split(range_index.locate(np.concatenate((reading_times, cgm_times, bolus_times, iob_times))), stream_sizes)
+
+        # Fill ranges without BG with their first reading
+        missing_bg = reading_idx >= 0
+        missing_bg[missing_bg] = np.isnan(timeline.bg[reading_idx[missing_bg]])
+        primary_ranges, primary_positions = merge_engine.first_per_range(np.where(missing_bg, reading_idx, -1))
+
+        timeline.bg[primary_ranges] = reading_values[primary_positions]
+        if has_dexcom:
+            timeline.trend[primary_ranges] = reading_trends[primary_positions]
+            timeline.trend_rate[primary_ranges] = reading_trend_rates[primary_positions]
+
+        is_primary = np.zeros(range_count, dtype=bool)
+        is_primary[primary_ranges] = True
+        changed |= is_primary
+
+    # Parse CGM data
+    with spans.span("cgm"):
+        missing_bg = np.isnan(timeline.bg)
+        timeline = parse_tandem_cgm_data(cgm_idx, cgm_values, timeline)
+        changed |= missing_bg & ~np.isnan(timeline.bg)
+
+    # Parse Bolus Data, only the first bolus of a range is kept
+    with spans.span("bolus"):
+        bolus_idx[bolus_idx >= 0] = np.where(has_bolus[bolus_idx[bolus_idx >= 0]], -1, bolus_idx[bolus_idx >= 0])
+        bolus_ranges, bolus_positions = merge_engine.first_per_range(bolus_idx)
+        skipped_bolus_count = np.count_nonzero(bolus_idx >= 0) - bolus_ranges.size
+        if skipped_bolus_count > 0:
+            print("Skipped {} boluses sharing a range".format(skipped_bolus_count))
+
+        kept_boluses = [bolus_data[idx] for idx in bolus_positions]
+
+        has_bolus[bolus_ranges] = True
+        changed[bolus_ranges] = True
+
+        timeline.insulin[bolus_ranges] = merge_engine.optional_floats(bolus_dict["insulin"] for bolus_dict in kept_boluses)
+        timeline.target_bg[bolus_ranges] = merge_engine.optional_floats(bolus_dict["target_bg"] for bolus_dict in kept_boluses)
+        timeline.completion_time[bolus_ranges] = bolus_times[bolus_positions]
+        timeline.is_manual[bolus_ranges] = [int(bolus_dict["is_manual"]) for bolus_dict in kept_boluses]
+
+        bolus_iob = merge_engine.optional_floats(bolus_dict["iob"] for bolus_dict in kept_boluses)
+
+    # Parse Insulin-on-Board, the bolus IOB comes first in a range. Ranges which already have IOB are complete
+    with spans.span("iob"):
+        bolus_iob_mask = ~np.isnan(bolus_iob)
+        new_iob_values = np.concatenate((bolus_iob[bolus_iob_mask], iob_values))
+        new_iob_idx = np.concatenate((bolus_ranges[bolus_iob_mask], iob_idx))
+
+        skipped_iob_count = np.count_nonzero(new_iob_idx < 0)
+        if skipped_iob_count > 0:
+            print("No corresponding BG found for {} IOB values".format(skipped_iob_count))
+
+        new_iob_idx[new_iob_idx >= 0] = np.where(has_iob[new_iob_idx[new_iob_idx >= 0]], -1, new_iob_idx[new_iob_idx >= 0])
+        timeline.set_iob(np.concatenate((existing_iob_idx, new_iob_idx)), np.concatenate((existing_iob_values, new_iob_values)))
+
+        added_iob = np.zeros(range_count, dtype=bool)
+        added_iob[new_iob_idx[new_iob_idx >= 0]] = True
+        changed |= added_iob
+
+    # Parse Basal Data, each range gets the latest basal segment overlapping it. Ranges which already have basal data are kept
+    with spans.span("basal"):
+        basal_idx = range_index.latest_overlapping(basal_times, basal_ends)
+        added_basal = (basal_idx >= 0) & ~timeline.has_basal()
+        basal_ranges = np.flatnonzero(added_basal)
+        basal_positions = basal_order[basal_idx[basal_ranges]]
+
+        timeline.basel_time[basal_ranges] = basal_times[basal_idx[basal_ranges]]
+        timeline.basel_delivery_type[basal_ranges] = basal_data[download_data.DataType.BASEL_DELIVERY_TYPE][basal_positions]
+        timeline.basel_duration[basal_ranges] = basal_data[download_data.DataType.BASEL_DURATION][basal_positions]
+        timeline.basel_rate[basal_ranges] = basal_data[download_data.DataType.BASEL_RATE][basal_positions]
+
+        changed |= added_basal
+
+    # Ranges without any data are dropped, existing entries are only returned when changed
+    keep = changed if user is not None else (is_primary | has_bolus | added_iob | ~np.isnan(timeline.bg))
+
+    return timeline.take(keep)
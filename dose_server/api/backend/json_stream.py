@@ -0,0 +1,109 @@
+"""
+Incremental decode of the items of an array nested in a top level JSON object, read from a binary stream.
+
+Only the unconsumed part of the current chunk and the item being decoded are held in memory,
+so large responses are decoded without reading, decoding and parsing the whole body at once.
+"""
+
+import codecs
+import json
+import re
+import typing
+
+CHUNK_SIZE = 64 * 1024
+
+_WHITESPACE = " \t\n\r"
+_decoder = json.JSONDecoder()
+# Rest of the buffer after a value which a number may continue with in the next chunk
+_NUMBER_TAIL = re.compile(r"[0-9+\-.eE]*\Z")
+
+
+class _StreamReader:
+
+    def __init__(self, stream : typing.BinaryIO, chunk_size : int):
+        self._stream = stream
+        self._chunk_size = chunk_size
+        self._text_decoder = codecs.getincrementaldecoder("utf-8")()
+        self.buffer = ""
+        self.position = 0
+        self.eof = False
+
+    def fill(self) -> bool:
+        """
+        Appends the next chunk, dropping the consumed part of the buffer. False at the end of the stream.
+        """
+        if self.eof:
+            return False
+
+        data = self._stream.read(self._chunk_size)
+        self.eof = len(data) == 0
+        self.buffer = self.buffer[self.position:] + self._text_decoder.decode(data, final=self.eof)
+        self.position = 0
+        return True
+
+    def peek(self) -> typing.Optional[str]:
+        # Next character which is not whitespace, None at the end of the stream
+        while True:
+            while self.position < len(self.buffer) and self.buffer[self.position] in _WHITESPACE:
+                self.position += 1
+
+            if self.position < len(self.buffer):
+                return self.buffer[self.position]
+
+            if not self.fill():
+                return None
+
+    def expect(self, characters : str) -> str:
+        character = self.peek()
+        if character is None or character not in characters:
+            raise ValueError("Expected one of {!r} in JSON stream, found {!r}".format(characters, character))
+
+        self.position += 1
+        return character
+
+    def decode_value(self) -> typing.Any:
+        self.peek()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.buffer, self.position)
+            except json.JSONDecodeError:
+                if self.fill():
+                    continue
+                raise
+
+            # A number at the end of the buffer may continue in the next chunk, "12" of "12.5" decodes as 12
+            if _NUMBER_TAIL.match(self.buffer, end) is not None and self.fill():
+                continue
+
+            self.position = end
+            return value
+
+
+def iter_array_items(stream : typing.BinaryIO, key : str, chunk_size : int = CHUNK_SIZE) -> typing.Iterator[typing.Any]:
+    """
+    Yields the items of the array under `key` of the top level object, nothing if the key is missing.
+    Other values of the object are decoded and discarded, the stream is not read past the array.
+    """
+    reader = _StreamReader(stream, chunk_size)
+
+    reader.expect("{")
+    if reader.peek() == "}":
+        return
+
+    while True:
+        item_key = reader.decode_value()
+        reader.expect(":")
+
+        if item_key == key:
+            reader.expect("[")
+            if reader.peek() == "]":
+                return
+
+            while True:
+                yield reader.decode_value()
+                if reader.expect(",]") == "]":
+                    return
+
+        reader.decode_value()
+        if reader.expect(",}") == "}":
+            return
@@ -0,0 +1,66 @@
+import typing
+
+import arrow
+import numpy as np
+
+
+def to_epoch_seconds(datetimes : typing.Iterable[arrow.Arrow]) -> np.ndarray:
+    return np.fromiter((int(dt.timestamp()) for dt in datetimes), dtype=np.int64)
+
+def from_epoch_seconds(seconds : int, tzinfo : typing.Any) -> arrow.Arrow:
+    return arrow.Arrow.fromtimestamp(int(seconds), tzinfo=tzinfo)
+
+def first_per_range(range_idx : np.ndarray) -> typing.Tuple[np.ndarray, np.ndarray]:
+    """
+    For events sorted by time, returns (ranges, event positions) of the first event in each range.
+    Events outside of every range (-1) are ignored.
+    """
+    valid = np.flatnonzero(range_idx >= 0)
+    ranges, first_idx = np.unique(range_idx[valid], return_index=True)
+    return ranges, valid[first_idx]
+
+def group_by_range(range_idx : np.ndarray, range_count : int) -> typing.Tuple[np.ndarray, np.ndarray]:
+    """
+    Stable grouping of events by range.
+    Returns (event order, offsets), events of range i are order[offsets[i]:offsets[i+1]].
+    """
+    valid = np.flatnonzero(range_idx >= 0)
+    order = valid[np.argsort(range_idx[valid], kind="stable")]
+    counts = np.bincount(range_idx[valid], minlength=range_count)
+    offsets = np.zeros(range_count + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    return order, offsets
+
+def summarize_groups(values : np.ndarray, offsets : np.ndarray) -> typing.Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    (last, min, max, mean) of each group of values, group i is values[offsets[i]:offsets[i+1]].
+    Empty groups are NaN.
+    """
+    group_count = offsets.size - 1
+    counts = np.diff(offsets)
+    nonempty = np.flatnonzero(counts > 0)
+
+    summaries = tuple(np.full(group_count, np.nan) for _ in range(4))
+    if nonempty.size == 0:
+        return summaries
+
+    last, minimum, maximum, mean = summaries
+    group_starts = offsets[nonempty]
+    last[nonempty] = values[offsets[nonempty + 1] - 1]
+    minimum[nonempty] = np.minimum.reduceat(values, group_starts)
+    maximum[nonempty] = np.maximum.reduceat(values, group_starts)
+    mean[nonempty] = np.add.reduceat(values, group_starts) / counts[nonempty]
+    return summaries
+
+def segment_ends(starts : np.ndarray, duration_minutes : np.ndarray) -> np.ndarray:
+    """
+    Ends of time sorted segments with a duration in minutes.
+    Segments with an unknown (NaN) duration last until the next segment starts, the last one has no length.
+    """
+    next_starts = np.append(starts[1:], starts[-1:])
+    known = ~np.isnan(duration_minutes)
+    return np.where(known, starts + np.round(np.where(known, duration_minutes, 0) * 60).astype(np.int64), next_starts)
+
+def optional_floats(values : typing.Iterable[typing.Any]) -> np.ndarray:
+    # None and '' become NaN
+    return np.fromiter((float(v) if v is not None and v != '' else np.nan for v in values), dtype=np.float64)
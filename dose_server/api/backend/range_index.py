@@ -0,0 +1,173 @@
+import typing
+
+import numpy as np
+
+# Length of a CGM range, the Dexcom / Tandem reading cadence
+RANGE_SECONDS = 5 * 60
+
+_NO_UPPER_BOUND = np.iinfo(np.int64).max
+
+
+class RangeIndex:
+    """
+    Interval index over a user's CGM ranges.
+    Ranges are half open [start, end), sorted and non overlapping, stored as epoch seconds.
+    """
+
+    def __init__(self, starts : typing.Optional[np.ndarray] = None, ends : typing.Optional[np.ndarray] = None):
+        self._starts = np.asarray(starts if starts is not None else [], dtype=np.int64)
+        self._ends = np.asarray(ends if ends is not None else [], dtype=np.int64)
+
+        if self._starts.shape != self._ends.shape:
+            raise ValueError("Range starts and ends differ in length")
+
+    @classmethod
+    def from_readings(cls, reading_times : np.ndarray) -> "RangeIndex":
+        range_index = cls()
+        range_index.add_readings(reading_times)
+        return range_index
+
+    def __len__(self) -> int:
+        return self._starts.size
+
+    @property
+    def starts(self) -> np.ndarray:
+        return self._starts
+
+    @property
+    def ends(self) -> np.ndarray:
+        return self._ends
+
+    def locate(self, times : np.ndarray) -> np.ndarray:
+        """
+        Index of the range containing each time, -1 if no range contains it.
+        """
+        times = np.asarray(times, dtype=np.int64)
+        if self._starts.size == 0:
+            return np.full(times.shape, -1, dtype=np.int64)
+
+        range_idx = np.searchsorted(self._starts, times, side="right") - 1
+        hit = (range_idx >= 0) & (times < self._ends[np.maximum(range_idx, 0)])
+        return np.where(hit, range_idx, -1)
+
+    def locate_one(self, time : int) -> typing.Optional[int]:
+        range_idx = int(self.locate(np.array([time]))[0])
+        return range_idx if range_idx >= 0 else None
+
+    def contains(self, times : np.ndarray) -> np.ndarray:
+        return self.locate(times) >= 0
+
+    def latest_overlapping(self, segment_starts : np.ndarray, segment_ends : np.ndarray) -> np.ndarray:
+        """
+        Index of the latest starting segment overlapping each range, -1 if no segment overlaps it.
+        Segments [start, end) are sorted by start and do not overlap each other,
+        a zero length segment overlaps the range containing its start.
+        """
+        segment_starts = np.asarray(segment_starts, dtype=np.int64)
+        segment_ends = np.asarray(segment_ends, dtype=np.int64)
+        if segment_starts.size == 0:
+            return np.full(self._starts.shape, -1, dtype=np.int64)
+
+        segment_idx = np.searchsorted(segment_starts, self._ends, side="left") - 1
+        clipped_idx = np.maximum(segment_idx, 0)
+        hit = (segment_idx >= 0) & ((segment_starts[clipped_idx] >= self._starts) | (segment_ends[clipped_idx] > self._starts))
+        return np.where(hit, segment_idx, -1)
+
+    def _next_starts(self, next_idx : np.ndarray) -> np.ndarray:
+        # Start of the range at each index, unbounded past the last range
+        if self._starts.size == 0:
+            return np.full(next_idx.shape, _NO_UPPER_BOUND, dtype=np.int64)
+
+        return np.where(next_idx < self._starts.size, self._starts[np.minimum(next_idx, self._starts.size - 1)], _NO_UPPER_BOUND)
+
+    def insert(self, starts : np.ndarray, ends : np.ndarray) -> None:
+        """
+        Inserts sorted ranges which do not overlap the existing ones, without re-sorting the index.
+        """
+        starts = np.asarray(starts, dtype=np.int64)
+        ends = np.asarray(ends, dtype=np.int64)
+        if starts.size == 0:
+            return
+
+        positions = np.searchsorted(self._starts, starts)
+        self._starts = np.insert(self._starts, positions, starts)
+        self._ends = np.insert(self._ends, positions, ends)
+
+    def end_open_ranges(self, reading_times : np.ndarray) -> np.ndarray:
+        """
+        Ends every open range at the first reading after its start, when that reading comes before the next range.
+        A range is open when no range starts at its end, like the five minute range given to the last reading,
+        consecutive readings delimit a range as in add_readings. Returns the starts of the ranges whose end moved.
+        """
+        reading_times = np.unique(np.asarray(reading_times, dtype=np.int64))
+        if self._starts.size == 0 or reading_times.size == 0:
+            return np.empty(0, dtype=np.int64)
+
+        next_starts = self._next_starts(np.arange(1, self._starts.size + 1))
+        open_idx = np.flatnonzero(self._ends != next_starts)
+
+        next_reading_idx = np.searchsorted(reading_times, self._starts[open_idx], side="right")
+        has_next = next_reading_idx < reading_times.size
+        open_idx = open_idx[has_next]
+        next_readings = reading_times[next_reading_idx[has_next]]
+
+        moved = (next_readings < next_starts[open_idx]) & (next_readings != self._ends[open_idx])
+        if not moved.any():
+            return np.empty(0, dtype=np.int64)
+
+        # The ends may be the caller's array
+        self._ends = self._ends.copy()
+        self._ends[open_idx[moved]] = next_readings[moved]
+        return self._starts[open_idx[moved]]
+
+    def add_readings(self, reading_times : np.ndarray) -> int:
+        """
+        Adds a range for every reading outside of the existing ranges, returns the number of ranges added.
+        Consecutive readings delimit a range, the last reading is given a five minute range,
+        ranges are clipped to the start of the next existing range.
+        """
+        reading_times = np.unique(np.asarray(reading_times, dtype=np.int64))
+        new_starts = reading_times[self.locate(reading_times) < 0]
+        if new_starts.size == 0:
+            return 0
+
+        new_ends = np.empty_like(new_starts)
+        new_ends[:-1] = new_starts[1:]
+        new_ends[-1] = new_starts[-1] + RANGE_SECONDS
+
+        next_idx = np.searchsorted(self._starts, new_starts, side="right")
+        upper_bounds = self._next_starts(next_idx)
+
+        self.insert(new_starts, np.minimum(new_ends, upper_bounds))
+        return new_starts.size
+
+    def fill_gaps(self, times : np.ndarray) -> int:
+        """
+        Adds ranges so every time in `times` is contained by a range, returns the number of ranges added.
+
+        Uncovered times are bucketed into five minute slots anchored on the end of the range
+        before them (or on the earliest uncovered time, before the start of the data). Slots
+        are clipped to the start of the next range, so a gap of five minutes or less becomes
+        a single range covering the whole gap.
+        """
+        if self._starts.size == 0 or len(times) == 0:
+            # Nothing to anchor new ranges on
+            return 0
+
+        times = np.unique(np.asarray(times, dtype=np.int64))
+        missing = times[self.locate(times) < 0]
+        if missing.size == 0:
+            return 0
+
+        prev_idx = np.searchsorted(self._starts, missing, side="right") - 1
+        next_idx = prev_idx + 1
+
+        anchors = np.where(prev_idx >= 0, self._ends[np.maximum(prev_idx, 0)], missing[0])
+        upper_bounds = self._next_starts(next_idx)
+
+        slot_starts = anchors + ((missing - anchors) // RANGE_SECONDS) * RANGE_SECONDS
+        slot_starts, first_idx = np.unique(slot_starts, return_index=True)
+        slot_ends = np.minimum(slot_starts + RANGE_SECONDS, upper_bounds[first_idx])
+
+        self.insert(slot_starts, slot_ends)
+        return slot_starts.size
@@ -0,0 +1,148 @@
+"""
+Token bucket rate limits of the upstream requests, per upstream host and per upstream account.
+
+Every Dexcom and t:connect data request takes a token from the bucket of its host and from the
+bucket of the account on that host, waiting until both have one. A 429 answer empties the host's
+bucket for its Retry-After. Buckets are per process, each sync worker gets the full limits, so the
+limits in settings.UPSTREAM_RATE_LIMITS should be divided by the number of worker processes.
+"""
+
+import collections
+import threading
+import time
+import typing
+import urllib.parse
+
+from django.conf import settings
+
+import logging
+logger = logging.getLogger('dose-logger')
+
+# (requests per second, burst) of a host without its own limit in settings.UPSTREAM_RATE_LIMITS
+DEFAULT_HOST_LIMIT = (5.0, 10)
+
+# (requests per second, burst) of each account on a host
+DEFAULT_ACCOUNT_LIMIT = (1.0, 8)
+
+# Backoff of a 429 without a Retry-After header
+DEFAULT_RETRY_AFTER_SECONDS = 30
+
+# Account buckets unused for this long are dropped
+ACCOUNT_BUCKET_IDLE_SECONDS = 15 * 60
+
+
+class TokenBucket:
+
+    def __init__(self, rate : float, burst : int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def reserve(self, now : float) -> float:
+        """
+        Takes a token, returns the seconds until it is available. Tokens are reserved
+        ahead of time, the bucket goes negative while requests wait on it.
+        """
+        self.tokens = min(self.tokens + (now - self.updated) * self.rate, self.burst)
+        self.updated = now
+
+        self.tokens -= 1
+        if self.tokens >= 0:
+            return 0.0
+        return -self.tokens / self.rate
+
+    def drain(self, now : float, seconds : float):
+        # No token is available for `seconds`
+        self.tokens = min(self.tokens + (now - self.updated) * self.rate, self.burst, 0) - seconds * self.rate
+        self.updated = now
+
+
+class RateLimiter:
+
+    def __init__(self, host_limits : typing.Optional[typing.Dict[str, typing.Tuple[float, int]]] = None, account_limit : typing.Tuple[float, int] = DEFAULT_ACCOUNT_LIMIT):
+        self.host_limits = host_limits or {}
+        self.account_limit = account_limit
+
+        self._host_buckets : typing.Dict[str, TokenBucket] = {}
+        self._account_buckets : typing.Dict[typing.Tuple[str, str], TokenBucket] = {}
+        self._lock = threading.Lock()
+
+        # Host -> counter of requests, waits, waited seconds and 429s
+        self.counts : typing.Dict[str, typing.Counter[str]] = collections.defaultdict(collections.Counter)
+
+    def acquire(self, host : str, account : typing.Any) -> float:
+        """
+        Waits for a token of the host and one of the account on it, returns the seconds waited.
+        """
+        account_key = (host, str(account))
+        now = time.monotonic()
+
+        with self._lock:
+            host_bucket = self._host_bucket(host)
+
+            account_bucket = self._account_buckets.get(account_key)
+            if account_bucket is None:
+                self._drop_idle_accounts(now)
+                account_bucket = self._account_buckets[account_key] = TokenBucket(*self.account_limit)
+
+            wait_seconds = max(host_bucket.reserve(now), account_bucket.reserve(now))
+
+            counts = self.counts[host]
+            counts["requests"] += 1
+            if wait_seconds > 0:
+                counts["waits"] += 1
+                counts["waited_seconds"] += wait_seconds
+
+        if wait_seconds > 0:
+            time.sleep(wait_seconds)
+
+        return wait_seconds
+
+    def throttled(self, host : str, retry_after : typing.Optional[typing.Any] = None):
+        """
+        Backs off the host after a 429, for its Retry-After seconds.
+        """
+        try:
+            seconds = float(retry_after) if retry_after is not None else DEFAULT_RETRY_AFTER_SECONDS
+        except ValueError:
+            # Retry-After may also be an HTTP date
+            seconds = DEFAULT_RETRY_AFTER_SECONDS
+
+        logger.warning("rate-limits | \"{} answered 429, backing off {} seconds\"".format(host, seconds))
+
+        with self._lock:
+            host_bucket = self._host_bucket(host)
+
+            host_bucket.drain(time.monotonic(), seconds)
+            self.counts[host]["throttled"] += 1
+
+    def stats(self) -> typing.Dict[str, typing.Dict[str, typing.Any]]:
+        with self._lock:
+            return {
+                host : {
+                    "requests": counts["requests"],
+                    "waits": counts["waits"],
+                    "waited_seconds": round(counts["waited_seconds"], 3),
+                    "throttled": counts["throttled"]
+                }
+                for host, counts in self.counts.items()
+            }
+
+    def _host_bucket(self, host : str) -> TokenBucket:
+        host_bucket = self._host_buckets.get(host)
+        if host_bucket is None:
+            host_bucket = self._host_buckets[host] = TokenBucket(*self.host_limits.get(host, DEFAULT_HOST_LIMIT))
+        return host_bucket
+
+    def _drop_idle_accounts(self, now : float):
+        idle_keys = [key for key, bucket in self._account_buckets.items() if now - bucket.updated > ACCOUNT_BUCKET_IDLE_SECONDS]
+        for key in idle_keys:
+            del self._account_buckets[key]
+
+
+def url_host(url : str) -> str:
+    return urllib.parse.urlsplit(url).netloc
+
+
+limiter = RateLimiter(getattr(settings, "UPSTREAM_RATE_LIMITS", None), getattr(settings, "UPSTREAM_ACCOUNT_RATE_LIMIT", None) or DEFAULT_ACCOUNT_LIMIT)
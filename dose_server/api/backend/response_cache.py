@@ -0,0 +1,242 @@
+"""
+On-disk cache of raw upstream responses, one JSON file per user, source and day.
+
+Only closed days are cached, days which ended at least settings.RESPONSE_CACHE_SETTLE ago so late uploads
+of the pump or CGM are in their response. Open days are always downloaded again. The cache is capped at settings.RESPONSE_CACHE_MAX_BYTES, reading a day marks it used and the
+least recently used days are evicted first. Without settings.RESPONSE_CACHE_DIR nothing is cached.
+The responses are personal health data, the cache directories are only accessible by their owner (0700) and its files
+are only readable by their owner (0600).
+"""
+
+import datetime
+import hashlib
+import json
+import os
+import pathlib
+import tempfile
+import threading
+import typing
+
+from django.conf import settings
+
+import logging
+logger = logging.getLogger('dose-logger')
+
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+DEFAULT_SETTLE = datetime.timedelta(hours=6)
+
+DIRECTORY_MODE = 0o700
+FILE_MODE = 0o600
+
+
+class CacheEntry(typing.NamedTuple):
+    user_key : str
+    source : str
+    day : datetime.date
+    size : int
+    last_used : float
+    path : pathlib.Path
+
+
+_lock = threading.Lock()
+# Bytes used by the cache, counted on the first write
+_total_bytes : typing.Optional[int] = None
+
+
+def cache_dir() -> typing.Optional[pathlib.Path]:
+    directory = getattr(settings, "RESPONSE_CACHE_DIR", None)
+    return pathlib.Path(directory) if directory is not None else None
+
+def max_bytes() -> int:
+    return getattr(settings, "RESPONSE_CACHE_MAX_BYTES", DEFAULT_MAX_BYTES)
+
+def first_open_day(now : typing.Any) -> datetime.date:
+    """
+    First day which is not closed, `now` is an aware datetime (or Arrow) in the time zone of the source's days.
+    """
+    return (now - getattr(settings, "RESPONSE_CACHE_SETTLE", DEFAULT_SETTLE)).date()
+
+def hashed_user_key(user_key : typing.Any) -> str:
+    # Emails and uuids are not used as file names
+    return hashlib.sha256(str(user_key).encode("utf-8")).hexdigest()[:32]
+
+def _make_private_dirs(directory : pathlib.Path):
+    # mkdir(parents=True) gives the parents the default mode, each level is created on its own
+    missing_dirs = []
+    while not directory.is_dir():
+        missing_dirs.append(directory)
+        directory = directory.parent
+
+    for missing_dir in reversed(missing_dirs):
+        try:
+            missing_dir.mkdir(mode=DIRECTORY_MODE)
+        except FileExistsError:
+            pass
+
+def _day_path(directory : pathlib.Path, user_key : typing.Any, source : str, day : datetime.date) -> pathlib.Path:
+    return directory / hashed_user_key(user_key) / source / "{}.json".format(day.isoformat())
+
+def get(user_key : typing.Any, source : str, day : datetime.date) -> typing.Optional[typing.Any]:
+    """
+    Cached response of the day, None if it is not cached.
+    """
+    directory = cache_dir()
+    if directory is None:
+        return None
+
+    path = _day_path(directory, user_key, source, day)
+    try:
+        with open(path, "rb") as cache_file:
+            payload = json.loads(cache_file.read().decode("utf-8"))
+        os.utime(path)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        logger.warning("response-cache | \"Dropping unreadable {}: {}\"".format(path, e))
+        _remove(path)
+        return None
+
+    return payload
+
+def put(user_key : typing.Any, source : str, day : datetime.date, payload : typing.Any):
+    directory = cache_dir()
+    if directory is None:
+        return
+
+    global _total_bytes
+
+    path = _day_path(directory, user_key, source, day)
+    data = json.dumps(payload, separators=(",", ":")).encode("utf-8")
+    try:
+        _make_private_dirs(path.parent)
+        previous_size = path.stat().st_size if path.exists() else 0
+
+        # Written aside and renamed, readers never see a partial file
+        file_descriptor, temp_path = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+        os.chmod(temp_path, FILE_MODE)
+        with os.fdopen(file_descriptor, "wb") as temp_file:
+            temp_file.write(data)
+        os.replace(temp_path, path)
+    except OSError as e:
+        logger.warning("response-cache | \"Could not cache {}: {}\"".format(path, e))
+        return
+
+    with _lock:
+        if _total_bytes is None:
+            _total_bytes = sum(entry.size for entry in entries())
+        else:
+            _total_bytes += len(data) - previous_size
+
+        if _total_bytes > max_bytes():
+            _total_bytes = _evict_to(max_bytes())
+
+def entries(user_key : typing.Any = None, source : typing.Optional[str] = None) -> typing.List[CacheEntry]:
+    """
+    Cached days, least recently used first. The user key of an entry is its hashed user key.
+    """
+    directory = cache_dir()
+    if directory is None or not directory.is_dir():
+        return []
+
+    user_dirs = [directory / hashed_user_key(user_key)] if user_key is not None else [path for path in directory.iterdir() if path.is_dir()]
+
+    cache_entries = []
+    for user_dir in user_dirs:
+        source_dirs = [user_dir / source] if source is not None else (list(user_dir.iterdir()) if user_dir.is_dir() else [])
+        for source_dir in source_dirs:
+            if not source_dir.is_dir():
+                continue
+
+            for path in source_dir.glob("*.json"):
+                try:
+                    day = datetime.date.fromisoformat(path.stem)
+                    stat = path.stat()
+                except (ValueError, OSError):
+                    continue
+
+                cache_entries.append(CacheEntry(user_dir.name, source_dir.name, day, stat.st_size, stat.st_mtime, path))
+
+    cache_entries.sort(key=lambda entry: entry.last_used)
+    return cache_entries
+
+def _remove(path : pathlib.Path):
+    try:
+        path.unlink()
+    except FileNotFoundError:
+        pass
+
+def _evict_to(target_bytes : int) -> int:
+    # Removes the least recently used days until the cache fits, returns the bytes left
+    cache_entries = entries()
+    total_bytes = sum(entry.size for entry in cache_entries)
+
+    evicted_count = 0
+    for entry in cache_entries:
+        if total_bytes <= target_bytes:
+            break
+
+        _remove(entry.path)
+        total_bytes -= entry.size
+        evicted_count += 1
+
+    print("Evicted {} cached days".format(evicted_count))
+    return total_bytes
+
+def purge(user_key : typing.Any = None, source : typing.Optional[str] = None, before : typing.Optional[datetime.date] = None) -> int:
+    """
+    Removes the cached days matching every given filter, returns the number removed.
+    """
+    global _total_bytes
+
+    purged_count = 0
+    for entry in entries(user_key, source):
+        if before is not None and entry.day >= before:
+            continue
+
+        _remove(entry.path)
+        purged_count += 1
+
+    with _lock:
+        _total_bytes = None
+
+    return purged_count
+
+def cached_days(user_key : typing.Any, source : str, days : typing.List[datetime.date], first_open : datetime.date,
+                download : typing.Callable[[typing.List[typing.Tuple[datetime.date, datetime.date]]], typing.Dict[datetime.date, typing.Any]]) -> typing.List[typing.Any]:
+    """
+    Responses of each day, in order. Days before first_open are read from the cache, the other days are downloaded
+    by `download`, given the inclusive (first day, last day) runs of consecutive missing days and returning
+    the response of every day in them. Downloaded days before first_open are cached.
+    """
+    day_payloads : typing.Dict[datetime.date, typing.Any] = {}
+    for day in days:
+        if day < first_open:
+            payload = get(user_key, source, day)
+            if payload is not None:
+                day_payloads[day] = payload
+
+    missing_runs : typing.List[typing.Tuple[datetime.date, datetime.date]] = []
+    for day in days:
+        if day in day_payloads:
+            continue
+
+        if len(missing_runs) > 0 and missing_runs[-1][1] + datetime.timedelta(days=1) == day:
+            missing_runs[-1] = (missing_runs[-1][0], day)
+        else:
+            missing_runs.append((day, day))
+
+    if len(day_payloads) > 0:
+        print("Using {} cached {} days".format(len(day_payloads), source))
+
+    if len(missing_runs) > 0:
+        downloaded = download(missing_runs)
+        for day, payload in downloaded.items():
+            if day < first_open and payload is not None:
+                put(user_key, source, day, payload)
+
+        day_payloads.update(downloaded)
+
+    return [day_payloads[day] for day in days if day in day_payloads]
+
+def day_range(first_day : datetime.date, last_day : datetime.date) -> typing.List[datetime.date]:
+    return [first_day + datetime.timedelta(days=day_offset) for day_offset in range((last_day - first_day).days + 1)]
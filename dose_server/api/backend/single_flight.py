@@ -0,0 +1,85 @@
+"""
+Per user coalescing of concurrent syncs within the process.
+
+The first sync of a user runs, a sync of the same user started while it is in flight attaches to it
+and shares its result when the flight covers its window and streams. Otherwise it waits for the flight
+to land and then runs, so the syncs of a user never race in save_data_to_database and User.save().
+"""
+
+import collections
+import datetime
+import threading
+import typing
+
+import arrow
+
+# A flight ending at most this long before the end of a joining sync's window still covers it
+END_TOLERANCE = datetime.timedelta(minutes=1)
+
+
+class _Flight:
+
+    def __init__(self, utc_time_start : arrow.Arrow, utc_time_end : arrow.Arrow, streams : typing.FrozenSet[typing.Any]):
+        self.utc_time_start = utc_time_start
+        self.utc_time_end = utc_time_end
+        self.streams = streams
+
+        self.landed = threading.Event()
+        self.result : typing.Any = None
+        self.error : typing.Optional[BaseException] = None
+
+    def covers(self, utc_time_start : arrow.Arrow, utc_time_end : arrow.Arrow, streams : typing.FrozenSet[typing.Any]) -> bool:
+        return self.utc_time_start <= utc_time_start and utc_time_end - END_TOLERANCE <= self.utc_time_end and streams <= self.streams
+
+
+class SingleFlight:
+
+    def __init__(self):
+        self._flights : typing.Dict[typing.Any, _Flight] = {}
+        self._lock = threading.Lock()
+
+        self.counts : typing.Counter[str] = collections.Counter()
+
+    def run(self, key : typing.Any, utc_time_start : arrow.Arrow, utc_time_end : arrow.Arrow, streams : typing.FrozenSet[typing.Any], call : typing.Callable[[], typing.Any]) -> typing.Tuple[typing.Any, bool]:
+        """
+        Runs call unless a flight of the key covering the window and streams is in flight, returns
+        (result, joined). A joined flight's result is shared, as is its error.
+        """
+        while True:
+            with self._lock:
+                flight = self._flights.get(key)
+                if flight is None:
+                    flight = self._flights[key] = _Flight(utc_time_start, utc_time_end, streams)
+                    self.counts["flights"] += 1
+                    break
+
+                joining = flight.covers(utc_time_start, utc_time_end, streams)
+                if joining:
+                    self.counts["joined"] += 1
+                else:
+                    self.counts["waited"] += 1
+
+            flight.landed.wait()
+            if joining:
+                if flight.error is not None:
+                    raise flight.error
+                return flight.result, True
+
+        try:
+            flight.result = call()
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.landed.set()
+
+        return flight.result, False
+
+    def in_flight(self) -> int:
+        with self._lock:
+            return len(self._flights)
+
+
+syncs = SingleFlight()
@@ -0,0 +1,96 @@
+"""
+Stage timing of the sync path.
+
+Stages are wrapped in span(name). Within recording(...) the durations are logged through the
+dose-logger, tagged with the user and sync window, and summed per stage for the request summary.
+Outside of a recording spans cost a perf_counter call and nothing is logged.
+"""
+
+import contextlib
+import contextvars
+import datetime
+import logging
+import threading
+import time
+import typing
+
+from django.conf import settings
+
+logger = logging.getLogger('dose-logger')
+
+# Response header of the per request summary, only added when settings.SYNC_TIMING_HEADER is set
+# and the request asks for it with the DEBUG_TIMING_HEADER
+TIMING_HEADER = "Server-Timing"
+DEBUG_TIMING_HEADER = "X-Debug-Timing"
+
+
+class SpanRecorder:
+
+    def __init__(self, user : typing.Any = None, window : typing.Optional[datetime.timedelta] = None):
+        self.user = str(user) if user is not None else None
+        self.window_seconds = int(window.total_seconds()) if window is not None else None
+        self.started = time.perf_counter()
+
+        # Stage name -> (total seconds, count), in order of first use
+        self.stages : typing.Dict[str, typing.Tuple[float, int]] = {}
+        # Spans of concurrent fetches are added from their threads
+        self._lock = threading.Lock()
+
+    def add(self, name : str, seconds : float):
+        with self._lock:
+            total, count = self.stages.get(name, (0.0, 0))
+            self.stages[name] = (total + seconds, count + 1)
+
+        logger.info("sync-span | stage=%s duration_ms=%.2f user=%s window_seconds=%s", name, seconds * 1000, self.user, self.window_seconds,
+                    extra={"stage": name, "duration_ms": seconds * 1000, "user": self.user, "window_seconds": self.window_seconds})
+
+    def total_seconds(self) -> float:
+        return time.perf_counter() - self.started
+
+    def summary(self) -> str:
+        # Server-Timing format, "name;dur=milliseconds" per stage
+        with self._lock:
+            stages = list(self.stages.items())
+
+        timings = ["{};dur={:.2f}".format(name, total * 1000) for name, (total, _) in stages]
+        timings.append("total;dur={:.2f}".format(self.total_seconds() * 1000))
+        return ", ".join(timings)
+
+
+_current_recorder : contextvars.ContextVar[typing.Optional[SpanRecorder]] = contextvars.ContextVar("current_span_recorder", default=None)
+
+
+def current_recorder() -> typing.Optional[SpanRecorder]:
+    return _current_recorder.get()
+
+@contextlib.contextmanager
+def recording(user : typing.Any = None, window : typing.Optional[datetime.timedelta] = None) -> typing.Iterator[SpanRecorder]:
+    """
+    Records the spans of the enclosed code, logging a summary at the end.
+    """
+    recorder = SpanRecorder(user, window)
+    token = _current_recorder.set(recorder)
+    try:
+        yield recorder
+    finally:
+        _current_recorder.reset(token)
+        logger.info("sync-timing | user=%s window_seconds=%s %s", recorder.user, recorder.window_seconds, recorder.summary(),
+                    extra={"user": recorder.user, "window_seconds": recorder.window_seconds, "stages": {name: total * 1000 for name, (total, _) in recorder.stages.items()}})
+
+@contextlib.contextmanager
+def span(name : str) -> typing.Iterator[None]:
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        recorder = _current_recorder.get()
+        if recorder is not None:
+            recorder.add(name, time.perf_counter() - start)
+
+def add_timing_header(request, response, recorder : SpanRecorder):
+    # Stage timings are not sent to every client, only to debugging requests of an enabled deployment
+    requested = request.headers.get(DEBUG_TIMING_HEADER, "").strip().lower() in ("1", "true")
+    if requested and getattr(settings, "SYNC_TIMING_HEADER", False):
+        response[TIMING_HEADER] = recorder.summary()
+
+    return response
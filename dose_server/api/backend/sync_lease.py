@@ -0,0 +1,68 @@
+"""
+Per user sync lease across app servers, a Postgres session level advisory lock.
+
+The sync path holds the lease of the user while it downloads and persists, so two nodes never sync the
+same user at once. A node finding the lease held waits up to LEASE_WAIT for the holder to finish,
+then checks whether the holder already synced its window. The lock belongs to the database session,
+so a node which dies releases it with its connection. Other database backends sync without a lease.
+"""
+
+import contextlib
+import datetime
+import time
+import typing
+import zlib
+
+from django.db import connection
+
+from api import models
+
+# First key of the advisory locks, "SYNC", the user is the second
+LEASE_NAMESPACE = 0x53594E43
+
+LEASE_WAIT = datetime.timedelta(seconds=30)
+LEASE_POLL_SECONDS = 0.5
+
+
+class LeaseUnavailable(Exception):
+    pass
+
+
+def _lock_key(user : models.User) -> int:
+    # Signed 32 bit, users with the same key only serialize their syncs
+    return zlib.crc32(str(user.pk).encode("utf-8")) - 2 ** 31
+
+def _try_lock(key : int) -> bool:
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT pg_try_advisory_lock(%s, %s)", [LEASE_NAMESPACE, key])
+        return cursor.fetchone()[0]
+
+def _unlock(key : int):
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT pg_advisory_unlock(%s, %s)", [LEASE_NAMESPACE, key])
+
+@contextlib.contextmanager
+def lease(user : models.User, wait : datetime.timedelta = LEASE_WAIT) -> typing.Iterator[bool]:
+    """
+    Holds the sync lease of the user, yields whether another node held it first and this one waited.
+    Raises LeaseUnavailable if it is still held after `wait`.
+    """
+    if connection.vendor != "postgresql":
+        yield False
+        return
+
+    key = _lock_key(user)
+    waited = False
+    deadline = time.monotonic() + wait.total_seconds()
+
+    while not _try_lock(key):
+        if time.monotonic() >= deadline:
+            raise LeaseUnavailable("The sync of {} is held by another node".format(user))
+
+        waited = True
+        time.sleep(LEASE_POLL_SECONDS)
+
+    try:
+        yield waited
+    finally:
+        _unlock(key)
@@ -0,0 +1,286 @@
+import datetime
+import typing
+
+import arrow
+
+from django.db import connection, transaction
+
+from api import models
+
+from . import download_data
+from . import dexcom_client
+from . import handle_services
+from . import single_flight
+from . import spans
+from . import sync_lease
+from . import tconnect_sessions
+from .range_index import RANGE_SECONDS
+from .timeline import Timeline
+
+# Window downloaded, merged and persisted at once by the sync pipeline
+SYNC_CHUNK = datetime.timedelta(days=1)
+
+# Ranges starting this close to the end of a chunk are held back and rebuilt with the next chunk,
+# so the last reading of a chunk still ends at the first reading of the next one
+CHUNK_CARRY = datetime.timedelta(seconds=2 * RANGE_SECONDS)
+
+# Fields written when updating an existing entry
+MERGED_ENTRY_FIELDS = ["blood_glucose", "trend_rate", "trend", "insulin_on_board",
+                       "insulin_on_board_last", "insulin_on_board_min", "insulin_on_board_max", "insulin_on_board_mean",
+                       "dosed_insulin", "dose_target_bg", "is_manual_bolus", "dose_completion_time",
+                       "basel_time", "basel_delivery_type", "basel_duration", "basel_rate"]
+
+# Unique range of an entry, the conflict target of the upsert
+UPSERT_KEY_FIELDS = ["owner", "start_datetime", "end_datetime"]
+UPSERT_BATCH_SIZE = 1000
+
+# User fields recording how far the streams are persisted
+CURSOR_FIELDS = ["last_fetched_datetime", "last_fetched_basal_datetime"]
+
+
+class SaveResult(typing.NamedTuple):
+    inserted_count : int
+    updated_count : int
+
+
+class SyncResult(typing.NamedTuple):
+    persisted_count : int
+    failed_sources : typing.List[str]
+
+
+def fetched_until(user : models.User, plan : download_data.DownloadPlan = download_data.SYNC_PLAN) -> datetime.datetime:
+    """
+    Time every stream of the plan is persisted until, a sync of the plan resumes from it.
+    """
+    if download_data.Stream.BASAL in plan.streams and user.last_fetched_basal_datetime is not None:
+        return min(user.last_fetched_datetime, user.last_fetched_basal_datetime)
+
+    return user.last_fetched_datetime
+
+def rewind_cursors(user : models.User, until : datetime.datetime):
+    """
+    Moves the user's cursors back to `until` if they are past it, so the next sync downloads the data after it again.
+    """
+    user.refresh_from_db(fields=CURSOR_FIELDS)
+    if user.last_fetched_datetime <= until:
+        return
+
+    user.last_fetched_datetime = until
+    if user.last_fetched_basal_datetime is not None and user.last_fetched_basal_datetime >= until:
+        user.last_fetched_basal_datetime = None
+    user.save(update_fields=CURSOR_FIELDS)
+
+def _advance_cursors(user : models.User, persisted_until : arrow.Arrow, plan : download_data.DownloadPlan):
+    if download_data.Stream.BASAL not in plan.streams:
+        # The basal segments stay behind, the next full sync resumes from them
+        if user.last_fetched_basal_datetime is None:
+            user.last_fetched_basal_datetime = user.last_fetched_datetime
+        user.last_fetched_datetime = persisted_until.datetime
+    elif user.last_fetched_basal_datetime is not None and persisted_until.datetime < user.last_fetched_datetime:
+        # A full sync resuming from the basal segments downloads the other streams again until it catches up
+        user.last_fetched_basal_datetime = persisted_until.datetime
+    else:
+        user.last_fetched_datetime = persisted_until.datetime
+        user.last_fetched_basal_datetime = None
+
+def fetch_all_data(user : models.User, utc_time_start : arrow.Arrow, utc_time_end : arrow.Arrow, incremental : bool = False, plan : download_data.DownloadPlan = download_data.SYNC_PLAN) -> Timeline:
+    # Start Data Downloads
+    # TConnect, logged in clients are reused between syncs
+    tconnect = tconnect_sessions.pool.get(user)
+
+    tandem_events, dexcom_data, failed_sources = download_data.download_all_data(user, tconnect, utc_time_start, utc_time_end, plan)
+    if len(failed_sources) > 0:
+        print("Failed to download {}, merging the other sources".format(", ".join(failed_sources)))
+
+    # Incremental merges only return the added or changed entries
+    full_data = handle_services.handle_data(tandem_events, dexcom_data, user=user if incremental else None)
+
+    return full_data
+
+def _entry(user : models.User, row) -> models.DiabetesEntry:
+    entry = models.DiabetesEntry(id=row.entry_id)
+    entry.owner = user
+
+    entry.start_datetime = row.start_datetime
+    entry.end_datetime = row.end_datetime
+
+    entry.blood_glucose = row.bg
+    entry.trend_rate = row.trend_rate
+    entry.trend = row.trend
+
+    entry.insulin_on_board = row.iob
+    entry.insulin_on_board_last = row.iob_last
+    entry.insulin_on_board_min = row.iob_min
+    entry.insulin_on_board_max = row.iob_max
+    entry.insulin_on_board_mean = row.iob_mean
+
+    entry.dosed_insulin = row.insulin
+    entry.dose_target_bg = row.target_bg
+    entry.is_manual_bolus = row.is_manual
+    entry.dose_completion_time = row.completion_time
+
+    entry.basel_time = row.basel_time
+    entry.basel_delivery_type = row.basel_delivery_type
+    entry.basel_duration = row.basel_duration
+    entry.basel_rate = row.basel_rate
+
+    return entry
+
+def _update_entry_ends(cursor, entries : typing.List[models.DiabetesEntry]):
+    meta = models.DiabetesEntry._meta
+    table = connection.ops.quote_name(meta.db_table)
+    id_column = connection.ops.quote_name(meta.pk.column)
+    end_field = meta.get_field("end_datetime")
+    end_column = connection.ops.quote_name(end_field.column)
+
+    for batch_start in range(0, len(entries), UPSERT_BATCH_SIZE):
+        batch = entries[batch_start:batch_start + UPSERT_BATCH_SIZE]
+        params = [value for entry in batch for value in (entry.id, end_field.get_db_prep_save(entry.end_datetime, connection))]
+        cursor.execute(
+            "WITH ranges (id, end_datetime) AS (VALUES {3}) UPDATE {0} SET {2} = ranges.end_datetime FROM ranges WHERE {0}.{1} = ranges.id AND {0}.{2} <> ranges.end_datetime".format(
+                table, id_column, end_column, ", ".join(["(%s, %s)"] * len(batch))
+            ),
+            params
+        )
+
+def save_data_to_database(user : models.User, full_data : Timeline) -> SaveResult:
+    """
+    Upserts the entries in UPSERT_BATCH_SIZE batches of INSERT ... ON CONFLICT, in one transaction.
+    Entries of a range which is already persisted, new or changed by an incremental merge, update its MERGED_ENTRY_FIELDS.
+    Persisted entries whose range was ended at a new reading are moved to their new end first.
+    """
+    # Ranges are unique, the last entry of a range wins
+    entries = list({(row.start_datetime, row.end_datetime) : _entry(user, row) for row in full_data.rows()}.values())
+    if len(entries) == 0:
+        return SaveResult(0, 0)
+
+    meta = models.DiabetesEntry._meta
+    fields = [meta.get_field(name) for name in UPSERT_KEY_FIELDS + MERGED_ENTRY_FIELDS]
+    columns = ", ".join(connection.ops.quote_name(field.column) for field in fields)
+    key_columns = ", ".join(connection.ops.quote_name(meta.get_field(name).column) for name in UPSERT_KEY_FIELDS)
+    updates = ", ".join("{0} = EXCLUDED.{0}".format(connection.ops.quote_name(meta.get_field(name).column)) for name in MERGED_ENTRY_FIELDS)
+    row_placeholders = "({})".format(", ".join(["%s"] * len(fields)))
+
+    inserted_count = 0
+    updated_count = 0
+    with transaction.atomic(), connection.cursor() as cursor:
+        _update_entry_ends(cursor, [entry for entry in entries if entry.id is not None])
+
+        for batch_start in range(0, len(entries), UPSERT_BATCH_SIZE):
+            batch = entries[batch_start:batch_start + UPSERT_BATCH_SIZE]
+            params = [field.get_db_prep_save(getattr(entry, field.attname), connection) for entry in batch for field in fields]
+
+            # xmax is 0 for the rows which were inserted
+            cursor.execute(
+                "INSERT INTO {} ({}) VALUES {} ON CONFLICT ({}) DO UPDATE SET {} RETURNING (xmax = 0)".format(
+                    connection.ops.quote_name(meta.db_table), columns, ", ".join([row_placeholders] * len(batch)), key_columns, updates
+                ),
+                params
+            )
+            inserted = sum(1 for (was_inserted,) in cursor.fetchall() if was_inserted)
+            inserted_count += inserted
+            updated_count += len(batch) - inserted
+
+    print("Saved {} new and {} updated ranges".format(inserted_count, updated_count))
+    return SaveResult(inserted_count, updated_count)
+
+def iter_sync_chunks(user : models.User, utc_time_start : arrow.Arrow, utc_time_end : arrow.Arrow, chunk : datetime.timedelta = SYNC_CHUNK, plan : download_data.DownloadPlan = download_data.SYNC_PLAN) -> typing.Iterator[typing.Tuple[arrow.Arrow, Timeline, typing.List[str]]]:
+    """
+    Downloads, merges and persists the window one chunk at a time, yielding (persisted_until, persisted entries, failed sources).
+
+    Each chunk is merged incrementally into the entries persisted by the previous one, and
+    user.last_fetched_datetime follows the persisted data, so a failed sync resumes from the
+    last persisted chunk. Only one chunk of upstream data is held in memory at a time.
+
+    The sources of a chunk are downloaded concurrently. When one fails the others are still
+    merged and persisted, but user.last_fetched_datetime stays before the chunk, so the next
+    sync downloads it again. A plan without the basal stream leaves user.last_fetched_basal_datetime
+    behind, the next full sync resumes from it and merges the basal segments into the persisted entries.
+    """
+    tconnect = tconnect_sessions.pool.get(user)
+
+    fetch_start = utc_time_start
+    chunk_start = utc_time_start
+    incomplete = False
+    while chunk_start < utc_time_end:
+        chunk_end = min(chunk_start + chunk, utc_time_end)
+
+        tandem_events, dexcom_data, failed_sources = download_data.download_all_data(user, tconnect, fetch_start, chunk_end, plan)
+        if len(failed_sources) > 0:
+            print("Failed to download {}, merging the other sources".format(", ".join(failed_sources)))
+            incomplete = True
+
+        full_data = handle_services.handle_data(tandem_events, dexcom_data, user=user)
+
+        persisted_until = chunk_end
+        if chunk_end < utc_time_end:
+            # Carry the end of the chunk over to the next one
+            persisted_until = chunk_end - CHUNK_CARRY
+            full_data = full_data.take(full_data.starts < int(persisted_until.timestamp()))
+
+        with spans.span("save"):
+            save_data_to_database(user, full_data)
+
+        if not incomplete:
+            _advance_cursors(user, persisted_until, plan)
+            user.save()
+
+        yield persisted_until, full_data, failed_sources
+
+        fetch_start = persisted_until
+        chunk_start = chunk_end
+
+def sync_user_window(user : models.User, utc_time_start : arrow.Arrow, utc_time_end : arrow.Arrow, plan : download_data.DownloadPlan = download_data.SYNC_PLAN,
+                     on_chunk : typing.Optional[typing.Callable[[arrow.Arrow], None]] = None) -> SyncResult:
+    """
+    Runs the chunked sync pipeline over the window, returns the number of entries persisted
+    and the sources which failed to download in any chunk. Only the streams of the plan are downloaded.
+
+    A sync of the user already in flight in this process which covers the window and streams is
+    joined and its result returned, otherwise this one waits for it to finish before starting.
+    Across processes the sync holds the user's sync_lease, raising LeaseUnavailable if another
+    node holds it for longer than LEASE_WAIT.
+
+    on_chunk is called with persisted_until after every chunk this sync persists, an error it raises stops the sync.
+    """
+    result, joined = single_flight.syncs.run(user.pk, utc_time_start, utc_time_end, plan.streams,
+                                             lambda: _sync_user_window(user, utc_time_start, utc_time_end, plan, on_chunk))
+    if joined:
+        print("Joined the sync of {} in flight".format(user))
+        # Saved by the sync which ran, this instance still holds the previous values
+        user.refresh_from_db(fields=CURSOR_FIELDS + dexcom_client.TOKEN_FIELDS)
+
+    return result
+
+def _sync_user_window(user : models.User, utc_time_start : arrow.Arrow, utc_time_end : arrow.Arrow, plan : download_data.DownloadPlan,
+                      on_chunk : typing.Optional[typing.Callable[[arrow.Arrow], None]]) -> SyncResult:
+    with sync_lease.lease(user) as waited:
+        if waited:
+            user.refresh_from_db(fields=CURSOR_FIELDS + dexcom_client.TOKEN_FIELDS)
+            if fetched_until(user, plan) >= (utc_time_end - single_flight.END_TOLERANCE).datetime:
+                # The node holding the lease persisted the window
+                print("{} was synced by another node".format(user))
+                return SyncResult(0, [])
+
+        return _run_sync_pipeline(user, utc_time_start, utc_time_end, plan, on_chunk)
+
+def _run_sync_pipeline(user : models.User, utc_time_start : arrow.Arrow, utc_time_end : arrow.Arrow, plan : download_data.DownloadPlan,
+                       on_chunk : typing.Optional[typing.Callable[[arrow.Arrow], None]]) -> SyncResult:
+    persisted_count = 0
+    failed_sources : typing.List[str] = []
+    for persisted_until, full_data, chunk_failed_sources in iter_sync_chunks(user, utc_time_start, utc_time_end, plan=plan):
+        print("Persisted {} ranges until {}".format(len(full_data), persisted_until.isoformat(timespec="seconds")))
+        persisted_count += len(full_data)
+        failed_sources.extend(source for source in chunk_failed_sources if source not in failed_sources)
+
+        if on_chunk is not None:
+            on_chunk(persisted_until)
+
+    return SyncResult(persisted_count, failed_sources)
+
+def sync_user_data(user : models.User, utc_time_start : arrow.Arrow, utc_time_end : arrow.Arrow, plan : download_data.DownloadPlan = download_data.SYNC_PLAN) -> int:
+    """
+    Runs the chunked sync pipeline over the window, returns the number of entries persisted.
+    Only the streams of the plan are downloaded.
+    """
+    return sync_user_window(user, utc_time_start, utc_time_end, plan).persisted_count
@@ -0,0 +1,346 @@
+"""
+Background sync of the upstream data, off the request path.
+
+Jobs are models.SyncJob rows. enqueue() queues a job for a user unless one is already queued, workers
+claim due jobs with SELECT ... FOR UPDATE SKIP LOCKED, so any number of worker processes share the queue,
+and run the chunked sync pipeline of sync_services for them. A user's jobs never run concurrently.
+schedule_due_users() queues every user with credentials once per SYNC_INTERVAL, the CGM cadence.
+
+Due jobs are claimed by staleness, the user whose data is the oldest first. A job syncs at most
+BACKFILL_SLICE of its window and is then queued again behind the waiting jobs, so a long backfill
+interleaves with the incremental syncs of the other users. Upstream requests are rate limited by rate_limits.
+"""
+
+import datetime
+import os
+import socket
+import threading
+import time
+import traceback
+import typing
+
+import arrow
+
+from django.db import close_old_connections, transaction
+from django.db.models import Min, Q
+from django.db.models.functions import Coalesce, Least
+
+from api import models
+
+from . import download_data
+from . import rate_limits
+from . import spans
+from . import sync_lease
+from . import sync_services
+
+import logging
+logger = logging.getLogger('dose-logger')
+
+# Dexcom CGMs read every 5 minutes
+SYNC_INTERVAL = datetime.timedelta(minutes=5)
+
+# Downloaded again before user.last_fetched_datetime, late pump uploads are merged
+SYNC_OVERLAP = datetime.timedelta(days=2)
+
+# Sleep of an idle worker between claims
+POLL_INTERVAL = datetime.timedelta(seconds=5)
+
+# Running jobs without a heartbeat for this long belong to a worker which died, they are queued again
+JOB_TIMEOUT = datetime.timedelta(minutes=15)
+
+MAX_ATTEMPTS = 3
+RETRY_DELAY = datetime.timedelta(minutes=1)
+
+# Finished jobs are deleted after this
+JOB_RETENTION = datetime.timedelta(days=1)
+
+# Window synced by one run of a job, longer windows are synced over several runs.
+# Longer than SYNC_OVERLAP, so an incremental sync is a single run.
+BACKFILL_SLICE = datetime.timedelta(days=3)
+
+# Queue metrics are logged through the dose-logger this often
+STATS_LOG_INTERVAL = datetime.timedelta(minutes=1)
+
+PENDING_STATUSES = [models.SyncJob.QUEUED, models.SyncJob.RUNNING]
+
+
+class IncompleteSync(Exception):
+    pass
+
+
+class JobLost(Exception):
+    pass
+
+
+
+def worker_name() -> str:
+    return "{}:{}".format(socket.gethostname(), os.getpid())
+
+def enqueue(user : models.User, run_after : typing.Optional[datetime.datetime] = None) -> typing.Tuple[models.SyncJob, bool]:
+    """
+    Queues a sync of the user, returns (job, created). An already queued job of the user is returned instead,
+    moved up to run_after if it was due later.
+    """
+    now = arrow.utcnow().datetime
+    run_after = run_after or now
+
+    with transaction.atomic():
+        # Serializes the enqueues of the user, so at most one job of them is queued
+        models.User.objects.select_for_update().filter(pk=user.pk).first()
+
+        job = models.SyncJob.objects.filter(owner=user, status=models.SyncJob.QUEUED).first()
+        if job is not None:
+            if job.run_after > run_after:
+                job.run_after = run_after
+                job.save(update_fields=["run_after"])
+            return job, False
+
+        job = models.SyncJob.objects.create(owner=user, run_after=run_after, stale_since=sync_services.fetched_until(user))
+        return job, True
+
+def request_sync(user : models.User, force : bool = False) -> bool:
+    """
+    Queues a sync of the user for a request, unless one is queued or running, or one was queued within
+    SYNC_INTERVAL and force is not set. True if a sync of the user is pending afterwards.
+    """
+    jobs = models.SyncJob.objects.filter(owner=user)
+
+    if jobs.filter(status=models.SyncJob.RUNNING).exists():
+        return True
+
+    recently_queued = jobs.filter(created_datetime__gt=arrow.utcnow().datetime - SYNC_INTERVAL).exists()
+    if recently_queued and not force:
+        return jobs.filter(status=models.SyncJob.QUEUED).exists()
+
+    enqueue(user)
+    return True
+
+def schedule_due_users() -> int:
+    """
+    Queues a job for every user with credentials and no job queued within SYNC_INTERVAL, returns the number queued.
+    """
+    now = arrow.utcnow().datetime
+
+    due_users = (
+        models.User.objects
+            .exclude(dexcom_refresh_token=None).exclude(tconnect_email=None).exclude(tconnect_password=None)
+            .exclude(sync_jobs__status__in=PENDING_STATUSES)
+            .exclude(sync_jobs__created_datetime__gt=now - SYNC_INTERVAL)
+    )
+
+    queued_count = 0
+    for user in due_users:
+        _, created = enqueue(user)
+        if created:
+            queued_count += 1
+
+    return queued_count
+
+def requeue_stale_jobs() -> int:
+    stale_before = arrow.utcnow().datetime - JOB_TIMEOUT
+    no_heartbeat = Q(heartbeat_datetime__lt=stale_before) | Q(heartbeat_datetime=None, started_datetime__lt=stale_before)
+    return models.SyncJob.objects.filter(no_heartbeat, status=models.SyncJob.RUNNING).update(status=models.SyncJob.QUEUED, worker=None)
+
+def prune_jobs() -> int:
+    finished_before = arrow.utcnow().datetime - JOB_RETENTION
+    deleted_count, _ = models.SyncJob.objects.filter(status__in=[models.SyncJob.DONE, models.SyncJob.FAILED], finished_datetime__lt=finished_before).delete()
+    return deleted_count
+
+def claim_job(worker : str) -> typing.Optional[models.SyncJob]:
+    """
+    Marks the stalest due job as running by the worker, None if no job is due.
+    Jobs of users with a running job are skipped.
+    """
+    now = arrow.utcnow().datetime
+
+    with transaction.atomic():
+        job = (
+            models.SyncJob.objects
+                .select_for_update(skip_locked=True)
+                .filter(status=models.SyncJob.QUEUED, run_after__lte=now)
+                .exclude(owner__sync_jobs__status=models.SyncJob.RUNNING)
+                .order_by("stale_since", "id")
+                .first()
+        )
+        if job is None:
+            return None
+
+        job.status = models.SyncJob.RUNNING
+        job.worker = worker
+        job.started_datetime = job.heartbeat_datetime = now
+        job.attempts += 1
+        job.save(update_fields=["status", "worker", "started_datetime", "heartbeat_datetime", "attempts"])
+
+    return job
+
+def _save_owned_job(job : models.SyncJob, worker : str, update_fields : typing.List[str]) -> bool:
+    # A job requeued as stale may be claimed by another worker meanwhile, this one must not overwrite it
+    updated_count = models.SyncJob.objects.filter(pk=job.pk, worker=worker).update(**{field: getattr(job, field) for field in update_fields})
+    if updated_count == 0:
+        logger.warning("sync-worker | \"Sync job {} was taken from worker {}, not saved\"".format(job.id, worker))
+    return updated_count > 0
+
+def _heartbeat(job : models.SyncJob, worker : str):
+    job.heartbeat_datetime = arrow.utcnow().datetime
+    if not models.SyncJob.objects.filter(pk=job.pk, worker=worker).update(heartbeat_datetime=job.heartbeat_datetime):
+        raise JobLost("Sync job {} was taken from worker {}".format(job.id, worker))
+
+def run_job(job : models.SyncJob):
+    """
+    Syncs every stream of the job's user from sync_services.fetched_until - SYNC_OVERLAP until now, at most BACKFILL_SLICE
+    of it. A job with more of its window left is queued again to sync the next slice. Failed jobs, and
+    slices with sources which failed to download, are retried after RETRY_DELAY, up to MAX_ATTEMPTS.
+    A slice still missing sources on its last attempt is left behind, the job moves on but keeps the
+    user's cursors where that slice stopped, so the next job downloads it again.
+
+    The job's heartbeat is updated after every persisted chunk, and it is only saved while it still
+    belongs to the worker which claimed it.
+    """
+    user = models.User.objects.get(pk=job.owner_id)
+    worker = job.worker
+
+    try:
+        if not user.is_valid_user():
+            raise ValueError("Some TConnect and Dexcom credentials missing")
+
+        now = arrow.utcnow()
+        utc_time_start = arrow.get(job.synced_until or sync_services.fetched_until(user) - SYNC_OVERLAP)
+        utc_time_end = min(utc_time_start + BACKFILL_SLICE, now)
+
+        with spans.recording(user.uuid, utc_time_end - utc_time_start):
+            result = sync_services.sync_user_window(user, utc_time_start, utc_time_end, download_data.SYNC_PLAN, on_chunk=lambda _: _heartbeat(job, worker))
+
+        incomplete_error = None
+        if len(result.failed_sources) > 0:
+            incomplete_error = "Failed to download {}".format(", ".join(result.failed_sources))
+            if job.attempts < MAX_ATTEMPTS:
+                # The slice is synced again, the last attempt moves on with the other sources persisted
+                raise IncompleteSync(incomplete_error)
+
+            if job.retry_from is None:
+                job.retry_from = min(sync_services.fetched_until(user), utc_time_end.datetime)
+
+        if job.retry_from is not None:
+            # The later slices are complete, the cursors stay at the first incomplete one
+            sync_services.rewind_cursors(user, job.retry_from)
+
+    except JobLost as e:
+        logger.warning("sync-worker | \"{}, abandoning it\"".format(e))
+        return
+
+    except sync_lease.LeaseUnavailable as e:
+        # Another node is syncing the user, not a failed attempt
+        logger.warning("sync-worker | \"{}, retrying job {} later\"".format(e, job.id))
+
+        job.status = models.SyncJob.QUEUED
+        job.worker = None
+        job.attempts -= 1
+        job.run_after = arrow.utcnow().datetime + RETRY_DELAY
+        _save_owned_job(job, worker, ["status", "worker", "attempts", "run_after"])
+        return
+
+    except Exception:
+        logger.exception("sync-worker | \"Sync job {} of {} failed\"".format(job.id, user))
+
+        job.error = traceback.format_exc()
+        job.worker = None
+        if job.attempts < MAX_ATTEMPTS:
+            job.status = models.SyncJob.QUEUED
+            job.run_after = arrow.utcnow().datetime + RETRY_DELAY * job.attempts
+        else:
+            job.status = models.SyncJob.FAILED
+            job.finished_datetime = arrow.utcnow().datetime
+        _save_owned_job(job, worker, ["status", "worker", "run_after", "finished_datetime", "error"])
+        return
+
+    job.persisted_count = (job.persisted_count or 0) + result.persisted_count
+    if incomplete_error is not None or job.retry_from is None:
+        # The error of a slice left behind is kept
+        job.error = incomplete_error
+
+    if utc_time_end < now:
+        # Next slice, behind every job waiting now
+        job.status = models.SyncJob.QUEUED
+        job.synced_until = utc_time_end.datetime
+        job.stale_since = job.run_after = arrow.utcnow().datetime
+        job.worker = None
+        job.attempts = 0
+        _save_owned_job(job, worker, ["status", "synced_until", "stale_since", "run_after", "worker", "attempts", "persisted_count", "error", "retry_from"])
+        return
+
+    job.status = models.SyncJob.DONE
+    job.finished_datetime = arrow.utcnow().datetime
+    _save_owned_job(job, worker, ["status", "persisted_count", "finished_datetime", "error", "retry_from"])
+
+def queue_stats() -> typing.Dict[str, typing.Any]:
+    """
+    Queue depth and lag. queue_lag_seconds is the longest a due job has waited to be claimed,
+    staleness_seconds how old the oldest data of a user with credentials is.
+    """
+    now = arrow.utcnow().datetime
+    jobs = models.SyncJob.objects
+
+    due_jobs = jobs.filter(status=models.SyncJob.QUEUED, run_after__lte=now)
+    oldest_due = due_jobs.aggregate(run_after=Min("run_after"))["run_after"]
+
+    oldest_fetch = (
+        models.User.objects
+            .exclude(dexcom_refresh_token=None).exclude(tconnect_email=None).exclude(tconnect_password=None)
+            .aggregate(last_fetched=Min(Least("last_fetched_datetime", Coalesce("last_fetched_basal_datetime", "last_fetched_datetime"))))["last_fetched"]
+    )
+
+    return {
+        "queued": jobs.filter(status=models.SyncJob.QUEUED).count(),
+        "due": due_jobs.count(),
+        "backfilling": jobs.filter(status__in=PENDING_STATUSES).exclude(synced_until=None).count(),
+        "running": jobs.filter(status=models.SyncJob.RUNNING).count(),
+        "failed": jobs.filter(status=models.SyncJob.FAILED).count(),
+        "queue_lag_seconds": (now - oldest_due).total_seconds() if oldest_due is not None else 0,
+        "staleness_seconds": (now - oldest_fetch).total_seconds() if oldest_fetch is not None else None,
+        "upstreams": rate_limits.limiter.stats()
+    }
+
+def _log_queue_stats():
+    stats = queue_stats()
+    logger.info("sync-queue | " + " ".join("{}={}".format(name, value) for name, value in stats.items() if name != "upstreams"), extra=stats)
+
+def run_worker(stop : threading.Event, schedule : bool = True, once : bool = False, worker : typing.Optional[str] = None):
+    """
+    Claims and runs jobs until stop is set, scheduling due users between jobs when schedule is set.
+    With once, returns when no job is due.
+    """
+    worker = worker or worker_name()
+    print("Sync worker {} started".format(worker))
+
+    stats_logged = 0.0
+    while not stop.is_set():
+        # Long running processes outlive their database connections
+        close_old_connections()
+
+        if time.monotonic() - stats_logged >= STATS_LOG_INTERVAL.total_seconds():
+            _log_queue_stats()
+            stats_logged = time.monotonic()
+
+        requeued_count = requeue_stale_jobs()
+        if requeued_count > 0:
+            logger.warning("sync-worker | \"Queued {} stale jobs again\"".format(requeued_count))
+
+        if schedule:
+            queued_count = schedule_due_users()
+            if queued_count > 0:
+                print("Scheduled {} users".format(queued_count))
+
+        job = claim_job(worker)
+        if job is None:
+            if once:
+                break
+
+            prune_jobs()
+            stop.wait(POLL_INTERVAL.total_seconds())
+            continue
+
+        start = time.perf_counter()
+        run_job(job)
+        print("Sync job {} of {} {} in {:.2f} s".format(job.id, job.owner_id, job.status, time.perf_counter() - start))
+
+    close_old_connections()
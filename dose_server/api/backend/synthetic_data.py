@@ -0,0 +1,196 @@
+"""
+Synthetic Dexcom and Tandem payloads, shaped like the upstream API responses.
+Used to benchmark and load test the sync path without upstream access.
+"""
+
+import datetime
+import random
+import typing
+
+import arrow
+
+from .range_index import RANGE_SECONDS
+
+# Local wall clock format of Dexcom displayTime and Tandem EventDateTime
+LOCAL_TIME_FORMAT = "%Y-%m-%dT%H:%M:%S"
+
+TRENDS = ["doubleDown", "singleDown", "fortyFiveDown", "flat", "fortyFiveUp", "singleUp", "doubleUp"]
+
+
+class SyntheticConfig(typing.NamedTuple):
+    days : float = 1
+    start : datetime.datetime = datetime.datetime(2022, 6, 1)
+    # Chance of a sensor gap starting at a reading, and its length in readings
+    gap_rate : float = 0.002
+    gap_readings : typing.Tuple[int, int] = (2, 36)
+    # Offset of the pump clock from the Dexcom clock
+    clock_skew_seconds : int = 40
+    # Random jitter of each reading around the five minute cadence
+    jitter_seconds : int = 5
+    boluses_per_day : int = 6
+    iob_interval_seconds : int = 60
+    seed : int = 0
+
+
+def _reading_times(config : SyntheticConfig, rng : random.Random) -> typing.List[datetime.datetime]:
+    reading_count = int(config.days * 24 * 60 * 60 // RANGE_SECONDS)
+
+    times = []
+    skip = 0
+    for reading_idx in range(reading_count):
+        if skip > 0:
+            skip -= 1
+            continue
+
+        if rng.random() < config.gap_rate:
+            skip = rng.randint(*config.gap_readings)
+
+        jitter = rng.randint(-config.jitter_seconds, config.jitter_seconds)
+        times.append(config.start + datetime.timedelta(seconds=reading_idx * RANGE_SECONDS + jitter))
+
+    return times
+
+def _glucose_values(count : int, rng : random.Random) -> typing.List[int]:
+    values = []
+    bg = 120.0
+    for _ in range(count):
+        bg = min(max(bg + rng.gauss(0, 4), 40), 400)
+        values.append(int(bg))
+
+    return values
+
+def dexcom_egvs(config : SyntheticConfig) -> typing.List[typing.Dict[str, typing.Any]]:
+    """
+    Dexcom /v2/users/self/egvs records.
+    """
+    rng = random.Random(config.seed)
+    times = _reading_times(config, rng)
+    values = _glucose_values(len(times), rng)
+
+    egvs = []
+    for time, value in zip(times, values):
+        egvs.append({
+            "systemTime": time.strftime(LOCAL_TIME_FORMAT),
+            "displayTime": time.strftime(LOCAL_TIME_FORMAT),
+            "value": value,
+            "realtimeValue": value,
+            "smoothedValue": None,
+            "status": None,
+            "trend": rng.choice(TRENDS),
+            "trendRate": round(rng.uniform(-2, 2), 1)
+        })
+
+    return egvs
+
+def tandem_reading_data(config : SyntheticConfig) -> typing.List[typing.Dict[str, str]]:
+    """
+    Tandem therapy timeline CSV readingData rows, as seen through the pump clock.
+    """
+    rng = random.Random(config.seed + 1)
+    skew = datetime.timedelta(seconds=config.clock_skew_seconds)
+    times = _reading_times(config, rng)
+    values = _glucose_values(len(times), rng)
+
+    return [{
+        "EventDateTime": (time + skew).strftime(LOCAL_TIME_FORMAT),
+        "Readings (CGM / BGM)": str(value),
+        "Description": "EGV"
+    } for time, value in zip(times, values)]
+
+def tandem_bolus_data(config : SyntheticConfig) -> typing.List[typing.Dict[str, str]]:
+    """
+    Tandem therapy timeline CSV bolusData rows.
+    """
+    rng = random.Random(config.seed + 2)
+    skew = datetime.timedelta(seconds=config.clock_skew_seconds)
+    bolus_count = int(config.days * config.boluses_per_day)
+
+    rows = []
+    for _ in range(bolus_count):
+        request_time = config.start + skew + datetime.timedelta(seconds=rng.uniform(0, config.days * 24 * 60 * 60))
+        completion_time = request_time + datetime.timedelta(seconds=rng.randint(30, 180))
+        is_manual = rng.random() < 0.5
+        insulin = round(rng.uniform(0.1, 8), 2)
+
+        rows.append({
+            "BG": str(rng.randint(70, 250)) if is_manual else "",
+            "IOB": str(round(rng.uniform(0, 6), 2)),
+            "InsulinDelivered": str(insulin),
+            "ActualTotalBolusRequested": str(insulin),
+            "CarbSize": str(rng.randint(0, 80)) if is_manual else "0",
+            "RequestDateTime": request_time.strftime(LOCAL_TIME_FORMAT),
+            "CompletionDateTime": completion_time.strftime(LOCAL_TIME_FORMAT),
+            "TargetBG": "110",
+            "Description": "Standard" if is_manual else "Automatic Bolus",
+            "BolusIsComplete": "1",
+            "ExtendedBolusIsComplete": "",
+            "CompletionStatusDesc": "Completed",
+            "BolexCompletionStatusDesc": "",
+            "BolexCompletionDateTime": "",
+            "BolexStartDateTime": "",
+            "UserOverride": "0"
+        })
+
+    rows.sort(key=lambda row: row["CompletionDateTime"])
+    return rows
+
+def tandem_iob_data(config : SyntheticConfig) -> typing.List[typing.Dict[str, str]]:
+    """
+    Tandem therapy timeline CSV iobData rows.
+    """
+    rng = random.Random(config.seed + 3)
+    skew = datetime.timedelta(seconds=config.clock_skew_seconds)
+    sample_count = int(config.days * 24 * 60 * 60 // config.iob_interval_seconds)
+
+    rows = []
+    iob = 0.0
+    for sample_idx in range(sample_count):
+        iob = max(iob - rng.uniform(0, 0.05) + (rng.uniform(0.5, 5) if rng.random() < 0.005 else 0), 0)
+        time = config.start + skew + datetime.timedelta(seconds=sample_idx * config.iob_interval_seconds)
+        rows.append({
+            "EventDateTime": time.strftime(LOCAL_TIME_FORMAT),
+            "IOB": str(round(iob, 2)),
+            "EventID": str(sample_idx)
+        })
+
+    return rows
+
+def ciq_therapy_timeline(config : SyntheticConfig) -> typing.Dict[str, typing.Any]:
+    """
+    ControlIQ therapy timeline with a Control-IQ basal segment every five minutes and some temp basals.
+    """
+    rng = random.Random(config.seed + 4)
+    skew = datetime.timedelta(seconds=config.clock_skew_seconds)
+    segment_count = int(config.days * 24 * 60 * 60 // RANGE_SECONDS)
+
+    algorithm_events = []
+    temp_events = []
+    for segment_idx in range(segment_count):
+        time = config.start + skew + datetime.timedelta(seconds=segment_idx * RANGE_SECONDS)
+        event = {
+            # Local time, read as an America/Los_Angeles epoch timestamp by tconnectsync
+            "x": arrow.get(time, tzinfo="America/Los_Angeles").int_timestamp,
+            "y": round(rng.uniform(0, 2), 3),
+            "duration": RANGE_SECONDS
+        }
+        (temp_events if rng.random() < 0.02 else algorithm_events).append(event)
+
+    return {
+        "suspensionDeliveryEvents": [],
+        "basal": {
+            "tempDeliveryEvents": temp_events,
+            "algorithmDeliveryEvents": algorithm_events,
+            "profileDeliveryEvents": []
+        }
+    }
+
+def tconnect_csv_data(config : SyntheticConfig) -> typing.Dict[str, typing.Any]:
+    """
+    Parsed therapy timeline CSV, as returned by WS2Api.therapy_timeline_csv.
+    """
+    return {
+        "readingData": tandem_reading_data(config),
+        "iobData": tandem_iob_data(config),
+        "basalData": [],
+        "bolusData": tandem_bolus_data(config)
+    }
@@ -0,0 +1,185 @@
+"""
+Process wide pool of logged in t:connect clients by user.
+
+A TConnectApi logs in on first use, pooling it saves the login handshake of later syncs. Clients are
+replaced when their ControlIQ access token is about to expire, after SESSION_TTL, or when the user's
+credentials change. Clients idle for IDLE_TIMEOUT are evicted, as are the least recently used ones past
+MAX_SESSIONS. Hit rate metrics are logged through the dose-logger every STATS_LOG_INTERVAL acquisitions.
+
+Every client carries a login_lock, the concurrent fetches of a sync hold it while they log the client in.
+"""
+
+import collections
+import datetime
+import hashlib
+import threading
+import time
+import typing
+
+import arrow
+
+from django.conf import settings
+
+from tconnectsync.api import TConnectApi
+from tconnectsync.api.controliq import ControlIQApi
+from tconnectsync.api.ws2 import WS2Api
+
+from api import models
+
+import logging
+logger = logging.getLogger('dose-logger')
+
+MAX_SESSIONS = 256
+SESSION_TTL = datetime.timedelta(hours=8)
+IDLE_TIMEOUT = datetime.timedelta(minutes=30)
+
+# Clients whose access token expires within this margin are logged in again
+TOKEN_EXPIRY_MARGIN = datetime.timedelta(minutes=5)
+
+STATS_LOG_INTERVAL = 100
+
+
+class _Session(typing.NamedTuple):
+    tconnect : TConnectApi
+    credentials : str
+    created : float
+
+
+class SessionPool:
+
+    def __init__(self, max_sessions : int = MAX_SESSIONS, ttl : datetime.timedelta = SESSION_TTL, idle_timeout : datetime.timedelta = IDLE_TIMEOUT):
+        self.max_sessions = max_sessions
+        self.ttl_seconds = ttl.total_seconds()
+        self.idle_seconds = idle_timeout.total_seconds()
+
+        # User pk -> session, least recently used first
+        self._sessions : typing.OrderedDict[typing.Any, _Session] = collections.OrderedDict()
+        self._last_used : typing.Dict[typing.Any, float] = {}
+        self._lock = threading.Lock()
+
+        self.counts : typing.Counter[str] = collections.Counter()
+
+    def get(self, user : models.User) -> TConnectApi:
+        """
+        Pooled client of the user, a new one if there is none or it expired.
+        """
+        credentials = _credentials_digest(user.tconnect_email, user.tconnect_password)
+        now = time.monotonic()
+
+        with self._lock:
+            self._evict_idle(now)
+
+            session = self._sessions.get(user.pk)
+            if session is not None and session.credentials == credentials and not self._expired(session, now):
+                self.counts["hits"] += 1
+                self._sessions.move_to_end(user.pk)
+            else:
+                if session is None:
+                    self.counts["misses"] += 1
+                elif session.credentials != credentials:
+                    self.counts["credential_changes"] += 1
+                else:
+                    self.counts["expirations"] += 1
+
+                session = _Session(new_client(user.tconnect_email, user.tconnect_password), credentials, now)
+                self._sessions[user.pk] = session
+                self._sessions.move_to_end(user.pk)
+
+                while len(self._sessions) > self.max_sessions:
+                    evicted_pk, _ = self._sessions.popitem(last=False)
+                    self._last_used.pop(evicted_pk, None)
+                    self.counts["evictions"] += 1
+
+            self._last_used[user.pk] = now
+
+            acquisitions = self.counts["hits"] + self.counts["misses"] + self.counts["credential_changes"] + self.counts["expirations"]
+            if acquisitions % STATS_LOG_INTERVAL == 0:
+                self._log_stats()
+
+            return session.tconnect
+
+    def invalidate(self, user : models.User):
+        with self._lock:
+            self._sessions.pop(user.pk, None)
+            self._last_used.pop(user.pk, None)
+
+    def clear(self):
+        with self._lock:
+            self._sessions.clear()
+            self._last_used.clear()
+
+    def stats(self) -> typing.Dict[str, typing.Any]:
+        with self._lock:
+            return self._stats()
+
+    def _stats(self) -> typing.Dict[str, typing.Any]:
+        acquisitions = self.counts["hits"] + self.counts["misses"] + self.counts["credential_changes"] + self.counts["expirations"]
+        return {
+            "sessions": len(self._sessions),
+            "hits": self.counts["hits"],
+            "misses": self.counts["misses"],
+            "expirations": self.counts["expirations"],
+            "credential_changes": self.counts["credential_changes"],
+            "evictions": self.counts["evictions"],
+            "idle_evictions": self.counts["idle_evictions"],
+            "hit_rate": self.counts["hits"] / acquisitions if acquisitions > 0 else None
+        }
+
+    def _log_stats(self):
+        stats = self._stats()
+        logger.info("tconnect-sessions | " + " ".join("{}={}".format(name, value) for name, value in stats.items()), extra=stats)
+
+    def _expired(self, session : _Session, now : float) -> bool:
+        if now - session.created > self.ttl_seconds:
+            return True
+
+        # Not logged in yet, or the access token is close to its expiration
+        ciq = session.tconnect._ciq
+        if ciq is None or ciq.accessTokenExpiresAt is None:
+            return False
+
+        try:
+            expires_at = arrow.get(ciq.accessTokenExpiresAt)
+        except (arrow.parser.ParserError, TypeError, ValueError):
+            return True
+
+        return expires_at - arrow.utcnow() < TOKEN_EXPIRY_MARGIN
+
+    def _evict_idle(self, now : float):
+        # Least recently used first, stops at the first session still in use
+        while len(self._sessions) > 0:
+            user_pk = next(iter(self._sessions))
+            if now - self._last_used.get(user_pk, 0) <= self.idle_seconds:
+                break
+
+            del self._sessions[user_pk]
+            self._last_used.pop(user_pk, None)
+            self.counts["idle_evictions"] += 1
+
+
+def new_client(email : str, password : str) -> TConnectApi:
+    tconnect = TConnectApi(email, password)
+    # Serializes the logins of this client only, the clients of other users log in meanwhile
+    tconnect.login_lock = threading.Lock()
+    return tconnect
+
+def configure_base_urls():
+    """
+    Points the tconnectsync clients at settings.UPSTREAM_BASE_URL when it is set, the fake_upstream
+    server serves the login, ControlIQ and ws2 paths from one host.
+    """
+    base_url = getattr(settings, "UPSTREAM_BASE_URL", None)
+    if base_url is None:
+        return
+
+    base_url = base_url.rstrip("/") + "/"
+    ControlIQApi.BASE_URL = base_url
+    ControlIQApi.LOGIN_URL = base_url + "login.aspx?ReturnUrl=%2f"
+    WS2Api.BASE_URL = base_url
+
+def _credentials_digest(email : typing.Optional[str], password : typing.Optional[str]) -> str:
+    # Passwords are not kept in the pool's keys
+    return hashlib.sha256("{}\0{}".format(email, password).encode("utf-8")).hexdigest()
+
+
+pool = SessionPool()
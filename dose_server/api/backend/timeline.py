@@ -0,0 +1,174 @@
+import datetime
+import typing
+
+import numpy as np
+
+from . import merge_engine
+
+# Missing values of the integer columns
+NO_TIME = np.iinfo(np.int64).min
+NO_ID = -1
+UNKNOWN = -1
+
+
+def _optional_list(values : np.ndarray) -> typing.List[typing.Optional[float]]:
+    return [None if value != value else value for value in values.tolist()]
+
+def _optional_datetimes(seconds : np.ndarray) -> typing.List[typing.Optional[datetime.datetime]]:
+    return [None if value == NO_TIME else datetime.datetime.fromtimestamp(value, tz=datetime.timezone.utc) for value in seconds.tolist()]
+
+
+class TimelineRow(typing.NamedTuple):
+    entry_id : typing.Optional[int]
+    start_datetime : datetime.datetime
+    end_datetime : datetime.datetime
+    bg : typing.Optional[float]
+    trend : typing.Optional[str]
+    trend_rate : typing.Optional[float]
+    iob : typing.List[float]
+    iob_last : typing.Optional[float]
+    iob_min : typing.Optional[float]
+    iob_max : typing.Optional[float]
+    iob_mean : typing.Optional[float]
+    insulin : typing.Optional[float]
+    completion_time : typing.Optional[datetime.datetime]
+    target_bg : typing.Optional[float]
+    is_manual : typing.Optional[bool]
+    basel_time : typing.Optional[datetime.datetime]
+    basel_delivery_type : typing.Optional[str]
+    basel_duration : typing.Optional[float]
+    basel_rate : typing.Optional[float]
+
+
+class Timeline:
+    """
+    Merged CGM ranges stored as column arrays, one row per range.
+
+    Times are epoch seconds, missing floats are NaN and missing integers use NO_TIME,
+    NO_ID (entry not persisted yet) and UNKNOWN. The IOB samples of row i are
+    iob_values[iob_offsets[i]:iob_offsets[i+1]].
+    """
+
+    __slots__ = (
+        "starts", "ends", "entry_ids",
+        "bg", "trend", "trend_rate",
+        "insulin", "completion_time", "target_bg", "is_manual",
+        "basel_time", "basel_delivery_type", "basel_duration", "basel_rate",
+        "iob_values", "iob_offsets"
+    )
+
+    def __init__(self, starts : np.ndarray, ends : np.ndarray):
+        range_count = len(starts)
+
+        self.starts = np.asarray(starts, dtype=np.int64)
+        self.ends = np.asarray(ends, dtype=np.int64)
+        self.entry_ids = np.full(range_count, NO_ID, dtype=np.int64)
+
+        self.bg = np.full(range_count, np.nan)
+        self.trend = np.full(range_count, None, dtype=object)
+        self.trend_rate = np.full(range_count, np.nan)
+
+        self.insulin = np.full(range_count, np.nan)
+        self.completion_time = np.full(range_count, NO_TIME, dtype=np.int64)
+        self.target_bg = np.full(range_count, np.nan)
+        self.is_manual = np.full(range_count, UNKNOWN, dtype=np.int8)
+
+        self.basel_time = np.full(range_count, NO_TIME, dtype=np.int64)
+        self.basel_delivery_type = np.full(range_count, None, dtype=object)
+        self.basel_duration = np.full(range_count, np.nan)
+        self.basel_rate = np.full(range_count, np.nan)
+
+        self.iob_values = np.empty(0)
+        self.iob_offsets = np.zeros(range_count + 1, dtype=np.int64)
+
+    def __len__(self) -> int:
+        return self.starts.size
+
+    def has_bolus(self) -> np.ndarray:
+        return (self.completion_time != NO_TIME) | ~np.isnan(self.insulin)
+
+    def has_basal(self) -> np.ndarray:
+        return self.basel_time != NO_TIME
+
+    def iob_counts(self) -> np.ndarray:
+        return np.diff(self.iob_offsets)
+
+    def iob(self, range_idx : int) -> typing.List[float]:
+        return self.iob_values[self.iob_offsets[range_idx]:self.iob_offsets[range_idx+1]].tolist()
+
+    def iob_summary(self) -> typing.Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        # (last, min, max, mean) IOB of each row, NaN without samples
+        return merge_engine.summarize_groups(self.iob_values, self.iob_offsets)
+
+    def set_iob(self, range_idx : np.ndarray, values : np.ndarray) -> None:
+        """
+        Replaces the IOB samples with `values`, each belonging to the row in `range_idx` (-1 is dropped).
+        Samples keep their order within a row.
+        """
+        order, offsets = merge_engine.group_by_range(range_idx, len(self))
+        self.iob_values = np.asarray(values, dtype=np.float64)[order]
+        self.iob_offsets = offsets
+
+    def take(self, indices : np.ndarray) -> "Timeline":
+        """
+        New timeline with the rows at `indices` (or a boolean mask).
+        """
+        indices = np.asarray(indices)
+        if indices.dtype == bool:
+            indices = np.flatnonzero(indices)
+
+        subset = Timeline(self.starts[indices], self.ends[indices])
+        for column in ("entry_ids", "bg", "trend", "trend_rate", "insulin", "completion_time", "target_bg", "is_manual",
+                       "basel_time", "basel_delivery_type", "basel_duration", "basel_rate"):
+            setattr(subset, column, getattr(self, column)[indices])
+
+        counts = self.iob_counts()[indices]
+        np.cumsum(counts, out=subset.iob_offsets[1:])
+        value_idx = np.repeat(self.iob_offsets[indices] - subset.iob_offsets[:-1], counts) + np.arange(subset.iob_offsets[-1])
+        subset.iob_values = self.iob_values[value_idx]
+
+        return subset
+
+    def rows(self) -> typing.Iterator[TimelineRow]:
+        columns = zip(
+            self.entry_ids.tolist(),
+            _optional_datetimes(self.starts),
+            _optional_datetimes(self.ends),
+            _optional_list(self.bg),
+            self.trend.tolist(),
+            _optional_list(self.trend_rate),
+            _optional_list(self.insulin),
+            _optional_datetimes(self.completion_time),
+            _optional_list(self.target_bg),
+            self.is_manual.tolist(),
+            _optional_datetimes(self.basel_time),
+            self.basel_delivery_type.tolist(),
+            _optional_list(self.basel_duration),
+            _optional_list(self.basel_rate)
+        )
+        iob_values = self.iob_values.tolist()
+        offsets = self.iob_offsets.tolist()
+        iob_summaries = zip(*(_optional_list(summary) for summary in self.iob_summary()))
+
+        for range_idx, ((entry_id, start, end, bg, trend, trend_rate, insulin, completion_time, target_bg, is_manual, basel_time, basel_delivery_type, basel_duration, basel_rate), (iob_last, iob_min, iob_max, iob_mean)) in enumerate(zip(columns, iob_summaries)):
+            yield TimelineRow(
+                entry_id=entry_id if entry_id != NO_ID else None,
+                start_datetime=start,
+                end_datetime=end,
+                bg=bg,
+                trend=trend,
+                trend_rate=trend_rate,
+                iob=iob_values[offsets[range_idx]:offsets[range_idx+1]],
+                iob_last=iob_last,
+                iob_min=iob_min,
+                iob_max=iob_max,
+                iob_mean=iob_mean,
+                insulin=insulin,
+                completion_time=completion_time,
+                target_bg=target_bg,
+                is_manual=bool(is_manual) if is_manual != UNKNOWN else None,
+                basel_time=basel_time,
+                basel_delivery_type=basel_delivery_type,
+                basel_duration=basel_duration,
+                basel_rate=basel_rate
+            )
@@ -0,0 +1,79 @@
+"""
+Ingest time parsing of upstream timestamps into epoch seconds.
+
+Dexcom displayTime and Tandem EventDateTime are local wall clock times ("YYYY-MM-DDTHH:MM:SS").
+They are read in the user's timezone, any fraction or UTC offset in the string is ignored,
+the same as arrow.get(timestamp, tzinfo=timezone_name).
+"""
+
+import datetime
+import functools
+import typing
+
+import arrow
+import numpy as np
+import pytz
+
+_SECONDS_PER_DAY = 24 * 60 * 60
+_SECONDS_PER_HOUR = 60 * 60
+# Timezone offsets change on quarter hour boundaries of local time (except historic minute transitions, e.g. St. John's before 2011)
+_OFFSET_SLOT_SECONDS = 15 * 60
+
+
+def _days_from_civil(year : int, month : int, day : int) -> int:
+    # Days since 1970-01-01 of a proleptic Gregorian date
+    year -= month <= 2
+    era = (year if year >= 0 else year - 399) // 400
+    year_of_era = year - era * 400
+    day_of_year = (153 * (month + (-3 if month > 2 else 9)) + 2) // 5 + day - 1
+    day_of_era = year_of_era * 365 + year_of_era // 4 - year_of_era // 100 + day_of_year
+    return era * 146097 + day_of_era - 719468
+
+@functools.lru_cache(maxsize=262144)
+def _utc_offset_seconds(timezone_name : str, local_slot : int) -> int:
+    # Offset of the timezone during a quarter hour slot of local wall clock time.
+    # Like arrow, ambiguous and skipped hours around DST changes use the offset from before the change
+    timezone = pytz.timezone(timezone_name)
+    local_datetime = datetime.datetime(1970, 1, 1) + datetime.timedelta(seconds=local_slot * _OFFSET_SLOT_SECONDS)
+    try:
+        localized = timezone.localize(local_datetime, is_dst=None)
+    except pytz.AmbiguousTimeError:
+        localized = timezone.localize(local_datetime, is_dst=True)
+    except pytz.NonExistentTimeError:
+        localized = timezone.localize(local_datetime, is_dst=False)
+
+    return int(localized.utcoffset().total_seconds())
+
+def _is_fixed_format(timestamp : str) -> bool:
+    return (
+        len(timestamp) >= 19
+        and timestamp[4] == "-" and timestamp[7] == "-"
+        and timestamp[10] in "T "
+        and timestamp[13] == ":" and timestamp[16] == ":"
+    )
+
+def parse_local_timestamp(timestamp : str, timezone_name : str) -> int:
+    """
+    Epoch seconds of a local wall clock timestamp.
+    """
+    if not _is_fixed_format(timestamp):
+        return int(arrow.get(timestamp, tzinfo=timezone_name).timestamp())
+
+    local_seconds = (
+        _days_from_civil(int(timestamp[0:4]), int(timestamp[5:7]), int(timestamp[8:10])) * _SECONDS_PER_DAY
+        + int(timestamp[11:13]) * _SECONDS_PER_HOUR
+        + int(timestamp[14:16]) * 60
+        + int(timestamp[17:19])
+    )
+
+    return local_seconds - _utc_offset_seconds(timezone_name, local_seconds // _OFFSET_SLOT_SECONDS)
+
+def parse_local_timestamps(timestamps : typing.Iterable[str], timezone_name : str) -> np.ndarray:
+    return np.fromiter((parse_local_timestamp(timestamp, timezone_name) for timestamp in timestamps), dtype=np.int64)
+
+def optional_local_timestamp(timestamp : typing.Optional[str], timezone_name : str) -> typing.Optional[int]:
+    # Tandem leaves missing times as empty strings
+    if timestamp is None or timestamp == "":
+        return None
+
+    return parse_local_timestamp(timestamp, timezone_name)
@@ -0,0 +1,51 @@
+import numpy as np
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from api import models
+from api.backend import merge_engine
+
+SUMMARY_FIELDS = ["insulin_on_board_last", "insulin_on_board_min", "insulin_on_board_max", "insulin_on_board_mean"]
+
+
+class Command(BaseCommand):
+    help = "Fills the insulin on board summary columns of entries saved before they existed"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=5000)
+        parser.add_argument("--user", help="Only backfill the entries of the user with this uuid")
+
+    def handle(self, *args, **options):
+        entries = models.DiabetesEntry.objects.filter(insulin_on_board_last__isnull=True).exclude(insulin_on_board=[])
+        if options["user"] is not None:
+            entries = entries.filter(owner__uuid=options["user"])
+
+        batch_size = options["batch_size"]
+        updated_count = 0
+        last_id = 0
+        while True:
+            # Keyset pagination, updated entries drop out of the filter
+            batch = list(entries.filter(id__gt=last_id).order_by("id").only("id", "insulin_on_board")[:batch_size])
+            if len(batch) == 0:
+                break
+
+            counts = np.fromiter((len(entry.insulin_on_board) for entry in batch), dtype=np.int64, count=len(batch))
+            offsets = np.zeros(len(batch) + 1, dtype=np.int64)
+            np.cumsum(counts, out=offsets[1:])
+            values = np.fromiter((iob for entry in batch for iob in entry.insulin_on_board), dtype=np.float64, count=offsets[-1])
+
+            summaries = merge_engine.summarize_groups(values, offsets)
+            for entry, (last, minimum, maximum, mean) in zip(batch, zip(*(summary.tolist() for summary in summaries))):
+                entry.insulin_on_board_last = last
+                entry.insulin_on_board_min = minimum
+                entry.insulin_on_board_max = maximum
+                entry.insulin_on_board_mean = mean
+
+            with transaction.atomic():
+                models.DiabetesEntry.objects.bulk_update(batch, SUMMARY_FIELDS)
+
+            updated_count += len(batch)
+            last_id = batch[-1].id
+            self.stdout.write("Backfilled {} entries".format(updated_count))
+
+        self.stdout.write("Finished, backfilled {} entries".format(updated_count))
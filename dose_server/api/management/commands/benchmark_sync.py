@@ -0,0 +1,168 @@
+import contextlib
+import gc
+import io
+import json
+import platform
+import statistics
+import subprocess
+import time
+import tracemalloc
+import typing
+import uuid
+
+import numpy as np
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from tconnectsync.sync.basal import process_ciq_basal_events
+
+from api import models, utility
+from api.backend import download_data, handle_services, merge_engine, sync_services, synthetic_data
+from api.backend.range_index import RangeIndex
+
+# Synthetic local times are read in this timezone, tconnectsync's default
+TIMEZONE_NAME = "America/New_York"
+
+
+def _git_commit() -> typing.Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def _measure(stage : typing.Callable[[], typing.Any], repeat : int) -> typing.Dict[str, typing.Any]:
+    """
+    Wall time over `repeat` untraced runs, then one traced run for memory and allocations.
+    allocated_blocks counts the blocks the traced run allocated, its result included, against a snapshot taken before it.
+    Stage output (the sync path prints progress) is discarded.
+    """
+    wall_seconds = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        for _ in range(repeat):
+            start = time.perf_counter()
+            stage()
+            wall_seconds.append(time.perf_counter() - start)
+
+        gc.collect()
+        collections_before = sum(stats["collections"] for stats in gc.get_stats())
+
+        # Only blocks allocated by the stage are traced
+        tracemalloc.start()
+        baseline = tracemalloc.take_snapshot()
+        result = stage()
+        _, peak_bytes = tracemalloc.get_traced_memory()
+        snapshot = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+
+        collections = sum(stats["collections"] for stats in gc.get_stats()) - collections_before
+        del result
+
+    # The baseline snapshot itself is allocated while tracing
+    untraced = [tracemalloc.Filter(False, tracemalloc.__file__)]
+    allocated = snapshot.filter_traces(untraced).compare_to(baseline.filter_traces(untraced), "filename")
+    allocated_blocks = sum(stat.count_diff for stat in allocated if stat.count_diff > 0)
+
+    return {
+        "wall_seconds_min": min(wall_seconds),
+        "wall_seconds_median": statistics.median(wall_seconds),
+        "peak_bytes": peak_bytes,
+        "allocated_blocks": allocated_blocks,
+        "gc_collections": collections
+    }
+
+
+class Command(BaseCommand):
+    help = "Benchmarks the sync merge path on synthetic Dexcom and Tandem data, results are saved as JSON"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--days", type=float, nargs="+", default=[1, 7, 30, 90])
+        parser.add_argument("--repeat", type=int, default=3)
+        parser.add_argument("--gap-rate", type=float, default=synthetic_data.SyntheticConfig().gap_rate)
+        parser.add_argument("--clock-skew", type=int, default=synthetic_data.SyntheticConfig().clock_skew_seconds, help="Pump clock offset from Dexcom, in seconds")
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--with-db", action="store_true", help="Also benchmark save_data_to_database, inside a rolled back transaction")
+        parser.add_argument("--output", default="bench_output.json")
+        parser.add_argument("--compare", help="Previous results to compare wall times against")
+
+    def handle(self, *args, **options):
+        results = []
+        for days in options["days"]:
+            config = synthetic_data.SyntheticConfig(days=days, gap_rate=options["gap_rate"], clock_skew_seconds=options["clock_skew"], seed=options["seed"])
+            for stage, measurement in self._run_stages(config, options["repeat"], options["with_db"]):
+                result = {"days": days, "stage": stage, **measurement}
+                results.append(result)
+                self.stdout.write("{:>5g}d {:<14} {:>9.4f}s  peak {:>12,} B  allocated blocks {:>9,}  gc {:>4}".format(
+                    days, stage, result["wall_seconds_min"], result["peak_bytes"], result["allocated_blocks"], result["gc_collections"]
+                ))
+
+        report = {
+            "created": utility.utc_datetime().isoformat(timespec="seconds"),
+            "git_commit": _git_commit(),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "repeat": options["repeat"],
+            "gap_rate": options["gap_rate"],
+            "clock_skew_seconds": options["clock_skew"],
+            "seed": options["seed"],
+            "results": results
+        }
+
+        with open(options["output"], "w") as output_file:
+            json.dump(report, output_file, indent=2)
+        self.stdout.write("Saved results to {}".format(options["output"]))
+
+        if options["compare"] is not None:
+            self._compare(results, options["compare"])
+
+    def _run_stages(self, config : synthetic_data.SyntheticConfig, repeat : int, with_db : bool) -> typing.Iterator[typing.Tuple[str, typing.Dict[str, typing.Any]]]:
+        egvs = synthetic_data.dexcom_egvs(config)
+        csv_data = synthetic_data.tconnect_csv_data(config)
+        ciq_data = synthetic_data.ciq_therapy_timeline(config)
+
+        def parse_tandem():
+            return {
+                download_data.DataType.CGM : download_data.parse_tandem_readings(csv_data["readingData"], TIMEZONE_NAME),
+                download_data.DataType.BOLUS : download_data.custom_bolus_parse(csv_data["bolusData"], TIMEZONE_NAME),
+                download_data.DataType.IOB : download_data.parse_tandem_iob(csv_data["iobData"], TIMEZONE_NAME),
+                download_data.DataType.BASEL : download_data.parse_basal_events(process_ciq_basal_events(ciq_data), TIMEZONE_NAME)
+            }
+
+        yield "parse_dexcom", _measure(lambda: download_data.parse_dexcom_egvs(egvs, TIMEZONE_NAME), repeat)
+        yield "parse_tandem", _measure(parse_tandem, repeat)
+
+        dexcom_events = download_data.parse_dexcom_egvs(egvs, TIMEZONE_NAME)
+        tandem_events = parse_tandem()
+
+        reading_times = np.unique(dexcom_events[download_data.DataType.TIME])
+        event_times = np.concatenate((
+            tandem_events[download_data.DataType.CGM][download_data.DataType.TIME],
+            np.array([bolus_dict["completion_time"] for bolus_dict in tandem_events[download_data.DataType.BOLUS]], dtype=np.int64)
+        ))
+        yield "add_ranges", _measure(lambda: handle_services.add_ranges_for_datetimes(event_times, RangeIndex.from_readings(reading_times)), repeat)
+
+        yield "merge", _measure(lambda: handle_services.handle_data(tandem_events, dexcom_events), repeat)
+
+        if with_db:
+            full_data = handle_services.handle_data(tandem_events, dexcom_events)
+            yield "save", _measure(lambda: self._save_rolled_back(full_data), repeat)
+
+    def _save_rolled_back(self, full_data):
+        with transaction.atomic():
+            user = models.User.objects.create(uuid=uuid.uuid4(), first_name="Benchmark", last_name="User", last_login=utility.utc_datetime(), current_user_timezone="UTC")
+            sync_services.save_data_to_database(user, full_data)
+            transaction.set_rollback(True)
+
+    def _compare(self, results : typing.List[typing.Dict[str, typing.Any]], previous_path : str):
+        with open(previous_path) as previous_file:
+            previous = json.load(previous_file)
+
+        previous_wall = {(result["days"], result["stage"]): result["wall_seconds_min"] for result in previous["results"]}
+
+        self.stdout.write("Compared to {} ({})".format(previous_path, previous.get("git_commit")))
+        for result in results:
+            key = (result["days"], result["stage"])
+            if key not in previous_wall or previous_wall[key] == 0:
+                continue
+
+            ratio = result["wall_seconds_min"] / previous_wall[key]
+            self.stdout.write("{:>5g}d {:<14} {:>6.2f}x".format(result["days"], result["stage"], ratio))
@@ -0,0 +1,47 @@
+import pathlib
+
+from django.core.management.base import BaseCommand, CommandError
+
+from api.backend import fake_upstream
+
+
+class Command(BaseCommand):
+    help = "Runs a local stand-in for the Dexcom and t:connect services, set UPSTREAM_BASE_URL to its address to use it"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--host", default="127.0.0.1")
+        parser.add_argument("--port", type=int, default=8765)
+        parser.add_argument("--latency-ms", type=float, default=0, help="Delay added to every response")
+        parser.add_argument("--jitter-ms", type=float, default=0, help="Random variation of the delay, in both directions")
+        parser.add_argument("--error-rate", type=float, default=0, help="Chance of a data request answering a 500")
+        parser.add_argument("--csv-max-days", type=int, help="ws2 CSV exports of more days answer a 500")
+        parser.add_argument("--record-padding", type=int, default=0, help="Bytes of filler added to every record")
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--record", type=pathlib.Path, help="Proxies to the live services, saving every response to this directory. Fixtures contain credentials and health data.")
+        parser.add_argument("--replay", type=pathlib.Path, help="Serves the responses saved to this directory by --record")
+
+    def handle(self, *args, **options):
+        if options["record"] is not None and options["replay"] is not None:
+            raise CommandError("--record and --replay are exclusive")
+
+        config = fake_upstream.FakeUpstreamConfig(
+            latency_ms=options["latency_ms"],
+            jitter_ms=options["jitter_ms"],
+            error_rate=options["error_rate"],
+            csv_max_days=options["csv_max_days"],
+            record_padding=options["record_padding"],
+            seed=options["seed"],
+            record_dir=options["record"],
+            replay_dir=options["replay"]
+        )
+
+        server = fake_upstream.make_server(config, options["host"], options["port"])
+        mode = "recording to {}".format(options["record"]) if options["record"] else "replaying {}".format(options["replay"]) if options["replay"] else "synthetic data"
+        self.stdout.write("Fake upstream on http://{}:{}, {}".format(options["host"], options["port"], mode))
+
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
@@ -0,0 +1,49 @@
+import collections
+import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+
+from api.backend import response_cache
+
+
+class Command(BaseCommand):
+    help = "Shows the size of the raw upstream response cache, or purges it"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--user", help="Only the days of this t:connect email or Dexcom user uuid")
+        parser.add_argument("--source", choices=["tconnect_csv", "tconnect_ciq", "dexcom_egvs"])
+        parser.add_argument("--before", type=datetime.date.fromisoformat, help="Only the days before this date (YYYY-MM-DD)")
+        parser.add_argument("--purge", action="store_true", help="Removes the matching days")
+
+    def handle(self, *args, **options):
+        directory = response_cache.cache_dir()
+        if directory is None:
+            raise CommandError("The response cache is disabled, RESPONSE_CACHE_DIR is not set")
+
+        if options["purge"]:
+            purged_count = response_cache.purge(options["user"], options["source"], options["before"])
+            self.stdout.write("Purged {} cached days".format(purged_count))
+            return
+
+        entries = [
+            entry for entry in response_cache.entries(options["user"], options["source"])
+            if options["before"] is None or entry.day < options["before"]
+        ]
+
+        total_bytes = sum(entry.size for entry in entries)
+        self.stdout.write("{}: {} cached days, {:,} of {:,} bytes".format(directory, len(entries), total_bytes, response_cache.max_bytes()))
+
+        source_entries = collections.defaultdict(list)
+        for entry in entries:
+            source_entries[entry.source].append(entry)
+
+        for source, entries in sorted(source_entries.items()):
+            self.stdout.write("{:<14} {:>6} days {:>14,} bytes  {} users  {} - {}  last used {}".format(
+                source,
+                len(entries),
+                sum(entry.size for entry in entries),
+                len(set(entry.user_key for entry in entries)),
+                min(entry.day for entry in entries),
+                max(entry.day for entry in entries),
+                datetime.datetime.fromtimestamp(max(entry.last_used for entry in entries)).isoformat(timespec="seconds")
+            ))
@@ -0,0 +1,33 @@
+import json
+import signal
+import threading
+
+from django.core.management.base import BaseCommand
+
+from api.backend import sync_worker
+
+
+class Command(BaseCommand):
+    help = "Runs the background sync worker, syncing every user with credentials every few minutes. Start several to sync in parallel."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--no-schedule", action="store_true", help="Only runs queued jobs, users are not scheduled by this worker")
+        parser.add_argument("--once", action="store_true", help="Exits when no job is due")
+        parser.add_argument("--name", help="Worker name recorded on its jobs, host:pid by default")
+        parser.add_argument("--stats", action="store_true", help="Prints the queue depth and lag and exits")
+
+    def handle(self, *args, **options):
+        if options["stats"]:
+            self.stdout.write(json.dumps(sync_worker.queue_stats(), indent=2))
+            return
+
+        stop = threading.Event()
+
+        # Stops after the running job
+        def request_stop(signum, frame):
+            stop.set()
+
+        signal.signal(signal.SIGTERM, request_stop)
+        signal.signal(signal.SIGINT, request_stop)
+
+        sync_worker.run_worker(stop, schedule=not options["no_schedule"], once=options["once"], worker=options["name"])
@@ -0,0 +1,33 @@
+# Generated by Django 4.0.4 on 2026-10-18 10:53
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0011_diabetesentry_basel_delivery_type_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='diabetesentry',
+            name='insulin_on_board_last',
+            field=models.FloatField(null=True),
+        ),
+        migrations.AddField(
+            model_name='diabetesentry',
+            name='insulin_on_board_max',
+            field=models.FloatField(null=True),
+        ),
+        migrations.AddField(
+            model_name='diabetesentry',
+            name='insulin_on_board_mean',
+            field=models.FloatField(null=True),
+        ),
+        migrations.AddField(
+            model_name='diabetesentry',
+            name='insulin_on_board_min',
+            field=models.FloatField(null=True),
+        ),
+    ]
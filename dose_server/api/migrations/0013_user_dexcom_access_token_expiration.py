@@ -0,0 +1,18 @@
+# Generated by Django 4.0.4 on 2026-10-18 10:54
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0012_diabetesentry_insulin_on_board_last_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='dexcom_access_token_expiration',
+            field=models.DateTimeField(null=True),
+        ),
+    ]
@@ -0,0 +1,41 @@
+# Generated by Django 4.0.4 on 2026-10-18 11:11
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0013_user_dexcom_access_token_expiration'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SyncJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.TextField(choices=[('queued', 'Queued'), ('running', 'Running'), ('done', 'Done'), ('failed', 'Failed')], default='queued')),
+                ('run_after', models.DateTimeField()),
+                ('created_datetime', models.DateTimeField(auto_now_add=True)),
+                ('started_datetime', models.DateTimeField(null=True)),
+                ('finished_datetime', models.DateTimeField(null=True)),
+                ('worker', models.TextField(null=True)),
+                ('attempts', models.IntegerField(default=0)),
+                ('persisted_count', models.IntegerField(null=True)),
+                ('error', models.TextField(null=True)),
+                ('owner', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='sync_jobs', to='api.user')),
+            ],
+            options={
+                'db_table': 'sync_jobs',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='syncjob',
+            index=models.Index(fields=['status', 'run_after'], name='sync_jobs_status_8e4aed_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='syncjob',
+            index=models.Index(fields=['owner', 'status'], name='sync_jobs_owner_i_b62c92_idx'),
+        ),
+    ]
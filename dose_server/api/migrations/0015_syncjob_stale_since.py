@@ -0,0 +1,33 @@
+# Generated by Django 4.0.4 on 2026-10-18 11:14
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0014_syncjob'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='syncjob',
+            name='sync_jobs_status_8e4aed_idx',
+        ),
+        migrations.AddField(
+            model_name='syncjob',
+            name='stale_since',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='syncjob',
+            name='synced_until',
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.AddIndex(
+            model_name='syncjob',
+            index=models.Index(fields=['status', 'stale_since'], name='sync_jobs_status_252a16_idx'),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 4.0.4 on 2026-10-18 11:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0015_syncjob_stale_since'),
+    ]
+
+    operations = [
+        # Ranges saved twice by concurrent syncs, the latest one is kept
+        migrations.RunSQL(
+            """
+            DELETE FROM api_diabetesentry duplicate
+            USING api_diabetesentry latest
+            WHERE duplicate.owner_id = latest.owner_id
+              AND duplicate.start_datetime = latest.start_datetime
+              AND duplicate.end_datetime = latest.end_datetime
+              AND duplicate.id < latest.id
+            """,
+            migrations.RunSQL.noop
+        ),
+        migrations.AddConstraint(
+            model_name='diabetesentry',
+            constraint=models.UniqueConstraint(fields=('owner', 'start_datetime', 'end_datetime'), name='diabetes_entry_unique_range'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.0.4 on 2026-10-18 11:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0016_diabetesentry_diabetes_entry_unique_range'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='syncjob',
+            name='heartbeat_datetime',
+            field=models.DateTimeField(null=True),
+        ),
+    ]
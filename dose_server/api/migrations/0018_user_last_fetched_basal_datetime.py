@@ -0,0 +1,18 @@
+# Generated by Django 4.0.4 on 2026-10-18 11:46
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0017_syncjob_heartbeat_datetime'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='last_fetched_basal_datetime',
+            field=models.DateTimeField(null=True),
+        ),
+    ]
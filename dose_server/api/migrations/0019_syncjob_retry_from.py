@@ -0,0 +1,18 @@
+# Generated by Django 4.0.4 on 2026-10-18 11:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0018_user_last_fetched_basal_datetime'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='syncjob',
+            name='retry_from',
+            field=models.DateTimeField(null=True),
+        ),
+    ]
@@ -27,6 +27,10 @@ class EntrySerializer(ApiSerializer):
         trend = serializers.CharField()
 
         insulin_on_board = serializers.ListField(child=serializers.FloatField(default=0), default=list)
+        insulin_on_board_last = serializers.FloatField()
+        insulin_on_board_min = serializers.FloatField()
+        insulin_on_board_max = serializers.FloatField()
+        insulin_on_board_mean = serializers.FloatField()
 
         dosed_insulin = serializers.FloatField()
         dose_completion_time = serializers.DateTimeField()
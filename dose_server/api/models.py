@@ -113,6 +113,12 @@ class DiabetesEntry(models.Model):
 
     insulin_on_board = ArrayField(base_field=models.FloatField(default=0), default=list)
 
+    # Summary of insulin_on_board, null without IOB samples
+    insulin_on_board_last = models.FloatField(null=True)
+    insulin_on_board_min = models.FloatField(null=True)
+    insulin_on_board_max = models.FloatField(null=True)
+    insulin_on_board_mean = models.FloatField(null=True)
+
     # Bolus
     dosed_insulin = models.FloatField(default=0, null=True)
     dose_completion_time = models.DateTimeField(null=True)
@@ -125,6 +131,65 @@ class DiabetesEntry(models.Model):
     basel_duration = models.FloatField(default=0, null=True)
     basel_rate = models.FloatField(default=0, null=True)
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["owner", "start_datetime", "end_datetime"], name="diabetes_entry_unique_range")
+        ]
+
+
+class SyncJob(models.Model):
+
+    QUEUED = "queued"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+
+    STATUS_CHOICES = [(QUEUED, "Queued"), (RUNNING, "Running"), (DONE, "Done"), (FAILED, "Failed")]
+
+    owner = models.ForeignKey(
+        'User',
+        on_delete=models.CASCADE,
+        related_name='sync_jobs'
+    )
+
+    status = models.TextField(choices=STATUS_CHOICES, default=QUEUED)
+
+    # Not claimed before this time
+    run_after = models.DateTimeField()
+
+    # Due jobs are claimed oldest first, how far the user's streams were fetched when queued
+    stale_since = models.DateTimeField()
+
+    # End of the last synced slice of a backfill
+    synced_until = models.DateTimeField(null=True)
+
+    # Where the first slice whose sources still failed on its last attempt stopped, the user's cursors are kept there
+    retry_from = models.DateTimeField(null=True)
+
+    created_datetime = models.DateTimeField(auto_now_add=True)
+    started_datetime = models.DateTimeField(null=True)
+    finished_datetime = models.DateTimeField(null=True)
+
+    # Updated by the running worker after every persisted chunk
+    heartbeat_datetime = models.DateTimeField(null=True)
+
+    # Worker process running the job
+    worker = models.TextField(null=True)
+    attempts = models.IntegerField(default=0)
+
+    persisted_count = models.IntegerField(null=True)
+    error = models.TextField(null=True)
+
+    def __str__(self):
+        return "Sync Job {} ({}, {})".format(self.id, self.owner_id, self.status)
+
+    class Meta:
+        db_table = 'sync_jobs'
+        indexes = [
+            models.Index(fields=["status", "stale_since"]),
+            models.Index(fields=["owner", "status"])
+        ]
+
 
 # Create your models here.
 class User(models.Model):
@@ -141,12 +206,15 @@ class User(models.Model):
 
         # The last time the data was fetched
         last_fetched_datetime = models.DateTimeField(auto_now_add=True)
+        # The basal segments are fetched until, behind last_fetched_datetime after syncs without them. None when they are not behind
+        last_fetched_basal_datetime = models.DateTimeField(null=True)
 
         current_user_timezone = models.TextField()
 
         # Api Data
         dexcom_refresh_token = models.TextField(null=True)
         dexcom_access_token = models.TextField(null=True)
+        dexcom_access_token_expiration = models.DateTimeField(null=True)
         tconnect_email = models.TextField(null=True)
         tconnect_password = models.TextField(null=True)
 
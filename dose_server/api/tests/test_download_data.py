@@ -0,0 +1,51 @@
+import arrow
+import numpy as np
+from django.test import SimpleTestCase
+
+from api.backend import download_data
+from api.backend.download_data import DataType
+
+T0 = 1700000000
+
+
+class ClipToWindowTests(SimpleTestCase):
+
+    def tandem_events(self):
+        times = T0 + np.arange(0, 86400, 300)
+        return {
+            DataType.CGM : {DataType.TIME : times, DataType.CGM : np.full(times.size, 120.0)},
+            DataType.BOLUS : [{"completion_time" : T0 + 3600, "insulin" : "1"}, {"completion_time" : T0 + 7200, "insulin" : "2"}],
+            DataType.IOB : {DataType.TIME : times, DataType.IOB : np.ones(times.size)},
+            DataType.BASEL : {
+                DataType.TIME : np.array([T0, T0 + 1800, T0 + 5400]),
+                DataType.BASEL_RATE : np.array([0.5, 0.8, 1.0]),
+                DataType.BASEL_DURATION : np.array([30.0, 60.0, np.nan]),
+                DataType.BASEL_DELIVERY_TYPE : np.array(["a", "b", "c"], dtype=object)
+            }
+        }
+
+    def test_events_outside_the_window_are_dropped(self):
+        dexcom = {DataType.TIME : T0 + np.arange(0, 86400, 300), DataType.CGM : np.full(288, 110.0)}
+        tandem_events, dexcom_data = download_data.clip_to_window(self.tandem_events(), dexcom, arrow.get(T0 + 3000), arrow.get(T0 + 6000))
+
+        self.assertEqual(tandem_events[DataType.CGM][DataType.TIME].tolist(), list(range(T0 + 3000, T0 + 6000, 300)))
+        self.assertEqual(tandem_events[DataType.IOB][DataType.TIME].tolist(), list(range(T0 + 3000, T0 + 6000, 300)))
+        self.assertEqual(dexcom_data[DataType.TIME].tolist(), list(range(T0 + 3000, T0 + 6000, 300)))
+        self.assertEqual([bolus_dict["insulin"] for bolus_dict in tandem_events[DataType.BOLUS]], ["1"])
+
+    def test_running_basal_segment_is_kept(self):
+        tandem_events, _ = download_data.clip_to_window(self.tandem_events(), None, arrow.get(T0 + 3000), arrow.get(T0 + 6000))
+
+        self.assertEqual(tandem_events[DataType.BASEL][DataType.TIME].tolist(), [T0 + 1800, T0 + 5400])
+        self.assertEqual(tandem_events[DataType.BASEL][DataType.BASEL_DELIVERY_TYPE].tolist(), ["b", "c"])
+
+
+class TimezoneTests(SimpleTestCase):
+
+    def test_readings_are_parsed_in_the_given_timezone(self):
+        readings = [{"EventDateTime" : "2023-06-01T08:00:00", "Readings (CGM / BGM)" : "120"}]
+
+        utc_times = download_data.parse_tandem_readings(readings, "UTC")[DataType.TIME]
+        new_york_times = download_data.parse_tandem_readings(readings, "America/New_York")[DataType.TIME]
+
+        self.assertEqual((new_york_times - utc_times).tolist(), [4 * 3600])
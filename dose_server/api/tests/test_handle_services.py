@@ -0,0 +1,89 @@
+import contextlib
+import io
+import uuid
+
+import arrow
+import numpy as np
+from django.test import TestCase
+
+from api import models
+from api.backend import download_data, handle_services, sync_services
+from api.backend.range_index import RANGE_SECONDS
+
+T0 = 1700000000
+
+
+def empty_tandem_events():
+    return {
+        download_data.DataType.CGM : download_data.parse_tandem_readings([], "UTC"),
+        download_data.DataType.BOLUS : download_data.custom_bolus_parse([], "UTC"),
+        download_data.DataType.IOB : download_data.parse_tandem_iob([], "UTC"),
+        download_data.DataType.BASEL : download_data.parse_basal_events([], "UTC")
+    }
+
+def dexcom_events(times : np.ndarray):
+    times = np.asarray(times, dtype=np.int64)
+    return {
+        download_data.DataType.TIME : times,
+        download_data.DataType.CGM : 100.0 + times % 97,
+        download_data.DataType.TREND : np.full(times.size, "flat", dtype=object),
+        download_data.DataType.TREND_RATE : np.zeros(times.size)
+    }
+
+
+class IncrementalMergeTests(TestCase):
+
+    def setUp(self):
+        self.user = models.User.objects.create(uuid=uuid.uuid4(), first_name="Test", last_name="User", last_login=arrow.utcnow().datetime, current_user_timezone="UTC")
+
+    def sync(self, reading_times : np.ndarray):
+        with contextlib.redirect_stdout(io.StringIO()):
+            full_data = handle_services.handle_data(empty_tandem_events(), dexcom_events(reading_times), user=self.user)
+            sync_services.save_data_to_database(self.user, full_data)
+
+    def persisted_ranges(self):
+        entries = models.DiabetesEntry.objects.filter(owner=self.user).order_by("start_datetime")
+        return [(int(entry.start_datetime.timestamp()), int(entry.end_datetime.timestamp()), entry.blood_glucose) for entry in entries]
+
+    def test_reading_inside_the_last_persisted_range(self):
+        # The second reading comes less than RANGE_SECONDS after the first
+        self.sync([T0])
+        self.sync([T0, T0 + 280])
+
+        self.assertEqual(self.persisted_ranges(), [
+            (T0, T0 + 280, 100.0 + T0 % 97),
+            (T0 + 280, T0 + 280 + RANGE_SECONDS, 100.0 + (T0 + 280) % 97)
+        ])
+
+    def test_back_to_back_syncs_keep_every_reading(self):
+        rng = np.random.default_rng(0)
+        reading_times = T0 + np.arange(30) * RANGE_SECONDS + rng.integers(-40, 40, 30)
+
+        for count in range(1, reading_times.size + 1):
+            self.sync(reading_times[max(count - 12, 0):count])
+
+        starts, ends, bgs = zip(*self.persisted_ranges())
+        self.assertEqual(list(starts), reading_times.tolist())
+        self.assertEqual(list(ends[:-1]), list(starts[1:]))
+        self.assertEqual(list(bgs), (100.0 + reading_times % 97).tolist())
+
+    def test_matches_a_full_merge(self):
+        rng = np.random.default_rng(1)
+        reading_times = T0 + np.arange(20) * RANGE_SECONDS + rng.integers(-40, 40, 20)
+
+        self.sync(reading_times[:10])
+        self.sync(reading_times[8:])
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            full_data = handle_services.handle_data(empty_tandem_events(), dexcom_events(reading_times))
+
+        self.assertEqual([(start, end) for start, end, _ in self.persisted_ranges()], list(zip(full_data.starts.tolist(), full_data.ends.tolist())))
+
+    def test_unchanged_entries_are_not_returned(self):
+        reading_times = T0 + np.arange(5) * RANGE_SECONDS
+        self.sync(reading_times)
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            full_data = handle_services.handle_data(empty_tandem_events(), dexcom_events(reading_times), user=self.user)
+
+        self.assertEqual(len(full_data), 0)
@@ -0,0 +1,59 @@
+import io
+import json
+
+from django.test import SimpleTestCase
+
+from api.backend import json_stream
+
+RESPONSE = {
+    "recordType" : "egv",
+    "unit" : {"name" : "mg/dL", "notes" : ["ü", "€ 😀", "\\\"]"]},
+    "records" : [
+        {"systemTime" : "2023-03-01T10:00:00", "value" : 123456789, "trend" : "flat", "trendRate" : -0.125},
+        {"systemTime" : "2023-03-01T10:05:00", "value" : None, "trend" : "déjà vu", "trendRate" : 1e-3},
+        [1, [2, {"3" : "]}"}]],
+        "😀",
+        12,
+        34.5
+    ],
+    "after" : [1, 2]
+}
+
+
+def items(document : str, key : str, chunk_size : int):
+    return list(json_stream.iter_array_items(io.BytesIO(document.encode("utf-8")), key, chunk_size))
+
+
+class IterArrayItemsTests(SimpleTestCase):
+
+    def test_every_chunk_boundary(self):
+        # Chunks split multi byte characters, strings, escapes and numbers at every position
+        document = json.dumps(RESPONSE, ensure_ascii=False, indent=1)
+        for chunk_size in range(1, 40):
+            self.assertEqual(items(document, "records", chunk_size), RESPONSE["records"], chunk_size)
+
+        self.assertEqual(items(document, "records", len(document.encode("utf-8"))), RESPONSE["records"])
+
+    def test_compact_and_escaped_documents(self):
+        for document in (json.dumps(RESPONSE, separators=(",", ":")), json.dumps(RESPONSE)):
+            for chunk_size in (1, 2, 3, 7, 64 * 1024):
+                self.assertEqual(items(document, "records", chunk_size), RESPONSE["records"])
+
+    def test_number_at_the_end_of_a_chunk(self):
+        self.assertEqual(items('{"records":[12345,6]}', "records", 14), [12345, 6])
+
+    def test_empty_and_missing_arrays(self):
+        self.assertEqual(items('{"records" : [ ]}', "records", 1), [])
+        self.assertEqual(items('{ }', "records", 1), [])
+        self.assertEqual(items('{"unit" : "mg/dL"}', "records", 2), [])
+
+    def test_stream_is_not_read_past_the_array(self):
+        stream = io.BytesIO(b'{"records":[1,2],"after":' + b"x" * 1000 + b"}")
+        self.assertEqual(list(json_stream.iter_array_items(stream, "records", 4)), [1, 2])
+        self.assertLess(stream.tell(), 100)
+
+    def test_invalid_documents(self):
+        for document, key in (('[1, 2]', "records"), ('{"records" : [1, 2', "records"), ('{"records" : [1 2]}', "records"),
+                              ('{"records" : [1, 2]', "after"), ('{"records" : [{"value" : }]}', "records")):
+            with self.assertRaises(ValueError):
+                items(document, key, 3)
@@ -0,0 +1,111 @@
+import contextlib
+import io
+
+import numpy as np
+from django.test import SimpleTestCase
+
+from api.backend import download_data, handle_services, merge_engine
+from api.backend.download_data import DataType
+
+DAY = "2023-03-01T"
+
+
+def tandem_events(readings, boluses, iob):
+    return {
+        DataType.CGM : download_data.parse_tandem_readings([{"EventDateTime" : DAY + time, "Readings (CGM / BGM)" : bg} for time, bg in readings], "UTC"),
+        DataType.BOLUS : download_data.custom_bolus_parse(boluses, "UTC"),
+        DataType.IOB : download_data.parse_tandem_iob([{"EventDateTime" : DAY + time, "IOB" : value} for time, value in iob], "UTC"),
+        DataType.BASEL : download_data.parse_basal_events([], "UTC")
+    }
+
+def dexcom_events(readings):
+    return download_data.parse_dexcom_egvs([
+        {"systemTime" : DAY + time, "displayTime" : DAY + time, "value" : bg, "trend" : "flat", "trendRate" : 0.5} for time, bg in readings
+    ], "UTC")
+
+def merged_rows(full_data):
+    return [
+        (row.start_datetime.strftime("%H:%M:%S"), row.end_datetime.strftime("%H:%M:%S"), row.bg, row.iob, row.insulin)
+        for row in full_data.rows()
+    ]
+
+
+class MergeEngineTests(SimpleTestCase):
+
+    def test_first_per_range(self):
+        range_idx = np.array([2, -1, 0, 2, 0, 1, -1, 1])
+        ranges, positions = merge_engine.first_per_range(range_idx)
+
+        expected = {}
+        for position, range_number in enumerate(range_idx.tolist()):
+            if range_number >= 0:
+                expected.setdefault(range_number, position)
+
+        self.assertEqual(dict(zip(ranges.tolist(), positions.tolist())), expected)
+
+    def test_group_and_summarize(self):
+        rng = np.random.default_rng(0)
+        range_idx = rng.integers(-1, 6, 200)
+        values = rng.random(200)
+
+        order, offsets = merge_engine.group_by_range(range_idx, 7)
+        last, minimum, maximum, mean = merge_engine.summarize_groups(values[order], offsets)
+
+        for range_number in range(7):
+            group = values[range_idx == range_number]
+            if group.size == 0:
+                self.assertTrue(np.isnan([last[range_number], minimum[range_number], maximum[range_number], mean[range_number]]).all())
+                continue
+
+            self.assertEqual(values[order[offsets[range_number]:offsets[range_number + 1]]].tolist(), group.tolist())
+            self.assertEqual(last[range_number], group[-1])
+            self.assertEqual(minimum[range_number], group.min())
+            self.assertEqual(maximum[range_number], group.max())
+            self.assertAlmostEqual(mean[range_number], group.mean())
+
+    def test_segment_ends(self):
+        ends = merge_engine.segment_ends(np.array([0, 600, 1200, 3000]), np.array([5.0, np.nan, 10.0, np.nan]))
+        self.assertEqual(ends.tolist(), [300, 1200, 1800, 3000])
+
+    def test_optional_floats(self):
+        self.assertEqual(np.isnan(merge_engine.optional_floats(["1.5", None, "", 2])).tolist(), [False, True, True, False])
+
+
+class BaselineMergeTests(SimpleTestCase):
+    """
+    Merges of small days whose expected entries are the output of the dict based merge handle_data replaced.
+    """
+
+    boluses = [{"BG" : "120", "IOB" : "2.5", "InsulinDelivered" : "3", "RequestDateTime" : DAY + "10:10:30", "CompletionDateTime" : DAY + "10:11:00",
+                "TargetBG" : "110", "Description" : "Standard/Correction"}]
+    iob = [("10:01:00", "1.0"), ("10:06:00", "0.9"), ("10:16:00", "2.4"), ("10:21:00", "2.3"), ("10:31:00", "2.0")]
+
+    def merge(self, tandem_readings, dexcom_readings):
+        with contextlib.redirect_stdout(io.StringIO()):
+            return merged_rows(handle_services.handle_data(tandem_events(tandem_readings, self.boluses, self.iob), dexcom_events(dexcom_readings) if dexcom_readings else None))
+
+    def test_dexcom_readings(self):
+        rows = self.merge(
+            [("10:05:30", 111), ("10:15:00", 125), ("10:20:00", 128)],
+            [("10:00:00", 100), ("10:05:00", 110), ("10:10:00", 120), ("10:25:00", 130), ("10:30:00", 140)]
+        )
+
+        self.assertEqual(rows, [
+            ("10:00:00", "10:05:00", 100.0, [1.0], None),
+            ("10:05:00", "10:10:00", 110.0, [0.9], None),
+            ("10:10:00", "10:25:00", 120.0, [2.5, 2.4, 2.3], 3.0),
+            ("10:25:00", "10:30:00", 130.0, [], None),
+            ("10:30:00", "10:35:00", 140.0, [2.0], None)
+        ])
+
+    def test_tandem_readings_without_dexcom(self):
+        rows = self.merge([("09:52:00", 95), ("10:05:30", 111), ("10:15:00", 125), ("10:20:00", 128), ("10:36:00", 142), ("10:50:00", 150)], None)
+
+        self.assertEqual(rows, [
+            ("09:52:00", "10:05:30", 95.0, [1.0], None),
+            ("10:05:30", "10:15:00", 111.0, [2.5, 0.9], 3.0),
+            ("10:15:00", "10:20:00", 125.0, [2.4], None),
+            ("10:20:00", "10:36:00", 128.0, [2.3, 2.0], None),
+            ("10:36:00", "10:50:00", 142.0, [], None),
+            ("10:50:00", "10:55:00", 150.0, [], None)
+        ])
@@ -0,0 +1,64 @@
+import numpy as np
+from django.test import SimpleTestCase
+
+from api.backend.range_index import RANGE_SECONDS, RangeIndex
+
+
+class RangeIndexTests(SimpleTestCase):
+
+    def test_locate(self):
+        range_index = RangeIndex([100, 400, 1000], [400, 700, 1300])
+
+        self.assertEqual(range_index.locate([50, 100, 399, 400, 699, 700, 999, 1000, 1299, 1300]).tolist(), [-1, 0, 0, 1, 1, -1, -1, 2, 2, -1])
+        self.assertEqual(range_index.locate_one(450), 1)
+        self.assertIsNone(range_index.locate_one(800))
+        self.assertEqual(RangeIndex().locate([100]).tolist(), [-1])
+
+    def test_from_readings(self):
+        range_index = RangeIndex.from_readings([700, 100, 400, 400])
+
+        self.assertEqual(range_index.starts.tolist(), [100, 400, 700])
+        self.assertEqual(range_index.ends.tolist(), [400, 700, 700 + RANGE_SECONDS])
+
+    def test_add_readings_around_existing_ranges(self):
+        range_index = RangeIndex([1000], [1300])
+
+        self.assertEqual(range_index.add_readings([400, 700, 1100, 1500]), 3)
+        self.assertEqual(range_index.starts.tolist(), [400, 700, 1000, 1500])
+        # The reading before an existing range is clipped to its start
+        self.assertEqual(range_index.ends.tolist(), [700, 1000, 1300, 1500 + RANGE_SECONDS])
+
+    def test_add_readings_inside_existing_ranges(self):
+        range_index = RangeIndex([100], [400])
+
+        self.assertEqual(range_index.add_readings([100, 250]), 0)
+        self.assertEqual(len(range_index), 1)
+
+    def test_fill_gaps(self):
+        range_index = RangeIndex([0, 2000], [300, 2300])
+
+        self.assertEqual(range_index.fill_gaps([350, 500, 950, 1900, 2100]), 3)
+        # Slots are anchored on the end of the previous range and clipped to the next one
+        self.assertEqual(range_index.starts.tolist(), [0, 300, 900, 1800, 2000])
+        self.assertEqual(range_index.ends.tolist(), [300, 600, 1200, 2000, 2300])
+        self.assertTrue(range_index.contains([350, 500, 950, 1900, 2100]).all())
+
+    def test_fill_gaps_without_ranges(self):
+        range_index = RangeIndex()
+
+        self.assertEqual(range_index.fill_gaps([100]), 0)
+        self.assertEqual(len(range_index), 0)
+
+    def test_latest_overlapping(self):
+        range_index = RangeIndex([0, 300, 600], [300, 600, 900])
+        segment_idx = range_index.latest_overlapping(np.array([-100, 350, 400, 950]), np.array([50, 400, 400, 1000]))
+
+        # The zero length segment at 400 is later than the one starting at 350
+        self.assertEqual(segment_idx.tolist(), [0, 2, -1])
+
+    def test_end_open_ranges(self):
+        range_index = RangeIndex([0, 300, 1000], [300, 600, 1300])
+
+        moved_starts = range_index.end_open_ranges([0, 300, 480, 1000, 1500])
+        self.assertEqual(moved_starts.tolist(), [300, 1000])
+        self.assertEqual(range_index.ends.tolist(), [300, 480, 1500])
@@ -0,0 +1,94 @@
+from unittest import mock
+
+from django.test import SimpleTestCase
+
+from api.backend import rate_limits
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = []
+
+    def monotonic(self) -> float:
+        return self.now
+
+    def sleep(self, seconds : float):
+        self.slept.append(seconds)
+        self.now += seconds
+
+
+class TokenBucketTests(SimpleTestCase):
+
+    def test_burst_then_rate(self):
+        bucket = rate_limits.TokenBucket(2.0, 3)
+        bucket.updated = 0.0
+
+        self.assertEqual([bucket.reserve(0.0) for _ in range(3)], [0.0, 0.0, 0.0])
+        # Reserved tokens queue up behind each other
+        self.assertEqual(bucket.reserve(0.0), 0.5)
+        self.assertEqual(bucket.reserve(0.0), 1.0)
+        self.assertEqual(bucket.reserve(1.0), 0.5)
+
+    def test_refill_is_capped_at_the_burst(self):
+        bucket = rate_limits.TokenBucket(1.0, 2)
+        bucket.updated = 0.0
+
+        bucket.reserve(100.0)
+        bucket.reserve(100.0)
+        self.assertEqual(bucket.reserve(100.0), 1.0)
+
+    def test_drain(self):
+        bucket = rate_limits.TokenBucket(2.0, 4)
+        bucket.updated = 0.0
+
+        bucket.drain(0.0, 10)
+        self.assertEqual(bucket.reserve(0.0), 10.5)
+        self.assertEqual(bucket.reserve(10.5), 0.5)
+
+
+class RateLimiterTests(SimpleTestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        patch = mock.patch.object(rate_limits, "time", self.clock)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+        self.limiter = rate_limits.RateLimiter({"api.dexcom.com" : (10.0, 2)}, account_limit=(1.0, 1))
+
+    def test_host_and_account_limits(self):
+        self.assertEqual(self.limiter.acquire("api.dexcom.com", "a"), 0.0)
+        self.assertEqual(self.limiter.acquire("api.dexcom.com", "b"), 0.0)
+        # The host bucket is empty
+        self.assertAlmostEqual(self.limiter.acquire("api.dexcom.com", "c"), 0.1)
+        # The account bucket of a is empty
+        self.assertAlmostEqual(self.limiter.acquire("api.dexcom.com", "a"), 0.9)
+        # Another host has the default limits
+        self.assertEqual(self.limiter.acquire("tconnect.example.com", "a"), 0.0)
+
+        stats = self.limiter.stats()
+        self.assertEqual(stats["api.dexcom.com"]["requests"], 4)
+        self.assertEqual(stats["api.dexcom.com"]["waits"], 2)
+        self.assertEqual(stats["tconnect.example.com"]["requests"], 1)
+        self.assertEqual(len(self.clock.slept), 2)
+
+    def test_throttled_host_waits_for_retry_after(self):
+        for retry_after, expected_seconds in (("12", 12.0), (None, rate_limits.DEFAULT_RETRY_AFTER_SECONDS), ("Wed, 21 Oct 2015 07:28:00 GMT", rate_limits.DEFAULT_RETRY_AFTER_SECONDS)):
+            limiter = rate_limits.RateLimiter({"api.dexcom.com" : (10.0, 2)}, account_limit=(100.0, 100))
+            with self.assertLogs("dose-logger", "WARNING"):
+                limiter.throttled("api.dexcom.com", retry_after)
+
+            self.assertAlmostEqual(limiter.acquire("api.dexcom.com", "a"), expected_seconds + 0.1)
+            self.assertEqual(limiter.stats()["api.dexcom.com"]["throttled"], 1)
+
+    def test_idle_account_buckets_are_dropped(self):
+        self.limiter.acquire("api.dexcom.com", "a")
+        self.clock.now += rate_limits.ACCOUNT_BUCKET_IDLE_SECONDS + 1
+        self.limiter.acquire("api.dexcom.com", "b")
+
+        self.assertEqual(list(self.limiter._account_buckets), [("api.dexcom.com", "b")])
+
+    def test_url_host(self):
+        self.assertEqual(rate_limits.url_host("https://api.dexcom.com/v3/users/self/egvs?startDate=x"), "api.dexcom.com")
@@ -0,0 +1,34 @@
+import datetime
+import pathlib
+import stat
+import tempfile
+
+from django.test import SimpleTestCase, override_settings
+
+from api.backend import response_cache
+
+DAY = datetime.date(2023, 3, 1)
+
+
+class ResponseCacheTests(SimpleTestCase):
+
+    def setUp(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.cache_dir = pathlib.Path(temp_dir.name) / "response_cache"
+
+    def test_disabled_without_a_directory(self):
+        with override_settings(RESPONSE_CACHE_DIR=None):
+            response_cache.put("user@example.com", "dexcom_egvs", DAY, [{"value" : 120}])
+            self.assertIsNone(response_cache.get("user@example.com", "dexcom_egvs", DAY))
+            self.assertEqual(response_cache.entries(), [])
+
+    def test_cached_days_are_private(self):
+        with override_settings(RESPONSE_CACHE_DIR=self.cache_dir):
+            response_cache.put("user@example.com", "dexcom_egvs", DAY, [{"value" : 120}])
+            self.assertEqual(response_cache.get("user@example.com", "dexcom_egvs", DAY), [{"value" : 120}])
+
+            entry, = response_cache.entries()
+            self.assertEqual(stat.S_IMODE(entry.path.stat().st_mode), response_cache.FILE_MODE)
+            for directory in (self.cache_dir, entry.path.parent.parent, entry.path.parent):
+                self.assertEqual(stat.S_IMODE(directory.stat().st_mode), response_cache.DIRECTORY_MODE)
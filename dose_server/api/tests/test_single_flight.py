@@ -0,0 +1,107 @@
+import datetime
+import threading
+import time
+
+import arrow
+from django.test import SimpleTestCase
+
+from api.backend import single_flight
+
+T0 = arrow.get(1700000000)
+HOUR = datetime.timedelta(hours=1)
+STREAMS = frozenset({"cgm", "bolus"})
+TIMEOUT = 5
+
+
+class SingleFlightTests(SimpleTestCase):
+
+    def setUp(self):
+        self.flights = single_flight.SingleFlight()
+        self.release = threading.Event()
+        self.started = threading.Event()
+        self.calls = []
+
+    def blocking_call(self, result):
+        def call():
+            self.calls.append(result)
+            self.started.set()
+            self.release.wait(TIMEOUT)
+            return result
+        return call
+
+    def run_in_thread(self, *args):
+        outcome = {}
+
+        def target():
+            try:
+                outcome["value"] = self.flights.run(*args)
+            except Exception as e:
+                outcome["error"] = e
+
+        thread = threading.Thread(target=target)
+        thread.start()
+        return thread, outcome
+
+    def wait_for_counts(self, **counts):
+        deadline = datetime.datetime.now() + datetime.timedelta(seconds=TIMEOUT)
+        while any(self.flights.counts[name] < count for name, count in counts.items()):
+            self.assertLess(datetime.datetime.now(), deadline)
+            time.sleep(0.001)
+
+    def test_covered_sync_joins_the_flight(self):
+        first, first_outcome = self.run_in_thread("user", T0, T0 + HOUR, STREAMS, self.blocking_call("first"))
+        self.assertTrue(self.started.wait(TIMEOUT))
+
+        second, second_outcome = self.run_in_thread("user", T0 + HOUR / 2, T0 + HOUR + single_flight.END_TOLERANCE / 2, frozenset({"cgm"}), self.blocking_call("second"))
+        self.wait_for_counts(joined=1)
+        self.release.set()
+        first.join(TIMEOUT)
+        second.join(TIMEOUT)
+
+        self.assertEqual(first_outcome["value"], ("first", False))
+        self.assertEqual(second_outcome["value"], ("first", True))
+        self.assertEqual(self.calls, ["first"])
+        self.assertEqual(self.flights.in_flight(), 0)
+
+    def test_uncovered_sync_runs_after_the_flight(self):
+        first, _ = self.run_in_thread("user", T0, T0 + HOUR, STREAMS, self.blocking_call("first"))
+        self.assertTrue(self.started.wait(TIMEOUT))
+
+        # A later window and a stream the flight does not download
+        later, later_outcome = self.run_in_thread("user", T0, T0 + 2 * HOUR, STREAMS, self.blocking_call("later"))
+        wider, wider_outcome = self.run_in_thread("user", T0, T0 + HOUR, STREAMS | {"basal"}, self.blocking_call("wider"))
+        self.wait_for_counts(waited=2)
+        self.assertEqual(self.calls, ["first"])
+
+        self.release.set()
+        for thread in (first, later, wider):
+            thread.join(TIMEOUT)
+
+        self.assertEqual(later_outcome["value"], ("later", False))
+        self.assertEqual(wider_outcome["value"], ("wider", False))
+        self.assertEqual(sorted(self.calls), ["first", "later", "wider"])
+
+    def test_other_keys_run_concurrently(self):
+        first, _ = self.run_in_thread("user", T0, T0 + HOUR, STREAMS, self.blocking_call("first"))
+        self.assertTrue(self.started.wait(TIMEOUT))
+
+        self.assertEqual(self.flights.run("other user", T0, T0 + HOUR, STREAMS, lambda: "other"), ("other", False))
+        self.release.set()
+        first.join(TIMEOUT)
+
+    def test_joined_sync_shares_the_error(self):
+        def failing_call():
+            self.started.set()
+            self.release.wait(TIMEOUT)
+            raise RuntimeError("upstream down")
+
+        first, first_outcome = self.run_in_thread("user", T0, T0 + HOUR, STREAMS, failing_call)
+        self.assertTrue(self.started.wait(TIMEOUT))
+        second, second_outcome = self.run_in_thread("user", T0, T0 + HOUR, STREAMS, self.blocking_call("second"))
+        self.wait_for_counts(joined=1)
+        self.release.set()
+        first.join(TIMEOUT)
+        second.join(TIMEOUT)
+
+        self.assertIs(second_outcome["error"], first_outcome["error"])
+        self.assertEqual(self.flights.in_flight(), 0)
@@ -0,0 +1,65 @@
+import contextlib
+import datetime
+import io
+import uuid
+from unittest import mock
+
+import arrow
+import numpy as np
+from django.test import TestCase
+
+from api import models
+from api.backend import download_data, sync_services
+from api.tests.test_handle_services import T0, dexcom_events, empty_tandem_events
+
+
+class SyncCursorTests(TestCase):
+
+    def setUp(self):
+        self.user = models.User.objects.create(uuid=uuid.uuid4(), first_name="Test", last_name="User", last_login=arrow.utcnow().datetime, current_user_timezone="UTC")
+        self.user.last_fetched_datetime = arrow.get(T0).datetime
+        self.user.save()
+
+        self.downloaded_windows = []
+        self.failed_sources = []
+
+        patches = [
+            mock.patch.object(sync_services.tconnect_sessions.pool, "get", return_value=None),
+            mock.patch.object(sync_services.download_data, "download_all_data", side_effect=self.download_all_data)
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def download_all_data(self, user, tconnect, time_start, time_end, plan):
+        self.downloaded_windows.append((int(time_start.timestamp()), int(time_end.timestamp()), plan))
+        reading_times = np.arange(int(time_start.timestamp()), int(time_end.timestamp()), 300)
+        return empty_tandem_events(), dexcom_events(reading_times), list(self.failed_sources)
+
+    def sync(self, hours : int, plan : download_data.DownloadPlan):
+        time_start = arrow.get(sync_services.fetched_until(self.user, plan))
+        with contextlib.redirect_stdout(io.StringIO()):
+            list(sync_services.iter_sync_chunks(self.user, time_start, time_start + datetime.timedelta(hours=hours), plan=plan))
+
+    def test_partial_plan_advances_its_streams(self):
+        self.sync(2, download_data.INSULIN_PLAN)
+        self.sync(2, download_data.INSULIN_PLAN)
+
+        self.assertEqual(self.downloaded_windows[1][0], T0 + 7200)
+        self.assertEqual(sync_services.fetched_until(self.user, download_data.INSULIN_PLAN), arrow.get(T0 + 4 * 3600).datetime)
+        self.assertEqual(sync_services.fetched_until(self.user), arrow.get(T0).datetime)
+
+    def test_full_sync_resumes_from_the_basal_segments(self):
+        self.sync(2, download_data.INSULIN_PLAN)
+        self.sync(3, download_data.SYNC_PLAN)
+
+        self.assertEqual(self.downloaded_windows[1][:2], (T0, T0 + 3 * 3600))
+        self.assertIsNone(self.user.last_fetched_basal_datetime)
+        self.assertEqual(sync_services.fetched_until(self.user), arrow.get(T0 + 3 * 3600).datetime)
+
+    def test_failed_source_keeps_the_cursor(self):
+        self.failed_sources = ["tconnect_csv"]
+        self.sync(2, download_data.SYNC_PLAN)
+
+        self.user.refresh_from_db()
+        self.assertEqual(sync_services.fetched_until(self.user), arrow.get(T0).datetime)
@@ -0,0 +1,72 @@
+import contextlib
+import datetime
+import io
+import uuid
+from unittest import mock
+
+import arrow
+from django.test import TestCase
+
+from api import models
+from api.backend import sync_services, sync_worker
+
+
+class RunJobTests(TestCase):
+
+    def setUp(self):
+        self.now = arrow.utcnow()
+        self.user = models.User.objects.create(uuid=uuid.uuid4(), first_name="Test", last_name="User", last_login=self.now.datetime, current_user_timezone="UTC",
+                                               dexcom_refresh_token="token", tconnect_email="user@example.com", tconnect_password="password")
+        self.user.last_fetched_datetime = (self.now - datetime.timedelta(days=8)).datetime
+        self.user.save()
+
+        self.job, _ = sync_worker.enqueue(self.user)
+        self.synced_windows = []
+        self.failing_slices = set()
+
+        patch = mock.patch.object(sync_worker.sync_services, "sync_user_window", side_effect=self.sync_user_window)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def sync_user_window(self, user, utc_time_start, utc_time_end, plan, on_chunk=None):
+        # Every slice persists its first day, failing slices stop there
+        slice_number = len({window[0] for window in self.synced_windows})
+        self.synced_windows.append((utc_time_start, utc_time_end))
+        failed = slice_number in self.failing_slices
+
+        user.last_fetched_datetime = (utc_time_start + datetime.timedelta(days=1) if failed else utc_time_end).datetime
+        user.save()
+        return sync_services.SyncResult(0, ["tconnect_ciq"] if failed else [])
+
+    def run_slices(self):
+        # Runs the job until it is done, every run being its last attempt
+        while True:
+            self.job.refresh_from_db()
+            if self.job.status == models.SyncJob.DONE:
+                return
+
+            self.job.status = models.SyncJob.RUNNING
+            self.job.worker = "worker"
+            self.job.attempts = sync_worker.MAX_ATTEMPTS
+            self.job.save()
+            with contextlib.redirect_stdout(io.StringIO()):
+                sync_worker.run_job(self.job)
+
+    def test_complete_backfill_moves_the_cursor_to_now(self):
+        self.run_slices()
+
+        self.user.refresh_from_db()
+        self.assertEqual(len(self.synced_windows), 4)
+        self.assertGreaterEqual(self.user.last_fetched_datetime, self.now.datetime)
+        self.assertIsNone(self.job.retry_from)
+
+    def test_cursor_stays_at_a_slice_left_behind(self):
+        self.failing_slices = {1}
+        self.run_slices()
+
+        self.user.refresh_from_db()
+        failed_slice_start = self.synced_windows[1][0]
+        self.assertEqual(len(self.synced_windows), 4)
+        self.assertEqual(self.job.retry_from, (failed_slice_start + datetime.timedelta(days=1)).datetime)
+        self.assertEqual(self.user.last_fetched_datetime, self.job.retry_from)
+        self.assertIsNotNone(self.job.error)
@@ -0,0 +1,65 @@
+import datetime
+
+import numpy as np
+from django.test import SimpleTestCase
+
+from api.backend.timeline import Timeline
+
+
+def sample_timeline() -> Timeline:
+    timeline = Timeline(np.arange(5) * 300, np.arange(1, 6) * 300)
+    timeline.entry_ids[:] = [10, 11, -1, 13, -1]
+    timeline.bg[:] = [100.0, np.nan, 120.0, 130.0, 140.0]
+    timeline.insulin[3] = 2.5
+    timeline.completion_time[3] = 1000
+    timeline.is_manual[3] = 1
+    timeline.basel_time[1] = 200
+    timeline.basel_delivery_type[1] = "algorithmDelivery"
+    # Rows 0 and 3 have two samples, row 2 has none
+    timeline.set_iob(np.array([0, 1, 3, 0, -1, 4, 3]), np.array([1.0, 2.0, 3.0, 4.0, 9.0, 5.0, 6.0]))
+    return timeline
+
+
+class TimelineTakeTests(SimpleTestCase):
+
+    def assertRowsEqual(self, subset : Timeline, timeline : Timeline, indices):
+        self.assertEqual(subset.starts.tolist(), timeline.starts[indices].tolist())
+        self.assertEqual(subset.entry_ids.tolist(), timeline.entry_ids[indices].tolist())
+        self.assertEqual([subset.iob(row) for row in range(len(subset))], [timeline.iob(row) for row in indices])
+        rows = list(timeline.rows())
+        self.assertEqual(list(subset.rows()), [rows[row] for row in indices])
+
+    def test_mask(self):
+        timeline = sample_timeline()
+        subset = timeline.take(np.array([True, False, False, True, True]))
+
+        self.assertRowsEqual(subset, timeline, [0, 3, 4])
+        self.assertEqual(subset.iob_values.tolist(), [1.0, 4.0, 3.0, 6.0, 5.0])
+        self.assertEqual(subset.iob_offsets.tolist(), [0, 2, 4, 5])
+
+    def test_indices_in_any_order(self):
+        timeline = sample_timeline()
+        subset = timeline.take(np.array([4, 2, 0, 0]))
+
+        self.assertRowsEqual(subset, timeline, [4, 2, 0, 0])
+        self.assertEqual([row.bg for row in subset.rows()], [140.0, 120.0, 100.0, 100.0])
+
+    def test_empty(self):
+        subset = sample_timeline().take(np.zeros(5, dtype=bool))
+
+        self.assertEqual(len(subset), 0)
+        self.assertEqual(subset.iob_offsets.tolist(), [0])
+        self.assertEqual(list(subset.rows()), [])
+
+    def test_rows(self):
+        rows = list(sample_timeline().rows())
+
+        self.assertIsNone(rows[1].bg)
+        self.assertIsNone(rows[2].entry_id)
+        self.assertEqual(rows[3].iob, [3.0, 6.0])
+        self.assertEqual((rows[3].iob_last, rows[3].iob_min, rows[3].iob_max, rows[3].iob_mean), (6.0, 3.0, 6.0, 4.5))
+        self.assertIsNone(rows[2].iob_last)
+        self.assertEqual(rows[3].completion_time, datetime.datetime.fromtimestamp(1000, tz=datetime.timezone.utc))
+        self.assertIsNone(rows[0].completion_time)
+        self.assertEqual((rows[3].is_manual, rows[0].is_manual), (True, None))
+        self.assertEqual(rows[1].basel_delivery_type, "algorithmDelivery")
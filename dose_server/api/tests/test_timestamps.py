@@ -0,0 +1,49 @@
+import datetime
+
+import arrow
+from django.test import SimpleTestCase
+
+from api.backend import timestamps
+
+
+def minutes_around(local_datetime : datetime.datetime, hours : int = 3):
+    # Wall clock timestamps every minute around a local time
+    for minute in range(-hours * 60, hours * 60):
+        yield (local_datetime + datetime.timedelta(minutes=minute)).strftime("%Y-%m-%dT%H:%M:%S")
+
+
+class ParseLocalTimestampTests(SimpleTestCase):
+
+    def assertMatchesArrow(self, timestamps_list, timezone_name : str):
+        for timestamp in timestamps_list:
+            self.assertEqual(timestamps.parse_local_timestamp(timestamp, timezone_name), int(arrow.get(timestamp, tzinfo=timezone_name).timestamp()), timestamp)
+
+    def test_spring_forward(self):
+        # 02:00 to 03:00 does not exist
+        self.assertMatchesArrow(minutes_around(datetime.datetime(2023, 3, 12, 2, 30)), "America/New_York")
+        self.assertMatchesArrow(minutes_around(datetime.datetime(2023, 3, 26, 1, 30)), "Europe/London")
+
+    def test_fall_back(self):
+        # 01:00 to 02:00 happens twice
+        self.assertMatchesArrow(minutes_around(datetime.datetime(2023, 11, 5, 1, 30)), "America/New_York")
+        self.assertMatchesArrow(minutes_around(datetime.datetime(2023, 10, 29, 1, 30)), "Europe/London")
+
+    def test_half_hour_changes(self):
+        # Lord Howe Island moves its clocks by 30 minutes
+        self.assertMatchesArrow(minutes_around(datetime.datetime(2023, 4, 2, 1, 45)), "Australia/Lord_Howe")
+        self.assertMatchesArrow(minutes_around(datetime.datetime(2023, 10, 1, 2, 15)), "Australia/Lord_Howe")
+
+    def test_fraction_and_offset_are_ignored(self):
+        expected = timestamps.parse_local_timestamp("2023-07-01T12:00:00", "America/New_York")
+
+        self.assertEqual(timestamps.parse_local_timestamp("2023-07-01T12:00:00.250", "America/New_York"), expected)
+        self.assertEqual(timestamps.parse_local_timestamp("2023-07-01 12:00:00", "America/New_York"), expected)
+        self.assertEqual(timestamps.parse_local_timestamp("2023-07-01T12:00:00-07:00", "America/New_York"), expected)
+
+    def test_other_formats_fall_back_to_arrow(self):
+        self.assertMatchesArrow(["2023-07-01T12:00", "2023-07-01"], "Asia/Kolkata")
+
+    def test_optional_and_many(self):
+        self.assertIsNone(timestamps.optional_local_timestamp("", "UTC"))
+        self.assertIsNone(timestamps.optional_local_timestamp(None, "UTC"))
+        self.assertEqual(timestamps.parse_local_timestamps(["1970-01-01T00:00:00", "1970-01-02T00:00:00"], "UTC").tolist(), [0, 86400])
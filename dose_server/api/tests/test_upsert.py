@@ -0,0 +1,107 @@
+import contextlib
+import io
+import unittest
+import uuid
+from unittest import mock
+
+import arrow
+import numpy as np
+from django.db import IntegrityError, connection, transaction
+from django.db.migrations.executor import MigrationExecutor
+from django.test import TestCase, TransactionTestCase
+
+from api import models
+from api.backend import sync_services
+from api.backend.timeline import Timeline
+
+T0 = 1700000000
+
+BEFORE_DEDUP = [("api", "0015_syncjob_stale_since")]
+DEDUP = [("api", "0016_diabetesentry_diabetes_entry_unique_range")]
+
+
+def create_user() -> models.User:
+    return models.User.objects.create(uuid=uuid.uuid4(), first_name="Test", last_name="User", last_login=arrow.utcnow().datetime, current_user_timezone="UTC")
+
+def day_timeline(bg : float, range_count : int = 12) -> Timeline:
+    timeline = Timeline(T0 + np.arange(range_count) * 300, T0 + np.arange(1, range_count + 1) * 300)
+    timeline.bg[:] = bg
+    timeline.set_iob(np.arange(range_count), np.full(range_count, bg / 100))
+    return timeline
+
+
+class UpsertTests(TestCase):
+
+    def setUp(self):
+        self.user = create_user()
+
+    def save(self, timeline : Timeline) -> sync_services.SaveResult:
+        with contextlib.redirect_stdout(io.StringIO()):
+            return sync_services.save_data_to_database(self.user, timeline)
+
+    def persisted(self):
+        return list(models.DiabetesEntry.objects.filter(owner=self.user).order_by("start_datetime").values_list("blood_glucose", "insulin_on_board"))
+
+    def test_saving_a_range_again_updates_it(self):
+        self.save(day_timeline(100.0))
+        self.save(day_timeline(150.0))
+
+        self.assertEqual(self.persisted(), [(150.0, [1.5])] * 12)
+
+    def test_last_entry_of_a_range_wins(self):
+        timeline = day_timeline(100.0, 1).take(np.array([0, 0]))
+        timeline.bg[1] = 120.0
+        self.save(timeline)
+
+        self.assertEqual(self.persisted(), [(120.0, [1.0])])
+
+    def test_batches(self):
+        with mock.patch.object(sync_services, "UPSERT_BATCH_SIZE", 5):
+            self.save(day_timeline(100.0))
+
+        self.assertEqual(len(self.persisted()), 12)
+
+    @unittest.skipUnless(connection.vendor == "postgresql", "ArrayField is Postgres only")
+    def test_ranges_are_unique(self):
+        self.save(day_timeline(100.0, 1))
+
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            models.DiabetesEntry.objects.create(owner=self.user, start_datetime=arrow.get(T0).datetime, end_datetime=arrow.get(T0 + 300).datetime)
+
+    @unittest.skipUnless(connection.vendor == "postgresql", "RETURNING xmax is Postgres only")
+    def test_inserted_and_updated_counts(self):
+        self.assertEqual(self.save(day_timeline(100.0)), sync_services.SaveResult(12, 0))
+        self.assertEqual(self.save(day_timeline(100.0, 14)), sync_services.SaveResult(2, 12))
+
+
+@unittest.skipUnless(connection.vendor == "postgresql", "The migration deletes the duplicates with Postgres' DELETE ... USING")
+class DedupMigrationTests(TransactionTestCase):
+
+    def migrate(self, targets):
+        executor = MigrationExecutor(connection)
+        executor.loader.build_graph()
+        executor.migrate(targets)
+        return executor.loader.project_state(targets).apps
+
+    def tearDown(self):
+        executor = MigrationExecutor(connection)
+        self.migrate(executor.loader.graph.leaf_nodes("api"))
+
+    def test_latest_duplicate_is_kept(self):
+        apps = self.migrate(BEFORE_DEDUP)
+        User = apps.get_model("api", "User")
+        DiabetesEntry = apps.get_model("api", "DiabetesEntry")
+
+        user = User.objects.create(uuid=uuid.uuid4(), first_name="Test", last_name="User", last_login=arrow.utcnow().datetime, current_user_timezone="UTC")
+        other_user = User.objects.create(uuid=uuid.uuid4(), first_name="Other", last_name="User", last_login=arrow.utcnow().datetime, current_user_timezone="UTC")
+        start, end = arrow.get(T0).datetime, arrow.get(T0 + 300).datetime
+
+        duplicate_ids = [DiabetesEntry.objects.create(owner=user, start_datetime=start, end_datetime=end, blood_glucose=bg).id for bg in (100.0, 110.0, 120.0)]
+        next_range = DiabetesEntry.objects.create(owner=user, start_datetime=end, end_datetime=arrow.get(T0 + 600).datetime)
+        other_range = DiabetesEntry.objects.create(owner=other_user, start_datetime=start, end_datetime=end)
+
+        apps = self.migrate(DEDUP)
+        DiabetesEntry = apps.get_model("api", "DiabetesEntry")
+
+        self.assertEqual(sorted(DiabetesEntry.objects.values_list("id", flat=True)), sorted([duplicate_ids[-1], next_range.id, other_range.id]))
+        self.assertEqual(DiabetesEntry.objects.get(id=duplicate_ids[-1]).blood_glucose, 120.0)
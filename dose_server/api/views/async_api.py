@@ -0,0 +1,83 @@
+"""
+Async counterparts of DRF's @api_view for the views served under ASGI.
+
+DRF views are sync only, an async view authenticates the JWT, parses the JSON body and answers
+errors the same way here. The ORM and the upstream clients are blocking, they run on a bounded pool
+of threads with run_blocking so the event loop keeps serving the other requests meanwhile.
+"""
+
+import asyncio
+import concurrent.futures
+import contextvars
+import functools
+import json
+import typing
+
+from django import db
+from django.http import HttpRequest, HttpResponseNotAllowed
+from django.http.response import JsonResponse
+
+from rest_framework import exceptions
+from rest_framework_simplejwt.authentication import JWTAuthentication
+
+from api import models
+
+MAX_WORKERS = 32
+
+_executor = concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix="async-view")
+
+_authentication = JWTAuthentication()
+
+
+def _run_closing_connections(call : typing.Callable[..., typing.Any], *args, **kwargs) -> typing.Any:
+    try:
+        return call(*args, **kwargs)
+    finally:
+        # Database connections are per thread, the request's cleanup only closes those of its own thread
+        db.connections.close_all()
+
+async def run_blocking(call : typing.Callable[..., typing.Any], *args, **kwargs) -> typing.Any:
+    """
+    Runs blocking code on the pool in a copy of the caller's context, so its spans are recorded for the request.
+    """
+    context = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(_executor, functools.partial(context.run, _run_closing_connections, call, *args, **kwargs))
+
+def _authenticated_user(request : HttpRequest) -> models.User:
+    login = _authentication.authenticate(request)
+    if login is None:
+        raise exceptions.NotAuthenticated()
+
+    login_data, _ = login
+    return login_data.user
+
+def _error_response(error : exceptions.APIException) -> JsonResponse:
+    # Same body as DRF's exception handler
+    detail = error.detail if isinstance(error.detail, (dict, list)) else {"detail": error.detail}
+    return JsonResponse(detail, status=error.status_code, safe=False)
+
+def async_api_view(view : typing.Callable[[HttpRequest, models.User, typing.Dict[str, typing.Any]], typing.Awaitable[typing.Any]]):
+    """
+    POST only, JWT authenticated and CSRF exempt like @api_view(['POST']) with the default permissions.
+    The view is called with the request, the authenticated models.User and the parsed JSON body.
+    """
+    @functools.wraps(view)
+    async def wrapped_view(request : HttpRequest):
+        if request.method != "POST":
+            return HttpResponseNotAllowed(["POST"])
+
+        try:
+            user = await run_blocking(_authenticated_user, request)
+        except exceptions.APIException as e:
+            return _error_response(e)
+
+        try:
+            request_dict = json.loads(request.body)
+        except ValueError as e:
+            return _error_response(exceptions.ParseError("JSON parse error - {}".format(e)))
+
+        return await view(request, user, request_dict)
+
+    # django.views.decorators.csrf.csrf_exempt wraps async views in a sync function before Django 5.0
+    wrapped_view.csrf_exempt = True
+    return wrapped_view
@@ -1,11 +1,11 @@
-import imp
 import uuid
 import pytz
 
+from django.conf import settings
 from django.db import models as dj_models
 
 from django.http.response import JsonResponse
-from django.http import HttpResponse
+from django.http import HttpRequest, HttpResponse
 import rest_framework as rest
 
 from rest_framework.decorators import api_view, permission_classes
@@ -14,21 +14,27 @@ from rest_framework.permissions import AllowAny
 from api import models, model_serializers
 
 from api import utility
+from api.views import async_api
 from api.backend import download_data
-from api.backend import handle_services
+from api.backend import spans
+from api.backend import sync_lease
+from api.backend import sync_services
+from api.backend import sync_worker
+from api.backend import tconnect_sessions
 
 import datetime
 import arrow
 import typing
 
-from tconnectsync.secret import TIMEZONE_NAME
-from tconnectsync import secret
-
-from tconnectsync.api import TConnectApi
 
 import logging
 logger = logging.getLogger('dose-logger')
 
+# Streams downloaded by each endpoint when it syncs inside the request (BACKGROUND_SYNC off),
+# the sync worker always downloads every stream. Only get_all_data persists complete entries
+GET_ALL_DATA_PLAN = download_data.SYNC_PLAN
+CALCULATE_INSULIN_PLAN = download_data.INSULIN_PLAN
+
 
 @api_view(['POST'])
 def update_credentials(request : rest.request.Request):
@@ -42,6 +48,9 @@ def update_credentials(request : rest.request.Request):
 
     if dexcom_refresh_token is not None:
         user.dexcom_refresh_token = dexcom_refresh_token
+        # The access token belongs to the previous refresh token
+        user.dexcom_access_token = None
+        user.dexcom_access_token_expiration = None
 
     if tconnect_email is not None:
         user.tconnect_email = tconnect_email
@@ -51,62 +60,38 @@ def update_credentials(request : rest.request.Request):
 
     user.save()
 
-    return JsonResponse(utility.format_response_dict())
-
-
-def fetch_all_data(user : models.User, utc_time_start : arrow.Arrow, utc_time_end : arrow.Arrow) -> typing.Dict[typing.Tuple[arrow.Arrow], typing.Dict[str, typing.Any]]:
-        # Start Data Downloads
-        secret.TIMEZONE_NAME = user.current_user_timezone
-        # TConnect
-        tconnect = TConnectApi(user.tconnect_email, user.tconnect_password)    
-
-        tandem_events = download_data.download_tconnect_data(tconnect, utc_time_start, utc_time_end)
-        dexcom_data = download_data.download_dexcom_data(user, utc_time_start, utc_time_end)
-
-        full_data = handle_services.handle_data(tandem_events, dexcom_data)
+    if tconnect_email is not None or tconnect_password is not None:
+        # The pooled client is logged in with the previous credentials
+        tconnect_sessions.pool.invalidate(user)
 
-        
-
-        return full_data
-
-def save_data_to_database(user : models.User, full_data : typing.Dict[typing.Tuple[arrow.Arrow], typing.Dict[str, typing.Any]]):
-
-    for (range_tup, entry_dict) in full_data.items():
-
-        entry = models.DiabetesEntry()
-        entry.owner = user
+    return JsonResponse(utility.format_response_dict())
 
-        entry.start_datetime = range_tup[0].datetime
-        entry.end_datetime = range_tup[1].datetime
 
-        entry.blood_glucose = entry_dict.get("bg")
-        entry.trend_rate = entry_dict.get("trend_rate")
-        entry.trend = entry_dict.get("trend")
+def _sync_in_request(user : models.User, utc_time_start : arrow.Arrow, utc_time_end : arrow.Arrow, plan : download_data.DownloadPlan, endpoint : str) -> bool:
+    # Syncs without the worker, returns whether the sync is still pending on another node
+    try:
+        persisted_count = sync_services.sync_user_data(user, utc_time_start, utc_time_end, plan)
+        logger.info("{} | \"Fetched data has {} ranges\"".format(endpoint, persisted_count))
+    except sync_lease.LeaseUnavailable:
+        # The persisted entries are returned, another node is adding the newer ones
+        logger.warning("{} | \"Sync held by another node\"".format(endpoint))
+        return True
 
-        entry.insulin_on_board = entry_dict.get("iob", [])
+    return False
 
-        entry.dosed_insulin = entry_dict.get("insulin")
-        entry.dose_target_bg = entry_dict.get("target_bg")
-        entry.is_manual_bolus = entry_dict.get("is_manual")
+def _serialized_entries(user : models.User, last_fetched_datetime_str : typing.Optional[str]) -> typing.List[typing.Dict[str, typing.Any]]:
+    all_entries = models.DiabetesEntry.objects.filter(owner=user)
 
-        comp_time : arrow.Arrow = entry_dict.get("completion_time")
-        if comp_time is not None:
-            entry.dose_completion_time = comp_time.datetime
+    if last_fetched_datetime_str is not None:
+        last_fetched_datetime = arrow.get(last_fetched_datetime_str).datetime
+        all_entries = all_entries.filter(start_datetime__gte=last_fetched_datetime)
 
-        # If this entry already exists, don't add it
-        try:
-            test_entry = models.DiabetesEntry.objects.get(start_datetime=entry.start_datetime, end_datetime=entry.end_datetime, owner=user)
-            continue
-        except:
-            pass
-        print("Saved: ({})".format(range_tup))
-        entry.save()
+    with spans.span("serialize"):
+        return model_serializers.EntrySerializer(all_entries, many=True).data
 
-@api_view(['POST'])
-def get_all_data(request : rest.request.Request):
 
-    user : models.User = request.user.user 
-    request_dict = rest.parsers.JSONParser().parse(request)
+@async_api.async_api_view
+async def get_all_data(request : HttpRequest, user : models.User, request_dict : typing.Dict[str, typing.Any]):
 
     if not user.is_valid_user():
             logger.warning("get-all-data | \"Some TConnect and Dexcom credentials missing\"")
@@ -115,36 +100,37 @@ def get_all_data(request : rest.request.Request):
     now = utility.utc_datetime()
 
     utc_time_end = arrow.get(now)
+    utc_time_start = arrow.get(sync_services.fetched_until(user, GET_ALL_DATA_PLAN) - sync_worker.SYNC_OVERLAP)
 
+    with spans.recording(user.uuid, utc_time_end - utc_time_start) as recorder:
+        if settings.BACKGROUND_SYNC:
+            # Persisted entries are returned, the worker adds the newer ones
+            sync_pending = await async_api.run_blocking(sync_worker.request_sync, user, force=request_dict.get("refresh", False))
+        else:
+            sync_pending = await async_api.run_blocking(_sync_in_request, user, utc_time_start, utc_time_end, GET_ALL_DATA_PLAN, "get-all-data")
 
-    full_data = fetch_all_data(user, arrow.get(user.last_fetched_datetime - datetime.timedelta(days=2)), utc_time_end)
-    print("Fetched data has {} ranges".format(len(full_data.keys())))
-    if full_data != {} and full_data is not None:
-        
-        user.last_fetched_datetime = utc_time_end.datetime
-        user.save()
+        entries_json_list = await async_api.run_blocking(_serialized_entries, user, request_dict.get("last_fetched_datetime"))
+        response = JsonResponse(utility.format_response_dict({"data" : entries_json_list, "sync_pending" : sync_pending}))
 
-    save_data_to_database(user, full_data)
+    return spans.add_timing_header(request, response, recorder)
+    
 
-    all_entries = models.DiabetesEntry.objects.filter(owner=user)
+def _save_target_bg(user : models.User, request_dict : typing.Dict[str, typing.Any]):
+        target_bg = request_dict.get("target_bg")
+        target_bg_duration = request_dict.get("target_duration_minutes")
 
-    last_fetched_datetime_str = request_dict.get("last_fetched_datetime")
-    if last_fetched_datetime_str is not None:
-        last_fetched_datetime = arrow.get(last_fetched_datetime_str).datetime
-        all_entries = all_entries.filter(start_datetime__gte=last_fetched_datetime)
+        if target_bg is not None:
+            user.current_target_bg = target_bg
 
-    entries_json_list = model_serializers.EntrySerializer(all_entries, many=True).data # This is where the requests timeout
+        if target_bg_duration is not None and isinstance(target_bg_duration, int):
+            user.target_bg_duration = datetime.timedelta(minutes=target_bg_duration)
 
-    return JsonResponse(utility.format_response_dict({"data" : entries_json_list}))
-    
+        user.save()
 
 # MSS = minutes since start of day
 # Comp_MSS = MSS of completed bolus
-@api_view(['POST'])
-def calculate_insulin(request : rest.request.Request):
-
-        user : models.User = request.user.user 
-        request_dict = rest.parsers.JSONParser().parse(request)
+@async_api.async_api_view
+async def calculate_insulin(request : HttpRequest, user : models.User, request_dict : typing.Dict[str, typing.Any]):
 
         if not user.is_valid_user():
                 logger.warning("calculate-insulin | \"Some TConnect and Dexcom credentials missing\"")
@@ -157,28 +143,19 @@ def calculate_insulin(request : rest.request.Request):
         mss : int = int((now.hour * 60) + now.minute)
         comp_mss : int = mss + comp_mss_delta
 
-        target_bg = request_dict.get("target_bg")
-        target_bg_duration = request_dict.get("target_duration_minutes")
-
-        if target_bg is not None:
-            user.current_target_bg = target_bg
-
-        if target_bg_duration is not None and isinstance(target_bg_duration, int):
-            user.target_bg_duration = datetime.timedelta(minutes=target_bg_duration)
-
-        user.save()
+        await async_api.run_blocking(_save_target_bg, user, request_dict)
 
         utc_time_end = arrow.get(now)
+        utc_time_start = arrow.get(sync_services.fetched_until(user, CALCULATE_INSULIN_PLAN))
 
-        full_data = fetch_all_data(user, user.last_fetched_datetime, utc_time_end)
-        if full_data != {} and full_data is not None:
-            user.last_fetched_datetime = utc_time_end.datetime
-            user.save()
-
-        save_data_to_database(user, full_data)
+        with spans.recording(user.uuid, utc_time_end - utc_time_start) as recorder:
+                if settings.BACKGROUND_SYNC:
+                        sync_pending = await async_api.run_blocking(sync_worker.request_sync, user, force=request_dict.get("refresh", False))
+                else:
+                        sync_pending = await async_api.run_blocking(_sync_in_request, user, utc_time_start, utc_time_end, CALCULATE_INSULIN_PLAN, "calculate-insulin")
 
 
-        return JsonResponse(utility.format_response_dict({}))
+        return spans.add_timing_header(request, JsonResponse(utility.format_response_dict({"sync_pending" : sync_pending})), recorder)
         
 
 @api_view(['POST'])
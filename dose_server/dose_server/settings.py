@@ -26,6 +26,33 @@ SECRET_KEY = 'django-insecure-x7z_@$p*a!u*i35m(0iba!gn+9k5yl7x7zd)lx_1217pphmgvr
 # SECURITY WARNING: don't run with debug turned on in production!
 DEBUG = True
 
+# Adds a Server-Timing header with the sync stage timings to the sync responses of requests sending "X-Debug-Timing: 1"
+SYNC_TIMING_HEADER = False
+
+# On-disk cache of raw t:connect and Dexcom responses of closed days, None disables it.
+# The cache stores personal health data: the raw Dexcom EGVs and the t:connect bolus, CGM, IOB and basal payloads
+# of every synced user. Enable it only on a private disk, e.g. RESPONSE_CACHE_DIR = BASE_DIR / 'response_cache',
+# its directories are created with 0700 and its files with 0600 permissions.
+RESPONSE_CACHE_DIR = None
+RESPONSE_CACHE_MAX_BYTES = 256 * 1024 * 1024
+
+# Base URL of every Dexcom and t:connect request, None for the live services.
+# Set to the fake_upstream server (e.g. "http://127.0.0.1:8765") to sync offline.
+UPSTREAM_BASE_URL = None
+
+# Syncs run by the sync_worker command, get-all-data and calculate-insulin only queue them.
+# False syncs inside the requests, for deployments without a worker.
+BACKGROUND_SYNC = True
+
+# Upstream requests per second and burst by host, per sync worker process
+UPSTREAM_RATE_LIMITS = {
+    "api.dexcom.com": (10.0, 20),
+    "tdcservices.tandemdiabetes.com": (2.0, 4),
+    "tconnectws2.tandemdiabetes.com": (2.0, 4)
+}
+# Upstream requests per second and burst of each account on a host
+UPSTREAM_ACCOUNT_RATE_LIMIT = (1.0, 8)
+
 ALLOWED_HOSTS = ["44.233.146.253"]
 
 